@@ -0,0 +1,267 @@
+"""
+Route benchmark for the medical records web server.
+
+Drives every route of a running server at a chosen concurrency and reports
+p50/p95/p99 latency, throughput and SQL statements per request (read from
+the server's /metrics). Sample ids for the detail pages are drawn from the
+database the server is using.
+
+	python server.py --threaded &
+	python benchmark.py --concurrency 16 --requests 200 --output results.json
+
+Results are saved as JSON so runs can be compared across commits:
+
+	python benchmark.py --compare before.json --output after.json
+"""
+import json
+import os
+import random
+import re
+import subprocess
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import click
+from sqlalchemy import create_engine, text
+
+
+#
+# Benchmark scenarios: name -> (Flask endpoint, URL template). Templates are
+# filled from the samples drawn by load_samples().
+#
+SCENARIOS = {
+	'index': ('index', '/'),
+	'patients': ('patients', '/patients'),
+	'patients_filtered': ('patients', '/patients?sex={sex}&min_age=40&max_age=80'),
+	'patient_detail': ('patient_detail', '/patient/{subject_id}'),
+	'conditions': ('conditions', '/conditions'),
+	'conditions_search': ('conditions', '/conditions?search={condition_word}'),
+	'condition_detail': ('condition_detail', '/condition/{icd_code}/{icd_version}'),
+	'admissions': ('admissions', '/admissions'),
+	'admissions_filtered': ('admissions', '/admissions?admission_type={admission_type}'),
+	'analytics': ('analytics', '/analytics'),
+	'medications': ('medications', '/medications'),
+	'medications_search': ('medications', '/medications?search={medication_word}'),
+	'prescriptions': ('prescriptions', '/prescriptions'),
+	'prescriptions_filtered': ('prescriptions', '/prescriptions?subject_id={subject_id}'),
+	'procedures': ('procedures', '/procedures'),
+	'trends': ('trends', '/trends?grain={grain}'),
+	'trends_medication': ('trends', '/trends?grain={grain}&medication_id={medication_id}'),
+	'trends_condition': ('trends', '/trends?grain={grain}&icd_code={icd_code}&icd_version={icd_version}'),
+	'cohort': ('cohort', '/cohort?q=condition:{icd_code}%20AND%20sex:{sex}'),
+	'cohort_medication': ('cohort', '/cohort?q=medication:%22{medication_name}%22%20AND%20age%3E%3D65'),
+	'api_cohort': ('api_cohort', '/api/v1/cohort?q=condition:{icd_code}%20OR%20medication:%22{medication_name}%22&limit=0'),
+	'api_trends': ('api_trends', '/api/v1/trends?grain={grain}&medication_id={medication_id}'),
+	'api_analytics': ('api_analytics', '/api/v1/analytics'),
+	'api_patients': ('api_list', '/api/v1/patients?sex={sex}'),
+	'api_conditions': ('api_list', '/api/v1/conditions?search={condition_word}'),
+	'api_admissions': ('api_list', '/api/v1/admissions?admission_type={admission_type}&format=columnar'),
+	'api_medications': ('api_list', '/api/v1/medications?search={medication_word}'),
+	'api_prescriptions': ('api_list', '/api/v1/prescriptions?subject_id={subject_id}'),
+	'api_procedures': ('api_list', '/api/v1/procedures'),
+	# Exports stream every matching row, so these stay filtered to one
+	# patient or condition
+	'export_prescriptions': ('export', '/export/prescriptions.csv?subject_id={subject_id}'),
+	'export_admissions': ('export', '/export/admissions.ndjson?subject_id={subject_id}'),
+	'export_condition': ('export_condition', '/export/condition/{icd_code}/{icd_version}.csv')
+}
+
+
+def load_samples(database_uri, count=200, seed=4111):
+	"""
+	Draw ids and search terms for the URL templates from the database
+	"""
+	rng = random.Random(seed)
+	engine = create_engine(database_uri)
+	with engine.connect() as conn:
+		def column(query):
+			return [row[0] for row in conn.execute(text(query), {'count': count})]
+
+		subject_ids = column("SELECT subject_id FROM wl2822.patient ORDER BY random() LIMIT :count")
+		# Diagnosed conditions, weighted towards the popular ones like real traffic
+		condition_keys = [(row.icd_code, row.icd_version) for row in conn.execute(text("""
+			SELECT icd_code, icd_version FROM wl2822.admission_diagnosis
+			ORDER BY random() LIMIT :count
+		"""), {'count': count})]
+		condition_names = column("SELECT condition_name FROM wl2822.condition ORDER BY random() LIMIT :count")
+		medication_names = column("SELECT name FROM wl2822.medication ORDER BY random() LIMIT :count")
+		# Prescribed medications, weighted like the conditions
+		medications = [(row.medication_id, row.name) for row in conn.execute(text("""
+			SELECT p.medication_id, m.name FROM wl2822.prescription p
+			JOIN wl2822.medication m ON m.medication_id = p.medication_id
+			ORDER BY random() LIMIT :count
+		"""), {'count': count})]
+		admission_types = column("SELECT DISTINCT admission_type FROM wl2822.admission WHERE admission_type IS NOT NULL LIMIT :count")
+	engine.dispose()
+
+	def words(names):
+		return [word for name in names for word in re.findall(r'[A-Za-z]{4,}', name or '')] or ['a']
+
+	def sample():
+		icd_code, icd_version = rng.choice(condition_keys) if condition_keys else ('0', 9)
+		medication_id, medication_name = rng.choice(medications) if medications else (0, '')
+		return {
+			'subject_id': rng.choice(subject_ids) if subject_ids else 0,
+			'sex': rng.choice('mf'),
+			'icd_code': icd_code,
+			'icd_version': icd_version,
+			'condition_word': rng.choice(words(condition_names)).lower(),
+			'medication_word': rng.choice(words(medication_names))[:4].lower(),
+			'admission_type': rng.choice(admission_types) if admission_types else '',
+			'medication_id': medication_id,
+			'medication_name': medication_name,
+			'grain': rng.choice(('day', 'week', 'month'))
+		}
+
+	return sample
+
+
+def scrape_statements(base_url):
+	"""
+	db_statements_total per route from the server's /metrics, and the number
+	of worker processes it adds up
+	"""
+	with urllib.request.urlopen(base_url + '/metrics', timeout=30) as response:
+		body = response.read().decode()
+	totals = {}
+	for route, value in re.findall(r'^db_statements_total\{route="([^"]+)"\} (\S+)$', body, re.M):
+		totals[route] = float(value)
+	processes = re.search(r'^metrics_processes (\d+)$', body, re.M)
+	return totals, int(processes.group(1)) if processes else 1
+
+
+def percentile(sorted_values, fraction):
+	"""
+	Nearest-rank percentile of an already sorted list
+	"""
+	if not sorted_values:
+		return None
+	index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+	return sorted_values[index]
+
+
+def fetch(url, timeout):
+	started = time.perf_counter()
+	try:
+		with urllib.request.urlopen(url, timeout=timeout) as response:
+			response.read()
+			status = response.status
+	except urllib.error.HTTPError as e:
+		status = e.code
+	except Exception:
+		status = None
+	return time.perf_counter() - started, status
+
+
+def run_scenario(base_url, template, sample, requests, concurrency, timeout):
+	"""
+	Issue `requests` requests at the given concurrency and summarize them
+	"""
+	urls = [base_url + template.format(**{key: urllib.parse.quote(str(value)) for key, value in sample().items()})
+		for _ in range(requests)]
+	started = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as pool:
+		results = list(pool.map(lambda url: fetch(url, timeout), urls))
+	elapsed = time.perf_counter() - started
+
+	latencies = sorted(latency for latency, _ in results)
+	errors = sum(1 for _, status in results if status is None or status >= 500)
+	return {
+		'requests': requests,
+		'errors': errors,
+		'seconds': round(elapsed, 3),
+		'throughput_rps': round(requests / elapsed, 2) if elapsed else None,
+		'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+		'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+		'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+		'max_ms': round(latencies[-1] * 1000, 2)
+	}
+
+
+def git_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+			cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+	except Exception:
+		return None
+
+
+def print_comparison(before, after):
+	print()
+	print("%-24s %12s %12s %9s %12s %12s" % ('scenario', 'p95 before', 'p95 after', 'change', 'rps before', 'rps after'))
+	for name, result in after['scenarios'].items():
+		old = before.get('scenarios', {}).get(name)
+		if not old:
+			continue
+		change = (result['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0
+		print("%-24s %10.1fms %10.1fms %+8.1f%% %12s %12s" % (
+			name, old['p95_ms'], result['p95_ms'], change, old['throughput_rps'], result['throughput_rps']))
+
+
+@click.command()
+@click.option('--base-url', default='http://127.0.0.1:8111', help='Server to benchmark')
+@click.option('--database-uri', default=lambda: os.environ.get('DATABASEURI'), help='Database to draw sample ids from (default: $DATABASEURI)')
+@click.option('--concurrency', default=8, type=int, help='Requests in flight at once')
+@click.option('--requests', 'request_count', default=100, type=int, help='Requests per scenario')
+@click.option('--warmup', default=5, type=int, help='Unmeasured requests per scenario first')
+@click.option('--timeout', default=60.0, type=float, help='Per-request timeout in seconds')
+@click.option('--metrics-settle', default=1.5, type=float, show_default=True,
+	help="Seconds to wait before reading a multi-worker server's metrics, for every worker to write its counts (METRICS_FLUSH_INTERVAL)")
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(sorted(SCENARIOS)), help='Only run these scenarios (repeatable)')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results as JSON')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), help='Earlier results JSON to compare against')
+def main(base_url, database_uri, concurrency, request_count, warmup, timeout, metrics_settle, scenarios, output, compare):
+	"""
+	Benchmark every route of a running server.
+	"""
+	if not database_uri:
+		raise click.UsageError('pass --database-uri or set DATABASEURI')
+	base_url = base_url.rstrip('/')
+	sample = load_samples(database_uri)
+
+	results = {
+		'commit': git_commit(),
+		'timestamp': datetime.now(timezone.utc).isoformat(),
+		'base_url': base_url,
+		'concurrency': concurrency,
+		'requests_per_scenario': request_count,
+		'scenarios': {}
+	}
+
+	print("%-24s %8s %9s %9s %9s %9s %7s %7s" % ('scenario', 'rps', 'p50', 'p95', 'p99', 'max', 'errors', 'sql/req'))
+	for name in scenarios or SCENARIOS:
+		endpoint, template = SCENARIOS[name]
+		if warmup:
+			run_scenario(base_url, template, sample, warmup, 1, timeout)
+		# Under `serve` the other workers' counts reach /metrics within a
+		# flush interval
+		before, processes = scrape_statements(base_url)
+		if processes > 1:
+			time.sleep(metrics_settle)
+			before, processes = scrape_statements(base_url)
+		result = run_scenario(base_url, template, sample, request_count, concurrency, timeout)
+		if processes > 1:
+			time.sleep(metrics_settle)
+		after, _ = scrape_statements(base_url)
+		result['queries_per_request'] = round((after.get(endpoint, 0) - before.get(endpoint, 0)) / request_count, 2)
+		results['scenarios'][name] = result
+		print("%-24s %8.1f %7.1fms %7.1fms %7.1fms %7.1fms %7d %7.1f" % (
+			name, result['throughput_rps'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+			result['max_ms'], result['errors'], result['queries_per_request']))
+
+	if output:
+		with open(output, 'w') as f:
+			json.dump(results, f, indent=2)
+		print("results written to %s" % output)
+
+	if compare:
+		with open(compare) as f:
+			print_comparison(json.load(f), results)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,329 @@
+"""
+Bulk loader for MIMIC extracts in the wl2822 schema.
+
+Streams CSV or CSV.gz files into the tables with COPY FROM STDIN. Each file
+holds one table and is named after it (admission.csv.gz, prescription.csv,
+...), with a header row of column names; columns left out take their
+defaults. Rows go through a staging table and are upserted on the table's
+primary key, so loading an extract twice updates rows instead of failing on
+duplicates.
+
+Tables load in foreign-key order, the tables of one level in parallel, each
+in a single transaction. For loads that are large next to the table, its
+secondary indexes are dropped first and rebuilt at the end. DROP INDEX takes
+an ACCESS EXCLUSIVE lock that is held until the table's transaction commits,
+so such a load blocks every query on the table, reads included: run it in a
+maintenance window, or with rebuild_indexes='never' while the app is serving.
+Triggers that maintain derived tables can be switched off for the load so the
+caller rebuilds those once afterwards.
+
+Used by `python server.py ingest`, which also refreshes what the app derives
+from the loaded tables.
+"""
+import csv
+import gzip
+import io
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+
+# Bytes sampled from the start of a file to estimate its row count
+ESTIMATE_SAMPLE_BYTES = 1 << 20
+
+# 'auto' index rebuilds need at least this many incoming rows, and at least
+# REBUILD_RATIO times the rows already in the table
+REBUILD_MIN_ROWS = 50000
+REBUILD_RATIO = 0.5
+
+LoadResult = namedtuple('LoadResult', ['table', 'path', 'rows', 'seconds'])
+
+
+def table_name(path):
+	"""
+	Table a file loads into: its name without .csv / .csv.gz
+	"""
+	name = os.path.basename(path)
+	for suffix in ('.csv.gz', '.csv'):
+		if name.lower().endswith(suffix):
+			return name[:-len(suffix)]
+	return None
+
+
+def find_files(paths):
+	"""
+	Expand directories into the CSV / CSV.gz files directly inside them
+	"""
+	files = []
+	for path in paths:
+		if os.path.isdir(path):
+			files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+				if table_name(name) is not None))
+		else:
+			files.append(path)
+	return files
+
+
+def open_csv(path):
+	return gzip.open(path, 'rb') if path.lower().endswith('.gz') else open(path, 'rb')
+
+
+def raw_position(stream):
+	"""
+	Bytes of the file on disk consumed so far (compressed bytes for .gz)
+	"""
+	return stream.fileobj.tell() if isinstance(stream, gzip.GzipFile) else stream.tell()
+
+
+def csv_records(stream):
+	"""
+	Yield the raw bytes of each CSV record. A record ends at the first
+	newline with an even number of quotes before it, so newlines inside
+	quoted fields stay in their record.
+	"""
+	parts = []
+	quotes = 0
+	for line in stream:
+		parts.append(line)
+		quotes += line.count(b'"')
+		if quotes % 2 == 0:
+			yield b''.join(parts) if len(parts) > 1 else line
+			parts = []
+			quotes = 0
+	if parts:
+		yield b''.join(parts)
+
+
+def read_header(stream):
+	return next(csv.reader([next(csv_records(stream)).decode('utf-8-sig')]))
+
+
+def estimate_rows(path):
+	"""
+	Rows in a file, extrapolated from the records in its first
+	ESTIMATE_SAMPLE_BYTES
+	"""
+	size = os.path.getsize(path)
+	with open_csv(path) as stream:
+		read_header(stream)
+		start = raw_position(stream)
+		rows = 0
+		for _ in csv_records(stream):
+			rows += 1
+			if raw_position(stream) - start >= ESTIMATE_SAMPLE_BYTES:
+				break
+		consumed = raw_position(stream) - start
+	if consumed <= 0:
+		return rows
+	return int(rows * max(size - start, consumed) / consumed)
+
+
+def batches(stream, batch_rows):
+	"""
+	Group the records of a stream into (row count, bytes) batches
+	"""
+	chunk = []
+	for record in csv_records(stream):
+		chunk.append(record)
+		if len(chunk) == batch_rows:
+			yield len(chunk), b''.join(chunk)
+			chunk = []
+	if chunk:
+		yield len(chunk), b''.join(chunk)
+
+
+def table_columns(cursor, table):
+	cursor.execute("""
+		SELECT a.attname FROM pg_attribute a
+		WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+		ORDER BY a.attnum
+	""", (f'wl2822.{table}',))
+	return [row[0] for row in cursor.fetchall()]
+
+
+def primary_key(cursor, table):
+	cursor.execute("""
+		SELECT a.attname
+		FROM pg_index i
+		JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+		WHERE i.indrelid = %s::regclass AND i.indisprimary
+		ORDER BY array_position(i.indkey, a.attnum)
+	""", (f'wl2822.{table}',))
+	return [row[0] for row in cursor.fetchall()]
+
+
+def secondary_indexes(cursor, table):
+	"""
+	(name, definition) of the indexes that back no constraint
+	"""
+	cursor.execute("""
+		SELECT c.relname, pg_get_indexdef(i.indexrelid)
+		FROM pg_index i
+		JOIN pg_class c ON c.oid = i.indexrelid
+		WHERE i.indrelid = %s::regclass
+			AND NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conindid = i.indexrelid)
+		ORDER BY c.relname
+	""", (f'wl2822.{table}',))
+	return cursor.fetchall()
+
+
+def load_levels(engine, tables):
+	"""
+	Group tables into levels that can load in parallel: every table comes
+	after the tables it references by foreign key
+	"""
+	with engine.connect() as conn:
+		references = conn.execute(text("""
+			SELECT child.relname as child, parent.relname as parent
+			FROM pg_constraint k
+			JOIN pg_class child ON child.oid = k.conrelid
+			JOIN pg_class parent ON parent.oid = k.confrelid
+			JOIN pg_namespace n ON n.oid = child.relnamespace
+			WHERE k.contype = 'f' AND n.nspname = 'wl2822'
+		""")).fetchall()
+
+	parents = {table: set() for table in tables}
+	for child, parent in references:
+		if child in parents and parent in parents and child != parent:
+			parents[child].add(parent)
+
+	levels = []
+	placed = set()
+	while len(placed) < len(parents):
+		level = sorted(table for table in parents if table not in placed and parents[table] <= placed)
+		if not level:
+			raise ValueError("foreign keys form a cycle between " + ", ".join(sorted(set(parents) - placed)))
+		levels.append(level)
+		placed.update(level)
+	return levels
+
+
+def load_table(engine, table, paths, batch_rows=100000, rebuild_indexes='auto', deferred_triggers=(), log=print):
+	"""
+	Load every file of one table in a single transaction. Triggers named in
+	`deferred_triggers` are disabled for the load; the caller rebuilds
+	whatever they maintain. Returns a LoadResult per file.
+	"""
+	raw = engine.raw_connection()
+	try:
+		cursor = raw.cursor()
+		columns = table_columns(cursor, table)
+		if not columns:
+			raise ValueError(f"wl2822.{table} has no columns")
+		key = primary_key(cursor, table)
+
+		cursor.execute("""
+			SELECT tgname FROM pg_trigger
+			WHERE tgrelid = %s::regclass AND tgname = ANY(%s) AND tgenabled <> 'D'
+		""", (f'wl2822.{table}', list(deferred_triggers)))
+		disabled = [row[0] for row in cursor.fetchall()]
+		for trigger in disabled:
+			cursor.execute(f'ALTER TABLE wl2822.{table} DISABLE TRIGGER "{trigger}"')
+
+		rebuild = rebuild_indexes == 'always'
+		if rebuild_indexes == 'auto':
+			cursor.execute("SELECT GREATEST(reltuples, 0) FROM pg_class WHERE oid = %s::regclass", (f'wl2822.{table}',))
+			existing = cursor.fetchone()[0]
+			incoming = sum(estimate_rows(path) for path in paths)
+			rebuild = incoming >= REBUILD_MIN_ROWS and incoming >= REBUILD_RATIO * existing
+
+		# DROP INDEX locks the table ACCESS EXCLUSIVE until commit: readers of
+		# the table wait for the whole load and index rebuild
+		dropped = []
+		if rebuild:
+			for name, definition in secondary_indexes(cursor, table):
+				cursor.execute(f'DROP INDEX wl2822."{name}"')
+				dropped.append((name, definition))
+			if dropped:
+				log(f"{table}: dropped {len(dropped)} secondary index(es) for the load; "
+					"reads of the table block until it commits")
+
+		stage = f'ingest_{table}'
+		cursor.execute(f'CREATE TEMP TABLE "{stage}" (LIKE wl2822.{table} INCLUDING DEFAULTS) ON COMMIT DROP')
+
+		results = []
+		for path in paths:
+			started = time.perf_counter()
+			rows = 0
+			with open_csv(path) as stream:
+				header = read_header(stream)
+				unknown = [column for column in header if column not in columns]
+				if unknown:
+					raise ValueError(f"{path}: no column(s) {', '.join(unknown)} in wl2822.{table}")
+				missing = [column for column in key if column not in header]
+				if missing:
+					raise ValueError(f"{path}: key column(s) {', '.join(missing)} missing")
+
+				column_list = ', '.join(f'"{column}"' for column in header)
+				if key:
+					updates = [column for column in header if column not in key]
+					conflict = (f"ON CONFLICT ({', '.join(key)}) DO UPDATE SET "
+						+ ', '.join(f'"{column}" = EXCLUDED."{column}"' for column in updates)) if updates \
+						else f"ON CONFLICT ({', '.join(key)}) DO NOTHING"
+					# A key repeated within one batch can only be upserted once;
+					# the last occurrence in the file wins
+					select = (f'SELECT DISTINCT ON ({", ".join(key)}) {column_list} FROM "{stage}" '
+						f'ORDER BY {", ".join(key)}, ctid DESC')
+				else:
+					conflict = ''
+					select = f'SELECT {column_list} FROM "{stage}"'
+
+				for count, chunk in batches(stream, batch_rows):
+					cursor.copy_expert(f'COPY "{stage}" ({column_list}) FROM STDIN WITH (FORMAT csv)',
+						io.BytesIO(chunk), size=1 << 20)
+					cursor.execute(f'INSERT INTO wl2822.{table} ({column_list}) {select} {conflict}')
+					cursor.execute(f'TRUNCATE "{stage}"')
+					rows += count
+
+			elapsed = time.perf_counter() - started
+			log("%-22s %10d rows  %7.1fs  %10.0f rows/s  %s" % (table, rows, elapsed, rows / max(elapsed, 1e-9), path))
+			results.append(LoadResult(table, path, rows, elapsed))
+
+		if dropped:
+			started = time.perf_counter()
+			for name, definition in dropped:
+				cursor.execute(definition)
+			log(f"{table}: rebuilt {len(dropped)} index(es) in {time.perf_counter() - started:.1f}s")
+
+		for trigger in disabled:
+			cursor.execute(f'ALTER TABLE wl2822.{table} ENABLE TRIGGER "{trigger}"')
+		raw.commit()
+		return results
+	except Exception:
+		raw.rollback()
+		raise
+	finally:
+		raw.close()
+
+
+def load_files(engine, paths, jobs=4, batch_rows=100000, rebuild_indexes='auto', deferred_triggers=(), log=print):
+	"""
+	Load CSV / CSV.gz files (or directories of them) into their tables,
+	level by level in foreign-key order with up to `jobs` tables at a time.
+	Returns the LoadResults of every file.
+	"""
+	files_by_table = {}
+	for path in find_files(paths):
+		table = table_name(path)
+		if table is None:
+			raise ValueError(f"{path}: expected a <table>.csv or <table>.csv.gz file")
+		files_by_table.setdefault(table, []).append(path)
+
+	with engine.connect() as conn:
+		known = {row[0] for row in conn.execute(text(
+			"SELECT table_name FROM information_schema.tables WHERE table_schema = 'wl2822'"))}
+	unknown = sorted(set(files_by_table) - known)
+	if unknown:
+		raise ValueError(f"no table(s) wl2822.{', wl2822.'.join(unknown)}")
+
+	results = []
+	with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+		for level in load_levels(engine, files_by_table):
+			futures = [pool.submit(load_table, engine, table, files_by_table[table],
+				batch_rows, rebuild_indexes, deferred_triggers, log) for table in level]
+			for future in futures:
+				results.extend(future.result())
+	return results
@@ -0,0 +1,438 @@
+"""
+Synthetic MIMIC-style data generator for the wl2822 schema.
+
+Fills the 12 tables at a chosen scale factor, where scale 1 matches the
+course database (400 patients, 2,147 admissions, 88,901 prescriptions).
+The data is skewed like the real extract: a few patients have many
+admissions, and diagnosis, medication and procedure popularity follow a
+Zipf distribution.
+
+Load into a local Postgres with:
+
+	python generate_data.py --database-uri postgresql://localhost/mimic --create-schema --scale 100
+
+Rows are streamed into each table with COPY FROM STDIN, in chunks.
+"""
+import csv
+import io
+import os
+import random
+import string
+import time
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+
+import click
+from sqlalchemy import create_engine, text
+
+
+#
+# Table layout of the wl2822 schema, in foreign-key load order
+#
+SCHEMA_DDL = """
+CREATE SCHEMA IF NOT EXISTS wl2822;
+
+CREATE TABLE IF NOT EXISTS wl2822.patient (
+	subject_id INTEGER PRIMARY KEY,
+	sex TEXT,
+	date_of_birth DATE,
+	race TEXT
+);
+
+CREATE TABLE IF NOT EXISTS wl2822.provider (
+	provider_id TEXT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS wl2822.medication (
+	medication_id INTEGER PRIMARY KEY,
+	name TEXT,
+	strength TEXT,
+	form TEXT
+);
+
+CREATE TABLE IF NOT EXISTS wl2822.condition (
+	icd_code TEXT,
+	icd_version INTEGER,
+	condition_name TEXT,
+	PRIMARY KEY (icd_code, icd_version)
+);
+
+CREATE TABLE IF NOT EXISTS wl2822.procedures (
+	icd_code TEXT,
+	icd_version INTEGER,
+	procedure_name TEXT,
+	PRIMARY KEY (icd_code, icd_version)
+);
+
+CREATE TABLE IF NOT EXISTS wl2822.admission (
+	hadm_id INTEGER PRIMARY KEY,
+	subject_id INTEGER REFERENCES wl2822.patient,
+	admission_intime TIMESTAMP,
+	admission_outtime TIMESTAMP,
+	admission_type TEXT,
+	admission_location TEXT,
+	discharge_location TEXT
+);
+
+CREATE TABLE IF NOT EXISTS wl2822.admission_diagnosis (
+	hadm_id INTEGER REFERENCES wl2822.admission,
+	icd_code TEXT,
+	icd_version INTEGER,
+	subject_id INTEGER REFERENCES wl2822.patient,
+	diagnosed_on DATE,
+	rank INTEGER,
+	PRIMARY KEY (hadm_id, icd_code, icd_version),
+	FOREIGN KEY (icd_code, icd_version) REFERENCES wl2822.condition
+);
+
+CREATE TABLE IF NOT EXISTS wl2822.prescription (
+	prescription_id INTEGER PRIMARY KEY,
+	subject_id INTEGER REFERENCES wl2822.patient,
+	hadm_id INTEGER REFERENCES wl2822.admission,
+	medication_id INTEGER REFERENCES wl2822.medication,
+	dose TEXT,
+	route TEXT,
+	frequency TEXT,
+	start_time TIMESTAMP,
+	end_time TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS wl2822.procedures_performed (
+	hadm_id INTEGER REFERENCES wl2822.admission,
+	icd_code TEXT,
+	icd_version INTEGER,
+	subject_id INTEGER REFERENCES wl2822.patient,
+	procedure_date DATE,
+	PRIMARY KEY (hadm_id, icd_code, icd_version),
+	FOREIGN KEY (icd_code, icd_version) REFERENCES wl2822.procedures
+);
+
+CREATE TABLE IF NOT EXISTS wl2822.orders (
+	poe_id TEXT PRIMARY KEY,
+	hadm_id INTEGER REFERENCES wl2822.admission,
+	subject_id INTEGER REFERENCES wl2822.patient,
+	order_provider_id TEXT REFERENCES wl2822.provider,
+	order_type TEXT,
+	order_time TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS wl2822.medical_images (
+	image_id TEXT PRIMARY KEY,
+	subject_id INTEGER REFERENCES wl2822.patient,
+	hadm_id INTEGER REFERENCES wl2822.admission,
+	study_id INTEGER,
+	viewpoint TEXT,
+	acquisition_date TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS wl2822.patient_condition (
+	subject_id INTEGER REFERENCES wl2822.patient,
+	icd_code TEXT,
+	icd_version INTEGER,
+	PRIMARY KEY (subject_id, icd_code, icd_version),
+	FOREIGN KEY (icd_code, icd_version) REFERENCES wl2822.condition
+);
+"""
+
+TABLES = ['patient', 'provider', 'medication', 'condition', 'procedures', 'admission',
+	'admission_diagnosis', 'prescription', 'procedures_performed', 'orders',
+	'medical_images', 'patient_condition']
+
+# Catalog sizes of the course database; catalogs do not grow with the scale
+CONDITION_COUNT = 12910
+MEDICATION_COUNT = 5115
+PROCEDURE_COUNT = 3000
+PROVIDER_COUNT = 4982
+
+# Fact table sizes at scale 1
+PATIENTS_PER_SCALE = 400
+ADMISSIONS_PER_SCALE = 2147
+
+# Mean rows per admission, chosen to match the course database totals
+DIAGNOSES_PER_ADMISSION = 11
+PRESCRIPTIONS_PER_ADMISSION = 41
+PROCEDURES_PER_ADMISSION = 2
+ORDERS_PER_ADMISSION = 25
+IMAGES_PER_ADMISSION = 3
+
+# Zipf exponent for diagnosis, medication and procedure popularity
+ZIPF_EXPONENT = 1.1
+
+RACES = ['WHITE', 'BLACK/AFRICAN AMERICAN', 'HISPANIC/LATINO', 'ASIAN', 'OTHER']
+RACE_WEIGHTS = [62, 16, 9, 6, 7]
+ADMISSION_TYPES = ['EW EMER.', 'URGENT', 'OBSERVATION ADMIT', 'ELECTIVE', 'DIRECT EMER.', 'SURGICAL SAME DAY ADMISSION']
+ADMISSION_TYPE_WEIGHTS = [40, 20, 15, 10, 8, 7]
+ADMISSION_LOCATIONS = ['EMERGENCY ROOM', 'PHYSICIAN REFERRAL', 'TRANSFER FROM HOSPITAL', 'WALK-IN/SELF REFERRAL', 'CLINIC REFERRAL', 'PROCEDURE SITE']
+DISCHARGE_LOCATIONS = ['HOME', 'HOME HEALTH CARE', 'SKILLED NURSING FACILITY', 'REHAB', 'DIED', 'HOSPICE']
+ROUTES = ['PO', 'IV', 'SC', 'IM', 'PO/NG', 'TP', 'IH', 'NU']
+ROUTE_WEIGHTS = [45, 25, 10, 3, 7, 4, 4, 2]
+FREQUENCIES = ['Q4H', 'Q6H', 'Q8H', 'Q12H', 'DAILY', 'BID', 'TID', 'PRN', 'ONCE']
+FORMS = ['Tablet', 'Capsule', 'Injection', 'Bag', 'Vial', 'Syringe', 'Solution', 'Cream', 'Inhaler', 'Patch']
+ORDER_TYPES = ['Lab', 'Medications', 'Radiology', 'Nutrition', 'General Care', 'Consults', 'IV therapy', 'Respiratory']
+VIEWPOINTS = ['AP', 'PA', 'LATERAL', 'LL', 'AP AXIAL', 'LPO']
+
+CONDITION_WORDS = [
+	['Acute', 'Chronic', 'Unspecified', 'Recurrent', 'Severe', 'Mild', 'Primary', 'Secondary', 'Congenital', 'Obstructive'],
+	['cardiac', 'renal', 'hepatic', 'pulmonary', 'cerebral', 'gastric', 'thyroid', 'vascular', 'spinal', 'pancreatic', 'urinary', 'respiratory'],
+	['failure', 'insufficiency', 'hypertension', 'infection', 'stenosis', 'disorder', 'neoplasm', 'embolism', 'edema', 'ulcer', 'hemorrhage', 'syndrome'],
+	['', 'without complication', 'with complication', 'of left side', 'of right side', 'initial encounter', 'subsequent encounter', 'not elsewhere classified']
+]
+PROCEDURE_WORDS = [
+	['Excision', 'Insertion', 'Drainage', 'Repair', 'Replacement', 'Bypass', 'Resection', 'Inspection', 'Dilation', 'Biopsy'],
+	['of heart', 'of kidney', 'of liver', 'of lung', 'of stomach', 'of colon', 'of artery', 'of vein', 'of spine', 'of skin'],
+	['open approach', 'percutaneous approach', 'endoscopic approach', 'external approach', 'via natural opening']
+]
+SYLLABLES = ['ace', 'bra', 'cor', 'dex', 'fen', 'glo', 'hep', 'ima', 'lor', 'met', 'nol', 'oxa', 'pra', 'ril', 'sar', 'tin', 'vas', 'zol', 'mab', 'pam']
+
+
+def zipf_cum_weights(n, exponent=ZIPF_EXPONENT):
+	"""
+	Cumulative Zipf weights for ranks 1..n, for random.choices(cum_weights=...)
+	"""
+	return list(accumulate(1.0 / (rank ** exponent) for rank in range(1, n + 1)))
+
+
+def sample_distinct(rng, population, cum_weights, count):
+	"""
+	Draw up to `count` distinct items from a skewed population
+	"""
+	return list(dict.fromkeys(rng.choices(population, cum_weights=cum_weights, k=count)))
+
+
+def skewed_count(rng, mean):
+	"""
+	Non-negative row count with the given mean and a long tail
+	"""
+	return int(rng.expovariate(1.0 / mean)) if mean > 0 else 0
+
+
+def random_time(rng, start, end):
+	return start + timedelta(seconds=rng.randrange(int((end - start).total_seconds())))
+
+
+class Generator:
+	"""
+	Builds the rows of every table for one scale factor and seed
+	"""
+
+	def __init__(self, scale, seed):
+		self.rng = random.Random(seed)
+		self.patient_count = max(1, round(PATIENTS_PER_SCALE * scale))
+		self.admission_count = max(1, round(ADMISSIONS_PER_SCALE * scale))
+		self.conditions = []
+		self.procedures = []
+		self.medication_ids = []
+		self.provider_ids = []
+		self.admissions = []
+		self.patient_conditions = set()
+
+	def patients(self):
+		rng = self.rng
+		for i in range(self.patient_count):
+			yield (10000000 + i,
+				rng.choice('mf'),
+				date(2011, 1, 1) + timedelta(days=rng.randrange(75 * 365)),
+				rng.choices(RACES, weights=RACE_WEIGHTS)[0])
+
+	def providers(self):
+		self.provider_ids = ['P%05d' % i for i in range(PROVIDER_COUNT)]
+		for provider_id in self.provider_ids:
+			yield (provider_id,)
+
+	def medications(self):
+		rng = self.rng
+		for medication_id in range(1, MEDICATION_COUNT + 1):
+			name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+			self.medication_ids.append(medication_id)
+			yield (medication_id, name, '%d%s' % (rng.choice([1, 2, 5, 10, 20, 25, 50, 100, 250, 500]), rng.choice(['mg', 'mcg', 'mL', 'g'])),
+				rng.choice(FORMS))
+
+	def condition_catalog(self):
+		rng = self.rng
+		for i in range(CONDITION_COUNT):
+			if i % 5 < 3:
+				code, version = '%s%04d' % (string.ascii_uppercase[i % 26], i // 26), 10
+			else:
+				code, version = '%05d' % i, 9
+			name = ' '.join(part for part in (rng.choice(words) for words in CONDITION_WORDS) if part)
+			self.conditions.append((code, version))
+			yield (code, version, name)
+
+	def procedure_catalog(self):
+		rng = self.rng
+		for i in range(PROCEDURE_COUNT):
+			if i % 3 < 2:
+				code, version = '0%s%05d' % (string.ascii_uppercase[i % 26], i // 26), 10
+			else:
+				code, version = '%04d' % i, 9
+			name = ', '.join(rng.choice(words) for words in PROCEDURE_WORDS)
+			self.procedures.append((code, version))
+			yield (code, version, name)
+
+	def admission_rows(self):
+		"""
+		Admissions spread over patients with Pareto weights, so a small
+		share of patients accounts for many of the admissions
+		"""
+		rng = self.rng
+		weights = list(accumulate(rng.paretovariate(1.2) for _ in range(self.patient_count)))
+		subjects = rng.choices(range(10000000, 10000000 + self.patient_count), cum_weights=weights, k=self.admission_count)
+		for i, subject_id in enumerate(subjects):
+			hadm_id = 20000000 + i
+			intime = random_time(rng, datetime(2110, 1, 1), datetime(2211, 12, 31))
+			outtime = intime + timedelta(hours=max(2, rng.expovariate(1 / 120.0))) if rng.random() > 0.03 else None
+			self.admissions.append((hadm_id, subject_id, intime, outtime or intime + timedelta(days=3)))
+			yield (hadm_id, subject_id, intime, outtime,
+				rng.choices(ADMISSION_TYPES, weights=ADMISSION_TYPE_WEIGHTS)[0],
+				rng.choice(ADMISSION_LOCATIONS),
+				rng.choice(DISCHARGE_LOCATIONS))
+
+	def diagnoses(self):
+		rng = self.rng
+		population = self.conditions[:]
+		rng.shuffle(population)
+		cum_weights = zipf_cum_weights(len(population))
+		for hadm_id, subject_id, intime, outtime in self.admissions:
+			codes = sample_distinct(rng, population, cum_weights, max(1, skewed_count(rng, DIAGNOSES_PER_ADMISSION)))
+			for rank, (code, version) in enumerate(codes, start=1):
+				self.patient_conditions.add((subject_id, code, version))
+				yield (hadm_id, code, version, subject_id, random_time(rng, intime, outtime).date(), rank)
+
+	def prescriptions(self):
+		rng = self.rng
+		population = self.medication_ids[:]
+		rng.shuffle(population)
+		cum_weights = zipf_cum_weights(len(population))
+		prescription_id = 1
+		for hadm_id, subject_id, intime, outtime in self.admissions:
+			count = skewed_count(rng, PRESCRIPTIONS_PER_ADMISSION)
+			for medication_id in rng.choices(population, cum_weights=cum_weights, k=count):
+				start = random_time(rng, intime, outtime)
+				end = start + timedelta(hours=rng.randint(1, 240)) if rng.random() > 0.1 else None
+				yield (prescription_id, subject_id, hadm_id, medication_id,
+					str(rng.choice([0.5, 1, 2, 5, 10, 25, 100])),
+					rng.choices(ROUTES, weights=ROUTE_WEIGHTS)[0],
+					rng.choice(FREQUENCIES), start, end)
+				prescription_id += 1
+
+	def procedures_performed(self):
+		rng = self.rng
+		population = self.procedures[:]
+		rng.shuffle(population)
+		cum_weights = zipf_cum_weights(len(population))
+		for hadm_id, subject_id, intime, outtime in self.admissions:
+			for code, version in sample_distinct(rng, population, cum_weights, skewed_count(rng, PROCEDURES_PER_ADMISSION)):
+				yield (hadm_id, code, version, subject_id, random_time(rng, intime, outtime).date())
+
+	def orders(self):
+		rng = self.rng
+		poe = 0
+		for hadm_id, subject_id, intime, outtime in self.admissions:
+			for _ in range(skewed_count(rng, ORDERS_PER_ADMISSION)):
+				poe += 1
+				yield ('%d-%d' % (subject_id, poe), hadm_id, subject_id,
+					rng.choice(self.provider_ids), rng.choice(ORDER_TYPES), random_time(rng, intime, outtime))
+
+	def images(self):
+		rng = self.rng
+		study_id = 50000000
+		for hadm_id, subject_id, intime, outtime in self.admissions:
+			for _ in range(skewed_count(rng, IMAGES_PER_ADMISSION)):
+				study_id += 1
+				yield ('%08x-%08x' % (study_id, rng.getrandbits(32)), subject_id, hadm_id, study_id,
+					rng.choice(VIEWPOINTS), random_time(rng, intime, outtime))
+
+	def patient_condition_rows(self):
+		return iter(sorted(self.patient_conditions))
+
+	def tables(self):
+		"""
+		(table, row iterator) pairs in foreign-key load order
+		"""
+		return [
+			('patient', self.patients),
+			('provider', self.providers),
+			('medication', self.medications),
+			('condition', self.condition_catalog),
+			('procedures', self.procedure_catalog),
+			('admission', self.admission_rows),
+			('admission_diagnosis', self.diagnoses),
+			('prescription', self.prescriptions),
+			('procedures_performed', self.procedures_performed),
+			('orders', self.orders),
+			('medical_images', self.images),
+			('patient_condition', self.patient_condition_rows)
+		]
+
+
+def copy_rows(cursor, table, rows, chunk_size):
+	"""
+	COPY rows into a table in chunks of `chunk_size`. Returns the row count.
+	"""
+	total = 0
+	buffer = io.StringIO()
+	writer = csv.writer(buffer)
+	pending = 0
+
+	def flush():
+		buffer.seek(0)
+		cursor.copy_expert(f"COPY wl2822.{table} FROM STDIN WITH (FORMAT csv)", buffer)
+		buffer.seek(0)
+		buffer.truncate()
+
+	for row in rows:
+		writer.writerow(row)
+		pending += 1
+		if pending == chunk_size:
+			flush()
+			total += pending
+			pending = 0
+	if pending:
+		flush()
+		total += pending
+	return total
+
+
+@click.command()
+@click.option('--database-uri', default=lambda: os.environ.get('DATABASEURI'), help='Target database (default: $DATABASEURI)')
+@click.option('--scale', default=1.0, type=float, help='Scale factor; 1 matches the course database')
+@click.option('--seed', default=4111, type=int, help='Random seed')
+@click.option('--create-schema', is_flag=True, help='Create the wl2822 tables if they do not exist')
+@click.option('--truncate', is_flag=True, help='Empty the tables before loading')
+@click.option('--chunk-size', default=50000, type=int, help='Rows per COPY chunk')
+def main(database_uri, scale, seed, create_schema, truncate, chunk_size):
+	"""
+	Generate synthetic data at SCALE and load it with COPY.
+	"""
+	if not database_uri:
+		raise click.UsageError('pass --database-uri or set DATABASEURI')
+
+	engine = create_engine(database_uri)
+	if create_schema or truncate:
+		with engine.begin() as conn:
+			if create_schema:
+				conn.execute(text(SCHEMA_DDL))
+			if truncate:
+				conn.execute(text("TRUNCATE " + ", ".join(f"wl2822.{table}" for table in TABLES) + " CASCADE"))
+
+	generator = Generator(scale, seed)
+	started = time.time()
+	raw = engine.raw_connection()
+	try:
+		cursor = raw.cursor()
+		for table, rows in generator.tables():
+			table_started = time.time()
+			count = copy_rows(cursor, table, rows(), chunk_size)
+			elapsed = time.time() - table_started
+			print("%-22s %10d rows  %7.1fs  %10.0f rows/s" % (table, count, elapsed, count / max(elapsed, 1e-9)))
+		cursor.execute("ANALYZE " + ", ".join(f"wl2822.{table}" for table in TABLES))
+		raw.commit()
+	finally:
+		raw.close()
+
+	print("loaded scale %g in %.1fs" % (scale, time.time() - started))
+	print("run `python server.py refresh-analytics` to rebuild the dashboard snapshot")
+
+
+if __name__ == "__main__":
+	main()
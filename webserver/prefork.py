@@ -0,0 +1,348 @@
+"""
+Prefork WSGI server for `python server.py serve`.
+
+The master binds the listening socket, forks the workers and keeps them
+running; it never serves requests itself. Each worker accepts connections
+on the shared socket and hands them to a fixed pool of threads, and only
+accepts the next one when a thread is free, so a busy worker leaves new
+connections to the others.
+
+Signals to the master:
+
+	TERM, INT   stop: the workers finish the requests in flight and exit
+	            (killed after the graceful timeout)
+	HUP         graceful restart: a new set of workers is started, then the
+	            old ones finish their requests and exit. Restarts come at
+	            most once per `restart_interval` seconds; HUPs received
+	            sooner are combined into one restart at the end of it.
+	QUIT        stop immediately
+
+A worker that has served `max_requests` requests (plus a random jitter, so
+the workers do not all recycle at once) finishes the ones in flight and
+exits, and the master starts a replacement.
+"""
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, get_sockaddr, select_address_family
+
+
+# A worker that dies sooner than this after starting is restarted only
+# after the same delay, so a worker that cannot start does not fork-loop
+MIN_WORKER_LIFETIME = 1.0
+
+
+def bind_socket(host, port, backlog=2048):
+	"""
+	The listening socket shared by every worker. It is non-blocking so the
+	workers that lose the race for a connection go back to waiting.
+	"""
+	family = select_address_family(host, port)
+	sock = socket.socket(family, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.bind(get_sockaddr(host, port, family))
+	sock.listen(backlog)
+	sock.setblocking(False)
+	return sock
+
+
+class PoolServer(BaseWSGIServer):
+	"""
+	Werkzeug's server on an inherited socket, serving connections with a
+	fixed pool of `threads` threads and HTTP/1.1 keep-alive. Stops by
+	itself after `max_requests` requests (0 for never).
+	"""
+	multithread = True
+	multiprocess = True
+
+	def __init__(self, app, sock, threads, max_requests=0, keepalive=5, log=print):
+		handler = type('KeepAliveRequestHandler', (WSGIRequestHandler,), {
+			'protocol_version': 'HTTP/1.1',
+			'timeout': keepalive
+		})
+		host, port = sock.getsockname()[:2]
+		super().__init__(host, port, self.counted(app), handler, fd=sock.fileno())
+		self.socket.setblocking(False)
+		self.threads = threads
+		self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+		self.slots = threading.Semaphore(threads)
+		self.handed_off = False
+		self.max_requests = max_requests
+		self.served = 0
+		self.stopping = False
+		self.lock = threading.Lock()
+		self.log_message = log
+
+	def counted(self, app):
+		"""
+		Wrap the app to count requests, and to close keep-alive connections
+		once the server is stopping
+		"""
+		def counted_app(environ, start_response):
+			self.record_request()
+
+			def close_when_stopping(status, headers, exc_info=None):
+				if self.stopping:
+					headers = [(key, value) for key, value in headers if key.lower() != 'connection']
+					headers.append(('Connection', 'close'))
+				return start_response(status, headers, exc_info)
+
+			return app(environ, close_when_stopping)
+		return counted_app
+
+	def record_request(self):
+		with self.lock:
+			self.served += 1
+			recycle = self.max_requests and self.served >= self.max_requests
+		if recycle:
+			self.stop(f"served {self.served} requests, recycling")
+
+	def stop(self, reason):
+		"""
+		Stop accepting connections; serve_forever() returns once the loop
+		notices. Safe to call from any thread but the serving one.
+		"""
+		with self.lock:
+			if self.stopping:
+				return
+			self.stopping = True
+		self.log_message(f"worker {os.getpid()}: {reason}")
+		threading.Thread(target=self.shutdown, name='shutdown', daemon=True).start()
+
+	def _handle_request_noblock(self):
+		# Wait for a free thread before accepting, so the connection goes to
+		# another worker when this one is busy
+		self.slots.acquire()
+		self.handed_off = False
+		try:
+			super()._handle_request_noblock()
+		finally:
+			if not self.handed_off:
+				self.slots.release()
+
+	def process_request(self, request, client_address):
+		self.handed_off = True
+		self.pool.submit(self.process_request_thread, request, client_address)
+
+	def process_request_thread(self, request, client_address):
+		try:
+			self.finish_request(request, client_address)
+		except Exception:
+			self.handle_error(request, client_address)
+		finally:
+			self.shutdown_request(request)
+			self.slots.release()
+
+	def drain(self):
+		"""
+		Wait for the requests in flight after the loop has stopped
+		"""
+		self.pool.shutdown(wait=True)
+
+
+class Master:
+	"""
+	Forks `workers` workers serving the app returned by load_app(worker)
+	(called in each worker after the fork) and keeps them running until
+	stopped. `warm()`, when given, runs in the master before the first
+	workers and before each graceful restart; `worker_stopped()` runs in a
+	worker once it has finished its last request, and `worker_exited(pid)`
+	in the master after a worker exits.
+	"""
+
+	def __init__(self, load_app, host, port, workers, threads, max_requests=0, max_requests_jitter=0,
+			graceful_timeout=30, keepalive=5, warm=None, log=print, restart_interval=0,
+			worker_stopped=None, worker_exited=None):
+		self.load_app = load_app
+		self.host = host
+		self.port = port
+		self.worker_count = max(1, workers)
+		self.threads = max(1, threads)
+		self.max_requests = max_requests
+		self.max_requests_jitter = max_requests_jitter
+		self.graceful_timeout = graceful_timeout
+		self.keepalive = keepalive
+		self.warm = warm
+		self.log = log
+		self.restart_interval = restart_interval
+		self.worker_stopped = worker_stopped
+		self.worker_exited = worker_exited
+		self.restart_pending = False
+		self.restarted_at = None
+		self.socket = None
+		self.generation = 0
+		self.workers = {}            # pid -> (worker index, generation, started)
+		self.stopping = {}           # pid -> kill deadline
+		self.respawn_after = {}      # worker index -> earliest restart
+		self.signals = []
+
+	def run(self):
+		self.socket = bind_socket(self.host, self.port)
+		if self.warm:
+			self.warm()
+		wakeup_read, wakeup_write = os.pipe()
+		os.set_blocking(wakeup_read, False)
+		os.set_blocking(wakeup_write, False)
+		signal.set_wakeup_fd(wakeup_write)
+		for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT, signal.SIGCHLD):
+			signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+
+		self.log(f"master {os.getpid()}: {self.worker_count} worker(s) x {self.threads} thread(s) on {self.host}:{self.port}")
+		try:
+			while True:
+				self.reap()
+				while self.signals:
+					signum = self.signals.pop(0)
+					if signum in (signal.SIGTERM, signal.SIGINT):
+						self.log(f"master {os.getpid()}: stopping")
+						self.shutdown(graceful=True)
+						return
+					if signum == signal.SIGQUIT:
+						self.shutdown(graceful=False)
+						return
+					if signum == signal.SIGHUP:
+						self.restart_pending = True
+				if self.restart_pending and (self.restarted_at is None
+						or time.monotonic() - self.restarted_at >= self.restart_interval):
+					self.restart()
+				self.spawn_missing()
+				self.kill_overdue()
+				select.select([wakeup_read], [], [], 1.0)
+				try:
+					while os.read(wakeup_read, 4096):
+						pass
+				except BlockingIOError:
+					pass
+		finally:
+			signal.set_wakeup_fd(-1)
+			os.close(wakeup_read)
+			os.close(wakeup_write)
+			self.socket.close()
+
+	def restart(self):
+		"""
+		Start a new generation of workers, then stop the current one
+		"""
+		self.log(f"master {os.getpid()}: graceful restart")
+		self.restart_pending = False
+		self.restarted_at = time.monotonic()
+		if self.warm:
+			try:
+				self.warm()
+			except Exception:
+				traceback.print_exc()
+		old = [pid for pid, (_, generation, _) in self.workers.items() if generation == self.generation]
+		self.generation += 1
+		self.respawn_after.clear()
+		self.spawn_missing()
+		for pid in old:
+			self.terminate(pid)
+
+	def spawn_missing(self):
+		running = {index for index, generation, _ in self.workers.values() if generation == self.generation}
+		now = time.monotonic()
+		for index in range(self.worker_count):
+			if index not in running and self.respawn_after.get(index, 0) <= now:
+				self.spawn(index)
+
+	def spawn(self, index):
+		pid = os.fork()
+		if pid:
+			self.workers[pid] = (index, self.generation, time.monotonic())
+			return
+		status = 1
+		try:
+			self.run_worker(index)
+			status = 0
+		except BaseException:
+			traceback.print_exc()
+		finally:
+			sys.stdout.flush()
+			sys.stderr.flush()
+			os._exit(status)
+
+	def run_worker(self, index):
+		signal.set_wakeup_fd(-1)
+		for signum in (signal.SIGHUP, signal.SIGCHLD):
+			signal.signal(signum, signal.SIG_DFL)
+		# Ctrl-C reaches the whole process group; the master decides
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		signal.signal(signal.SIGQUIT, lambda signum, frame: os._exit(1))
+		random.seed()
+
+		max_requests = self.max_requests
+		if max_requests and self.max_requests_jitter:
+			max_requests += random.randint(0, self.max_requests_jitter)
+		server = PoolServer(self.load_app(index), self.socket, self.threads, max_requests, self.keepalive, self.log)
+		signal.signal(signal.SIGTERM, lambda signum, frame: server.stop("stopping"))
+		self.log(f"worker {os.getpid()}: serving as worker {index}")
+		server.serve_forever()
+		server.drain()
+		if self.worker_stopped:
+			self.worker_stopped()
+
+	def reap(self):
+		while True:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except ChildProcessError:
+				return
+			if not pid:
+				return
+			self.stopping.pop(pid, None)
+			worker = self.workers.pop(pid, None)
+			if worker is None:
+				continue
+			if self.worker_exited:
+				try:
+					self.worker_exited(pid)
+				except Exception:
+					traceback.print_exc()
+			index, generation, started = worker
+			if generation == self.generation:
+				code = os.waitstatus_to_exitcode(status)
+				if code != 0:
+					self.log(f"master {os.getpid()}: worker {index} ({pid}) exited with {code}")
+				if time.monotonic() - started < MIN_WORKER_LIFETIME:
+					self.respawn_after[index] = time.monotonic() + MIN_WORKER_LIFETIME
+
+	def terminate(self, pid):
+		try:
+			os.kill(pid, signal.SIGTERM)
+		except ProcessLookupError:
+			return
+		self.stopping[pid] = time.monotonic() + self.graceful_timeout
+
+	def kill_overdue(self):
+		now = time.monotonic()
+		for pid, deadline in list(self.stopping.items()):
+			if deadline <= now:
+				self.log(f"master {os.getpid()}: worker {pid} did not stop in {self.graceful_timeout}s, killing it")
+				try:
+					os.kill(pid, signal.SIGKILL)
+				except ProcessLookupError:
+					pass
+				self.stopping[pid] = now + self.graceful_timeout
+
+	def shutdown(self, graceful):
+		for pid in list(self.workers):
+			if graceful:
+				self.terminate(pid)
+			else:
+				try:
+					os.kill(pid, signal.SIGKILL)
+				except ProcessLookupError:
+					pass
+		while self.workers:
+			self.reap()
+			if graceful:
+				self.kill_overdue()
+			time.sleep(0.1)
@@ -9,10 +9,36 @@ A debugger such as "pdb" may be helpful for debugging.
 Read about it online.
 """
 import os
+import base64
+import csv
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import logging
+import pickle
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from functools import lru_cache, wraps
 # accessible as a variable in index.html:
 from sqlalchemy import *
+from sqlalchemy.engine import IteratorResult
+from sqlalchemy.engine.result import SimpleResultMetaData
 from sqlalchemy.pool import NullPool
-from flask import Flask, request, render_template, g, redirect, Response, abort
+from flask import Flask, request, render_template, g, redirect, Response, abort, jsonify, url_for, stream_with_context, make_response, stream_template
+from flask import has_request_context, before_render_template, template_rendered
 
 tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 app = Flask(__name__, template_folder=tmpl_dir)
@@ -33,13 +59,207 @@ app = Flask(__name__, template_folder=tmpl_dir)
 DATABASE_USERNAME = "wl2822"
 DATABASE_PASSWRD = "234471"
 DATABASE_HOST = "34.139.8.30"
-DATABASEURI = f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWRD}@{DATABASE_HOST}/proj1part2"
+DATABASEURI = os.environ.get('DATABASEURI', f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWRD}@{DATABASE_HOST}/proj1part2")
+
+
+def env_int(name, default):
+	"""
+	Read an integer setting from the environment
+	"""
+	value = os.environ.get(name)
+	return int(value) if value not in (None, '') else default
+
+
+def env_float(name, default):
+	"""
+	Read a float setting from the environment
+	"""
+	value = os.environ.get(name)
+	return float(value) if value not in (None, '') else default
+
+
+def env_flag(name, default):
+	"""
+	Read a boolean setting from the environment (1/true/yes/on)
+	"""
+	value = os.environ.get(name)
+	if value in (None, ''):
+		return default
+	return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+#
+# Connection pool settings. Each one can be overridden with an environment
+# variable so the pool can be tuned to the worker count of a deployment:
+#
+#     DB_POOL_SIZE          connections kept open in the pool
+#     DB_POOL_MAX_OVERFLOW  extra connections allowed above DB_POOL_SIZE
+#     DB_POOL_RECYCLE       seconds before a connection is replaced
+#     DB_POOL_PRE_PING      test connections before handing them out
+#     DB_POOL_TIMEOUT       seconds to wait for a free connection
+#     DB_CONNECT_TIMEOUT    seconds to wait for a new connection before
+#                           giving up on the database host
+#     DB_STATEMENT_TIMEOUT_MS  server-side limit on each statement the web
+#                           server runs (0 none); maintenance commands such
+#                           as ingest run without it
+#
+POOL_SIZE = env_int('DB_POOL_SIZE', 5)
+POOL_MAX_OVERFLOW = env_int('DB_POOL_MAX_OVERFLOW', 10)
+POOL_RECYCLE = env_int('DB_POOL_RECYCLE', 1800)
+POOL_PRE_PING = env_flag('DB_POOL_PRE_PING', True)
+POOL_TIMEOUT = env_float('DB_POOL_TIMEOUT', 30)
+DB_CONNECT_TIMEOUT = env_int('DB_CONNECT_TIMEOUT', 3)
+DB_STATEMENT_TIMEOUT_MS = env_int('DB_STATEMENT_TIMEOUT_MS', 30000)
 
 
 #
 # This line creates a database engine that knows how to connect to the URI above.
+# Connections are kept in a pool and reused across requests, so only a cold
+# pool pays the TCP and authentication handshake with the database host.
 #
-engine = create_engine(DATABASEURI)
+engine = create_engine(DATABASEURI,
+	pool_size=POOL_SIZE,
+	max_overflow=POOL_MAX_OVERFLOW,
+	pool_recycle=POOL_RECYCLE,
+	pool_pre_ping=POOL_PRE_PING,
+	pool_timeout=POOL_TIMEOUT,
+	connect_args={'connect_timeout': DB_CONNECT_TIMEOUT})
+
+
+@event.listens_for(engine, 'do_connect')
+def apply_statement_timeout(dialect, connection_record, cargs, cparams):
+	"""
+	Start new connections with DB_STATEMENT_TIMEOUT_MS, read at connect time
+	so maintenance commands can lift it
+	"""
+	if DB_STATEMENT_TIMEOUT_MS > 0:
+		cparams['options'] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+
+
+class PoolMetrics:
+	"""
+	Counters for connection checkouts and newly opened connections,
+	used to tune pool size against worker counts under load
+	"""
+
+	def __init__(self, window=60):
+		self.lock = threading.Lock()
+		self.window = window
+		self.started = time.time()
+		self.checkouts = 0
+		self.total_wait = 0.0
+		self.max_wait = 0.0
+		self.connects = 0
+		self.recent_connects = deque()
+
+	def record_checkout(self, wait):
+		with self.lock:
+			self.checkouts += 1
+			self.total_wait += wait
+			self.max_wait = max(self.max_wait, wait)
+
+	def record_connect(self):
+		now = time.time()
+		with self.lock:
+			self.connects += 1
+			self.recent_connects.append(now)
+			self._trim(now)
+
+	def _trim(self, now):
+		while self.recent_connects and self.recent_connects[0] < now - self.window:
+			self.recent_connects.popleft()
+
+	def snapshot(self, pool):
+		now = time.time()
+		with self.lock:
+			self._trim(now)
+			checkouts = self.checkouts
+			return {
+				'pool_size': pool.size(),
+				'checked_in': pool.checkedin(),
+				'checked_out': pool.checkedout(),
+				'overflow': max(pool.overflow(), 0),
+				'checkouts': checkouts,
+				'avg_wait_ms': round(self.total_wait / checkouts * 1000, 3) if checkouts else 0.0,
+				'max_wait_ms': round(self.max_wait * 1000, 3),
+				'connects': self.connects,
+				'connects_per_second': round(len(self.recent_connects) / min(self.window, max(now - self.started, 1)), 3),
+				'uptime_seconds': round(now - self.started, 1)
+			}
+
+
+pool_metrics = PoolMetrics()
+
+
+@event.listens_for(engine, 'connect')
+def on_pool_connect(dbapi_connection, connection_record):
+	pool_metrics.record_connect()
+
+
+class LazyConnection:
+	"""
+	Stand-in for g.conn that only checks a connection out of the pool the
+	first time a route actually runs SQL, so requests such as /login and
+	/add never hold a database connection
+	"""
+
+	def __init__(self, engine):
+		self._engine = engine
+		self._conn = None
+
+	@property
+	def checked_out(self):
+		return self._conn is not None
+
+	@property
+	def engine(self):
+		return self._engine
+
+	def _connect(self):
+		if self._conn is None:
+			started = time.perf_counter()
+			try:
+				self._conn = connect_primary() if self._engine is engine else self._engine.connect()
+			except exc.OperationalError as e:
+				# An unreachable replica: carry on on the primary
+				if self._engine is engine or replicas is None:
+					raise
+				replicas.mark_failed(self._engine, e)
+				replica_fallbacks.inc((replicas.name_of(self._engine),))
+				self._engine = engine
+				self._conn = connect_primary()
+			pool_metrics.record_checkout(time.perf_counter() - started)
+		return self._conn
+
+	def __getattr__(self, name):
+		return getattr(self._connect(), name)
+
+	def execute(self, statement, parameters=None, **kwargs):
+		"""
+		Connection.execute(), answered from the result cache when the
+		statement is a read the current route caches
+		"""
+		if result_cache is not None and not kwargs:
+			return result_cache.execute(self._connect, statement, parameters)
+		return self._connect().execute(statement, parameters, **kwargs)
+
+	def cancel(self):
+		"""
+		Cancel the statement running on the connection, if there is one
+		"""
+		conn = self._conn
+		if conn is not None:
+			conn.connection.dbapi_connection.cancel()
+
+	def rollback(self):
+		# Nothing to roll back before the first statement
+		if self._conn is not None:
+			self._conn.rollback()
+
+	def close(self):
+		if self._conn is not None:
+			conn, self._conn = self._conn, None
+			conn.close()
 
 #
 # Example of running queries in your database
@@ -68,21 +288,20 @@ def before_request():
 	This function is run at the beginning of every web request 
 	(every time you enter an address in the web browser).
 	We use it to setup a database connection that can be used throughout the request.
+	The connection is only checked out of the pool once a route runs SQL on it.
 
 	The variable g is globally accessible.
 	"""
-	try:
-		g.conn = engine.connect()
-	except:
-		print("uh oh, problem connecting to database")
-		import traceback; traceback.print_exc()
-		g.conn = None
+	g.conn = LazyConnection(route_engine())
+	if replicas is not None:
+		routed_requests.inc((replicas.name_of(g.conn.engine),))
 
 @app.teardown_request
 def teardown_request(exception):
 	"""
 	At the end of the web request, this makes sure to close the database connection.
 	If you don't, the database could run out of memory!
+	Closing returns the connection to the pool if one was checked out.
 	"""
 	try:
 		g.conn.close()
@@ -90,738 +309,5538 @@ def teardown_request(exception):
 		pass
 
 
+@app.route('/pool_stats')
+def pool_stats():
+	"""
+	Connection pool statistics as JSON (checked out, overflow, wait time,
+	connects per second)
+	"""
+	return jsonify(pool_metrics.snapshot(engine.pool))
+
+
+# ==========================================
+# INSTRUMENTATION
+# ==========================================
+
 #
-# @app.route is a decorator around index() that means:
-#   run index() whenever the user tries to access the "/" path using a GET request
-#
-# If you wanted the user to go to, for example, localhost:8111/foobar/ with POST or GET then you could use:
+# Per-route request latency, SQL statement counts, rows fetched, and time
+# spent in the database versus template rendering, exposed at /metrics in
+# the Prometheus text format.
 #
-#       @app.route("/foobar/", methods=["POST", "GET"])
+# Statements slower than SLOW_QUERY_THRESHOLD_MS (0 disables) go to the
+# "server.slow_query" log with their bound parameters; with
+# SLOW_QUERY_EXPLAIN set, an EXPLAIN (ANALYZE, BUFFERS) of the statement is
+# logged as well, run in the background on a separate connection.
 #
-# PROTIP: (the trailing / in the path is important)
-# 
-# see for routing: https://flask.palletsprojects.com/en/1.1.x/quickstart/#routing
-# see for decorators: http://simeonfranklin.com/blog/2012/jul/1/python-decorators-in-12-steps/
+# Under `serve` each worker process counts its own requests, so the workers
+# share their metrics through a directory: every METRICS_FLUSH_INTERVAL
+# seconds, and when it stops, a worker writes a snapshot of its metrics
+# there, and /metrics adds up the snapshots of all of them, whichever
+# worker answers. The master folds the snapshot of a worker that exited
+# into one file of retired counts, so counters never go backwards when
+# workers are replaced. Gauges are combined over the live workers only.
 #
-@app.route('/')
-def index():
+SLOW_QUERY_THRESHOLD_MS = env_float('SLOW_QUERY_THRESHOLD_MS', 500)
+SLOW_QUERY_EXPLAIN = env_flag('SLOW_QUERY_EXPLAIN', False)
+METRICS_FLUSH_INTERVAL = env_float('METRICS_FLUSH_INTERVAL', 1.0)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+slow_query_log = logging.getLogger('server.slow_query')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def format_labels(names, values):
+	if not names:
+		return ''
+	pairs = ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+		for name, value in zip(names, values))
+	return '{' + pairs + '}'
+
+
+class Counter:
 	"""
-	Home page with database statistics
+	Prometheus counter with labels
 	"""
-	# Get statistics from database
-	try:
-		patient_count = g.conn.execute(text('SELECT COUNT(*) FROM wl2822.patient')).scalar()
-		admission_count = g.conn.execute(text('SELECT COUNT(*) FROM wl2822.admission')).scalar()
-		prescription_count = g.conn.execute(text('SELECT COUNT(*) FROM wl2822.prescription')).scalar()
-		image_count = g.conn.execute(text('SELECT COUNT(*) FROM wl2822.medical_images')).scalar()
 
-		stats = {
-			'patient_count': patient_count,
-			'admission_count': admission_count,
-			'prescription_count': prescription_count,
-			'image_count': image_count
-		}
-	except Exception as e:
-		print(f"Error getting stats: {e}")
-		stats = {
-			'patient_count': 0,
-			'admission_count': 0,
-			'prescription_count': 0,
-			'image_count': 0
-		}
+	kind = 'counter'
 
-	return render_template("home.html", stats=stats)
+	def __init__(self, name, help_text, labels=()):
+		self.name = name
+		self.help_text = help_text
+		self.labels = labels
+		self.lock = threading.Lock()
+		self.values = {}
 
-# ==========================================
-# PATIENT ROUTES
-# ==========================================
+	def inc(self, label_values=(), amount=1):
+		with self.lock:
+			self.values[label_values] = self.values.get(label_values, 0) + amount
 
-@app.route('/patients')
-def patients():
+	def snapshot(self):
+		with self.lock:
+			return dict(self.values)
+
+	def merge(self, snapshots):
+		merged = {}
+		for values in snapshots:
+			for label_values, value in values.items():
+				merged[label_values] = merged.get(label_values, 0) + value
+		return merged
+
+	def expose(self, values=None):
+		items = sorted((self.snapshot() if values is None else values).items())
+		for label_values, value in items:
+			yield '%s%s %s' % (self.name, format_labels(self.labels, label_values), value)
+
+
+class Histogram:
 	"""
-	Patient list with search/filter functionality
+	Prometheus histogram with labels and fixed buckets
 	"""
-	# Get filter parameters from URL
-	subject_id = request.args.get('subject_id', type=int)
-	sex = request.args.get('sex', '')
-	race = request.args.get('race', '')
-	min_age = request.args.get('min_age', type=int)
-	max_age = request.args.get('max_age', type=int)
 
-	# Build query with filters
-	query = text("""
-		SELECT
-			p.subject_id,
-			p.sex,
-			p.date_of_birth,
-			p.race,
-			2110 - EXTRACT(YEAR FROM p.date_of_birth) as age,
-			COUNT(a.hadm_id) as admission_count
-		FROM wl2822.patient p
-		LEFT JOIN wl2822.admission a ON p.subject_id = a.subject_id
-		WHERE (:subject_id IS NULL OR p.subject_id = :subject_id)
-			AND (:sex = '' OR p.sex = :sex)
-			AND (:race = '' OR p.race = :race)
-		GROUP BY p.subject_id, p.sex, p.date_of_birth, p.race
-		HAVING (:min_age IS NULL OR 2110 - EXTRACT(YEAR FROM p.date_of_birth) >= :min_age)
-			AND (:max_age IS NULL OR 2110 - EXTRACT(YEAR FROM p.date_of_birth) <= :max_age)
-		ORDER BY p.subject_id
-		LIMIT 100
-	""")
+	kind = 'histogram'
 
-	try:
-		result = g.conn.execute(query, {
-			'subject_id': subject_id,
-			'sex': sex,
-			'race': race,
-			'min_age': min_age,
-			'max_age': max_age
-		})
-		patients = result.fetchall()
-	except Exception as e:
-		print(f"Error fetching patients: {e}")
-		patients = []
+	def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+		self.name = name
+		self.help_text = help_text
+		self.labels = labels
+		self.buckets = buckets
+		self.lock = threading.Lock()
+		self.values = {}
 
-	return render_template("patients.html", patients=patients)
+	def observe(self, label_values, value):
+		with self.lock:
+			state = self.values.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					state[0][i] += 1
+			state[1] += value
+			state[2] += 1
 
+	def snapshot(self):
+		with self.lock:
+			return {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
 
-@app.route('/patient/<int:subject_id>')
-def patient_detail(subject_id):
+	def merge(self, snapshots):
+		merged = {}
+		for values in snapshots:
+			for key, (counts, total, count) in values.items():
+				if key in merged:
+					merged_counts, merged_total, merged_count = merged[key]
+					merged[key] = ([a + b for a, b in zip(merged_counts, counts)], merged_total + total, merged_count + count)
+				else:
+					merged[key] = (list(counts), total, count)
+		return merged
+
+	def expose(self, values=None):
+		items = sorted((self.snapshot() if values is None else values).items())
+		names = self.labels + ('le',)
+		for label_values, (counts, total, count) in items:
+			for bound, bucket_count in zip(self.buckets, counts):
+				yield '%s_bucket%s %d' % (self.name, format_labels(names, label_values + (bound,)), bucket_count)
+			yield '%s_bucket%s %d' % (self.name, format_labels(names, label_values + ('+Inf',)), count)
+			yield '%s_sum%s %s' % (self.name, format_labels(self.labels, label_values), total)
+			yield '%s_count%s %d' % (self.name, format_labels(self.labels, label_values), count)
+
+
+class Gauge:
 	"""
-	Patient detail page with complete medical timeline
-	SHOWCASE PAGE - Complex multi-table JOINs
+	Prometheus gauge whose value is read from a callback at scrape time.
+	The values of several workers are combined with `combine` (summed by
+	default).
 	"""
-	try:
-		# 1. Get patient basic info
-		patient_query = text("SELECT * FROM wl2822.patient WHERE subject_id = :subject_id")
-		patient_result = g.conn.execute(patient_query, {'subject_id': subject_id})
-		patient = patient_result.fetchone()
 
-		if not patient:
-			return "Patient not found", 404
+	kind = 'gauge'
 
-		# 2. Get all admissions for this patient (chronological)
-		admissions_query = text("""
-			SELECT * FROM wl2822.admission
-			WHERE subject_id = :subject_id
-			ORDER BY admission_intime DESC
-		""")
-		admissions_result = g.conn.execute(admissions_query, {'subject_id': subject_id})
-		admissions = admissions_result.fetchall()
-
-		# 3. For each admission, get detailed information
-		admission_details = []
-		for admission in admissions:
-			hadm_id = admission.hadm_id
-
-			# Get diagnoses with condition names
-			diagnoses_query = text("""
-				SELECT ad.*, c.condition_name
-				FROM wl2822.admission_diagnosis ad
-				JOIN wl2822.condition c
-					ON ad.icd_code = c.icd_code
-					AND ad.icd_version = c.icd_version
-				WHERE ad.hadm_id = :hadm_id
-				ORDER BY ad.rank
-			""")
-			diagnoses = g.conn.execute(diagnoses_query, {'hadm_id': hadm_id}).fetchall()
-
-			# Get prescriptions with medication details
-			prescriptions_query = text("""
-				SELECT p.*, m.name as medication_name, m.strength, m.form
-				FROM wl2822.prescription p
-				JOIN wl2822.medication m ON p.medication_id = m.medication_id
-				WHERE p.hadm_id = :hadm_id
-				ORDER BY p.start_time
-				LIMIT 20
-			""")
-			prescriptions = g.conn.execute(prescriptions_query, {'hadm_id': hadm_id}).fetchall()
-
-			# Get procedures with procedure names
-			procedures_query = text("""
-				SELECT pp.*, pr.procedure_name
-				FROM wl2822.procedures_performed pp
-				JOIN wl2822.procedures pr
-					ON pp.icd_code = pr.icd_code
-					AND pp.icd_version = pr.icd_version
-				WHERE pp.hadm_id = :hadm_id
-				ORDER BY pp.procedure_date
-			""")
-			procedures = g.conn.execute(procedures_query, {'hadm_id': hadm_id}).fetchall()
-
-			# Get medical images
-			images_query = text("""
-				SELECT * FROM wl2822.medical_images
-				WHERE hadm_id = :hadm_id
-				ORDER BY acquisition_date
-			""")
-			images = g.conn.execute(images_query, {'hadm_id': hadm_id}).fetchall()
-
-			# Get orders
-			orders_query = text("""
-				SELECT * FROM wl2822.orders
-				WHERE hadm_id = :hadm_id
-				ORDER BY order_time
-				LIMIT 20
-			""")
-			orders = g.conn.execute(orders_query, {'hadm_id': hadm_id}).fetchall()
-
-			# Compile all data for this admission
-			admission_details.append({
-				'admission': admission,
-				'diagnoses': diagnoses,
-				'prescriptions': prescriptions,
-				'procedures': procedures,
-				'images': images,
-				'orders': orders
-			})
+	def __init__(self, name, help_text, read, combine=sum):
+		self.name = name
+		self.help_text = help_text
+		self.read = read
+		self.combine = combine
 
-		# Calculate patient age
-		from datetime import date
-		if patient.date_of_birth:
-			today = date.today()
-			age = today.year - patient.date_of_birth.year - ((today.month, today.day) < (patient.date_of_birth.month, patient.date_of_birth.day))
+	def snapshot(self):
+		return self.read()
+
+	def merge(self, snapshots):
+		return self.combine(snapshots)
+
+	def expose(self, value=None):
+		yield '%s %s' % (self.name, self.read() if value is None else value)
+
+
+class MetricsRegistry:
+	"""
+	The metrics served at /metrics, shared with the other `serve` workers
+	through `directory` once share() is called
+	"""
+
+	RETIRED = 'retired.pickle'
+
+	def __init__(self):
+		self.metrics = []
+		self.directory = None
+
+	def register(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def snapshot(self):
+		return {metric.name: metric.snapshot() for metric in self.metrics}
+
+	def share(self, directory, interval=METRICS_FLUSH_INTERVAL):
+		"""
+		Write this process' snapshot to `directory` every `interval` seconds
+		"""
+		self.directory = directory
+
+		def flush_periodically():
+			while True:
+				time.sleep(interval)
+				try:
+					self.flush()
+				except Exception as e:
+					print(f"Error writing metrics: {e}")
+
+		threading.Thread(target=flush_periodically, name='metrics-flush', daemon=True).start()
+
+	def flush(self):
+		if self.directory is None:
+			return
+		path = os.path.join(self.directory, f'{os.getpid()}.pickle')
+		with open(path + '.tmp', 'wb') as f:
+			pickle.dump(self.snapshot(), f, pickle.HIGHEST_PROTOCOL)
+		os.replace(path + '.tmp', path)
+
+	def read(self, name):
+		try:
+			with open(os.path.join(self.directory, name), 'rb') as f:
+				return pickle.load(f)
+		except (OSError, EOFError, pickle.UnpicklingError):
+			return {}
+
+	def retire(self, pid):
+		"""
+		Fold the snapshot of the exited worker `pid` into the retired counts;
+		run by the master
+		"""
+		if self.directory is None:
+			return
+		exited = self.read(f'{pid}.pickle')
+		if exited:
+			retired = self.read(self.RETIRED)
+			for metric in self.metrics:
+				if metric.kind != 'gauge' and metric.name in exited:
+					retired[metric.name] = metric.merge([retired.get(metric.name, {}), exited[metric.name]])
+			path = os.path.join(self.directory, self.RETIRED)
+			with open(path + '.tmp', 'wb') as f:
+				pickle.dump(retired, f, pickle.HIGHEST_PROTOCOL)
+			os.replace(path + '.tmp', path)
+		for name in (f'{pid}.pickle', f'{pid}.pickle.tmp'):
+			try:
+				os.remove(os.path.join(self.directory, name))
+			except FileNotFoundError:
+				pass
+
+	def collect(self):
+		"""
+		The snapshots of this process and of the other workers, live ones
+		first, and the retired counts
+		"""
+		own = self.snapshot()
+		if self.directory is None:
+			return [own], None
+		own_name = f'{os.getpid()}.pickle'
+		live = [own] + [self.read(name) for name in sorted(os.listdir(self.directory))
+			if name.endswith('.pickle') and name not in (own_name, self.RETIRED)]
+		return live, self.read(self.RETIRED)
+
+	def expose(self):
+		live, retired = self.collect()
+		lines = []
+		for metric in self.metrics:
+			lines.append('# HELP %s %s' % (metric.name, metric.help_text))
+			lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+			snapshots = [snapshot[metric.name] for snapshot in live if metric.name in snapshot]
+			if retired and metric.kind != 'gauge' and metric.name in retired:
+				snapshots.append(retired[metric.name])
+			lines.extend(metric.expose(metric.merge(snapshots) if len(snapshots) > 1 else None))
+		lines.append('# HELP metrics_processes Worker processes these metrics add up')
+		lines.append('# TYPE metrics_processes gauge')
+		lines.append('metrics_processes %d' % len(live))
+		return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+request_latency = metrics.register(Histogram('http_request_duration_seconds',
+	'Request latency by route', ('route', 'method')))
+requests_total = metrics.register(Counter('http_requests_total',
+	'Requests by route and status code', ('route', 'method', 'status')))
+request_statements = metrics.register(Histogram('db_statements_per_request',
+	'SQL statements executed per request', ('route',), buckets=COUNT_BUCKETS))
+db_time = metrics.register(Histogram('db_time_seconds',
+	'Time per request spent executing SQL', ('route',)))
+template_time = metrics.register(Histogram('template_render_seconds',
+	'Time per request spent rendering templates', ('route',)))
+statements_total = metrics.register(Counter('db_statements_total',
+	'SQL statements executed', ('route',)))
+rows_total = metrics.register(Counter('db_rows_fetched_total',
+	'Rows returned by SQL statements', ('route',)))
+slow_queries_total = metrics.register(Counter('db_slow_queries_total',
+	'Statements slower than SLOW_QUERY_THRESHOLD_MS', ('route',)))
+for stat in ('checked_out', 'overflow', 'checked_in'):
+	metrics.register(Gauge('db_pool_' + stat, f'Connection pool {stat.replace("_", " ")} connections',
+		lambda stat=stat: pool_metrics.snapshot(engine.pool)[stat]))
+metrics.register(Gauge('db_pool_connects_total', 'Database connections opened',
+	lambda: pool_metrics.connects))
+metrics.register(Gauge('db_pool_checkout_wait_seconds_max', 'Longest pool checkout wait',
+	lambda: pool_metrics.max_wait, combine=max))
+
+
+# Route, RequestMetrics and result cache salt of the request a parallel
+# query worker is serving
+query_context = threading.local()
+
+
+def current_route():
+	"""
+	Route name used as the metrics label for work done by this thread
+	"""
+	if has_request_context():
+		return request.endpoint or 'unmatched'
+	return getattr(query_context, 'route', None) or 'background'
+
+
+class RequestMetrics:
+	"""
+	What one request spent, accumulated by the engine and template hooks
+	"""
+
+	def __init__(self):
+		self.started = time.perf_counter()
+		self.statements = 0
+		self.db_seconds = 0.0
+		self.template_seconds = 0.0
+		self.template_started = None
+		# Results served past their TTL because the database failed
+		self.stale_results = 0
+		# Parallel query workers record into the same object
+		self.lock = threading.Lock()
+
+
+def request_metrics():
+	if has_request_context():
+		return g.get('request_metrics')
+	return getattr(query_context, 'stats', None)
+
+
+@app.before_request
+def start_request_metrics():
+	g.request_metrics = RequestMetrics()
+
+
+@app.after_request
+def record_request_metrics(response):
+	stats = g.get('request_metrics')
+	if stats is not None:
+		route, method = current_route(), request.method
+
+		def record():
+			request_latency.observe((route, method), time.perf_counter() - stats.started)
+			requests_total.inc((route, method, str(response.status_code)))
+			request_statements.observe((route,), stats.statements)
+			db_time.observe((route,), stats.db_seconds)
+			template_time.observe((route,), stats.template_seconds)
+
+		# A streamed body runs after this hook; it is counted once it is sent
+		if response.is_streamed:
+			response.call_on_close(record)
 		else:
-			age = None
+			record()
+	return response
 
-		return render_template("patient_detail.html",
-			patient=patient,
-			age=age,
-			admission_details=admission_details,
-			total_admissions=len(admissions))
 
-	except Exception as e:
-		print(f"Error fetching patient details: {e}")
-		import traceback
-		traceback.print_exc()
-		return f"Error loading patient: {str(e)}", 500
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+	stats = request_metrics()
+	if stats is not None:
+		stats.template_started = time.perf_counter()
 
 
-# ==========================================
-# CONDITION ROUTES
-# ==========================================
+@template_rendered.connect_via(app)
+def stop_template_timer(sender, template, context, **extra):
+	stats = request_metrics()
+	if stats is not None and stats.template_started is not None:
+		stats.template_seconds += time.perf_counter() - stats.template_started
+		stats.template_started = None
 
-@app.route('/conditions')
-def conditions():
+
+explain_state = threading.local()
+explain_slots = threading.Semaphore(1)
+
+# (route, statement, parameters) of every statement run while the index
+# advisor is capturing; None otherwise
+captured_statements = None
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+	conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+
+@event.listens_for(engine, 'handle_error')
+def discard_statement_timer(context):
+	# A failed or cancelled statement never reaches after_cursor_execute
+	if context.execution_context is not None and context.connection is not None:
+		started = context.connection.info.get('statement_started')
+		if started:
+			started.pop()
+
+
+@event.listens_for(engine, 'after_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+	elapsed = time.perf_counter() - conn.info['statement_started'].pop()
+	if getattr(explain_state, 'active', False):
+		return
+
+	route = current_route()
+	statements_total.inc((route,))
+	if captured_statements is not None:
+		captured_statements.append((route, statement, parameters))
+	if cursor.rowcount is not None and cursor.rowcount > 0:
+		rows_total.inc((route,), cursor.rowcount)
+	stats = request_metrics()
+	if stats is not None:
+		with stats.lock:
+			stats.statements += 1
+			stats.db_seconds += elapsed
+
+	if SLOW_QUERY_THRESHOLD_MS > 0 and elapsed * 1000 >= SLOW_QUERY_THRESHOLD_MS:
+		slow_queries_total.inc((route,))
+		log_slow_query(route, statement, parameters, elapsed, conn.engine)
+
+
+def log_slow_query(route, statement, parameters, elapsed, statement_engine=None):
 	"""
-	Condition analytics browser - SHOWCASE PAGE
-	Displays conditions with patient counts and diagnosis statistics
+	Log a slow statement, and in the background its EXPLAIN (ANALYZE,
+	BUFFERS) plan when SLOW_QUERY_EXPLAIN is set
 	"""
-	search = request.args.get('search', '')
+	slow_query_log.warning("%.1f ms in %s: %s -- parameters: %r",
+		elapsed * 1000, route, ' '.join(statement.split()), parameters)
 
-	# Complex analytics query with JOINs and aggregations
-	query = text("""
-		SELECT
-			c.icd_code,
-			c.icd_version,
-			c.condition_name,
-			COUNT(DISTINCT ad.subject_id) as patient_count,
-			COUNT(ad.hadm_id) as diagnosis_count,
-			MIN(ad.diagnosed_on) as first_diagnosis,
-			MAX(ad.diagnosed_on) as latest_diagnosis
-		FROM wl2822.condition c
-		LEFT JOIN wl2822.admission_diagnosis ad
-			ON c.icd_code = ad.icd_code
-			AND c.icd_version = ad.icd_version
-		WHERE
-			(:search = '' OR
-			 LOWER(c.condition_name) LIKE LOWER(:search_pattern) OR
-			 c.icd_code LIKE :search_pattern)
-		GROUP BY c.icd_code, c.icd_version, c.condition_name
-		ORDER BY patient_count DESC NULLS LAST, diagnosis_count DESC
-		LIMIT 100
-	""")
+	first_word = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+	if not SLOW_QUERY_EXPLAIN or first_word not in ('SELECT', 'WITH'):
+		return
+	# Only one EXPLAIN runs at a time; others are skipped rather than queued
+	if not explain_slots.acquire(blocking=False):
+		return
 
-	try:
-		search_pattern = f'%{search}%' if search else ''
-		result = g.conn.execute(query, {
-			'search': search,
-			'search_pattern': search_pattern
-		})
-		conditions = result.fetchall()
-	except Exception as e:
-		print(f"Error fetching conditions: {e}")
-		import traceback
-		traceback.print_exc()
-		conditions = []
+	def explain():
+		explain_state.active = True
+		try:
+			with (statement_engine or engine).connect() as conn:
+				plan = conn.exec_driver_sql('EXPLAIN (ANALYZE, BUFFERS) ' + statement, parameters).fetchall()
+				conn.rollback()
+			slow_query_log.warning("plan for slow statement in %s:\n%s",
+				route, '\n'.join(row[0] for row in plan))
+		except Exception as e:
+			slow_query_log.warning("could not EXPLAIN slow statement in %s: %s", route, e)
+		finally:
+			explain_state.active = False
+			explain_slots.release()
 
-	return render_template("conditions.html", conditions=conditions, search=search)
+	threading.Thread(target=explain, name='slow-query-explain', daemon=True).start()
 
 
-@app.route('/condition/<icd_code>/<int:icd_version>')
-def condition_detail(icd_code, icd_version):
+@app.route('/metrics')
+def metrics_endpoint():
 	"""
-	Detailed view of a specific condition showing all diagnosed patients
+	Request, SQL and pool metrics in the Prometheus text format
 	"""
-	try:
-		# Get condition info
-		condition_query = text("""
-			SELECT * FROM wl2822.condition
-			WHERE icd_code = :icd_code AND icd_version = :icd_version
-		""")
-		condition_result = g.conn.execute(condition_query, {
-			'icd_code': icd_code,
-			'icd_version': icd_version
-		})
-		condition = condition_result.fetchone()
+	return Response(metrics.expose(), mimetype='text/plain; version=0.0.4')
+
+
+# ==========================================
+# ADMIN ENDPOINTS
+# ==========================================
+
+#
+# The endpoints that drop caches or rebuild indexes (and under `serve`
+# restart every worker) only answer requests from this host, or from
+# anywhere with the shared secret in an X-Admin-Token header. A request that
+# came through a proxy (it has X-Forwarded-For) does not count as local.
+#
+#     ADMIN_TOKEN  the shared secret (unset: local requests only)
+#
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+def admin_only(view):
+	"""
+	Answer 403 to requests that are neither local nor carry ADMIN_TOKEN
+	"""
+	@wraps(view)
+	def guarded(*args, **kwargs):
+		token = request.headers.get('X-Admin-Token')
+		if token is not None:
+			allowed = bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+		else:
+			allowed = request.remote_addr in LOCAL_ADDRESSES and 'X-Forwarded-For' not in request.headers
+		if not allowed:
+			abort(403)
+		return view(*args, **kwargs)
+	return guarded
+
+
+# ==========================================
+# PARALLEL QUERIES
+# ==========================================
+
+#
+# Independent statements of one page (the dashboard aggregations, the
+# condition detail queries) run side by side on separate pooled
+# connections, so the page waits about as long as its slowest statement
+# instead of the sum of all of them.
+#
+#     QUERY_PARALLELISM    statements in flight at once across all requests;
+#                          kept below the pool size so the workers can never
+#                          take every connection (1 runs them one by one)
+#     QUERY_PAGE_DEADLINE  seconds after the request started by which a
+#                          page's statements must have finished
+#
+QUERY_PARALLELISM = max(1, min(env_int('QUERY_PARALLELISM', 4), POOL_SIZE + POOL_MAX_OVERFLOW - 1))
+QUERY_PAGE_DEADLINE = env_float('QUERY_PAGE_DEADLINE', 30)
+
+query_executor = None
+query_executor_lock = threading.Lock()
+
+
+class QueryDeadlineExceeded(Exception):
+	pass
+
+
+def get_query_executor():
+	"""
+	The shared worker pool, created on first use
+	"""
+	global query_executor
+	with query_executor_lock:
+		if query_executor is None:
+			query_executor = ThreadPoolExecutor(max_workers=QUERY_PARALLELISM, thread_name_prefix='query')
+		return query_executor
+
+
+def fetch_rows(query, params=None):
+	"""
+	A task for run_parallel() that returns every row of one statement
+	"""
+	statement = text(query) if isinstance(query, str) else query
+	return lambda conn: conn.execute(statement, params or {}).fetchall()
+
+
+def run_parallel(tasks, conn):
+	"""
+	Run independent tasks ({name: function(conn)}) each on its own pooled
+	connection and return {name: result}. `conn` is the request's own
+	connection: it is handed back to the pool while the page waits, and
+	used for everything when QUERY_PARALLELISM is 1.
+
+	Raises QueryDeadlineExceeded when the tasks have not all finished by
+	the page deadline; statements still running are cancelled.
+	"""
+	if QUERY_PARALLELISM < 2 or len(tasks) < 2:
+		return {name: task(conn) for name, task in tasks.items()}
+
+	route = current_route()
+	stats = request_metrics()
+	salt = result_cache_salt()
+	started = stats.started if stats is not None else time.perf_counter()
+	running = {}
+
+	def run(name, task):
+		query_context.route, query_context.stats, query_context.cache_salt = route, stats, salt
+		# The connection is only checked out when the task misses the result
+		# cache, so cached and stale results are served during an outage
+		worker_conn = LazyConnection(request_engine)
+		running[name] = worker_conn
+		try:
+			return task(worker_conn)
+		finally:
+			running.pop(name, None)
+			worker_conn.close()
+			query_context.route, query_context.stats, query_context.cache_salt = None, None, None
+
+	request_engine = conn.engine if isinstance(conn, LazyConnection) else engine
+	if isinstance(conn, LazyConnection):
+		conn.close()
+
+	executor = get_query_executor()
+	futures = {executor.submit(run, name, task): name for name, task in tasks.items()}
+	done, pending = wait(futures, timeout=max(0, started + QUERY_PAGE_DEADLINE - time.perf_counter()),
+		return_when=FIRST_EXCEPTION)
+
+	if pending:
+		for future in pending:
+			future.cancel()
+		for worker_conn in list(running.values()):
+			try:
+				worker_conn.cancel()
+			except Exception:
+				pass
+		for future in done:
+			if future.exception() is not None:
+				raise future.exception()
+		raise QueryDeadlineExceeded(f"{len(pending)} of {len(futures)} queries did not finish "
+			f"within the {QUERY_PAGE_DEADLINE:g}s page deadline")
+
+	return {futures[future]: future.result() for future in done}
+
+
+# ==========================================
+# PAGE SECTIONS
+# ==========================================
+
+#
+# The composite pages (the dashboard, the patient timeline) are built from
+# sections that each get a deadline. A section still running at its
+# deadline has its statement cancelled and renders as unavailable, while
+# the rest of the page renders normally; a section that fails renders the
+# same way. No section runs past QUERY_PAGE_DEADLINE, so a page costs at
+# most the budget chosen here, not its slowest query.
+#
+#     SECTION_DEADLINE_MS            deadline of each section (0 none)
+#     SECTION_DEADLINE_MS_<SECTION>  the deadline of one section, e.g.
+#                                    SECTION_DEADLINE_MS_PROVIDER_STATS
+#
+SECTION_DEADLINE_MS = env_int('SECTION_DEADLINE_MS', 5000)
+
+section_failures = metrics.register(Counter('page_section_failures_total',
+	'Page sections rendered as unavailable', ('route', 'section', 'reason')))
+
+
+class SectionUnavailable:
+	"""
+	Stands in for the result of a section that timed out or failed. It is
+	empty and false, so templates that loop over the section show nothing.
+	"""
+
+	def __init__(self, reason):
+		self.reason = reason
+
+	def __bool__(self):
+		return False
+
+	def __iter__(self):
+		return iter(())
+
+	def __len__(self):
+		return 0
+
+
+@app.template_test('unavailable')
+def is_unavailable(value):
+	return isinstance(value, SectionUnavailable)
+
+
+def section_deadline(name):
+	"""
+	Seconds section `name` may run, capped by what is left of the page
+	deadline; None when neither applies
+	"""
+	deadline_ms = env_int('SECTION_DEADLINE_MS_' + name.upper(), SECTION_DEADLINE_MS)
+	deadline = deadline_ms / 1000 if deadline_ms > 0 else None
+	stats = request_metrics()
+	if stats is not None:
+		remaining = stats.started + QUERY_PAGE_DEADLINE - time.perf_counter()
+		deadline = remaining if deadline is None else min(deadline, remaining)
+	return deadline
+
+
+def run_section(conn, name, fetch):
+	"""
+	Return fetch(conn), or SectionUnavailable when it runs past the
+	deadline of section `name` (its statement is cancelled) or fails
+	"""
+	deadline = section_deadline(name)
+	if deadline is not None and deadline <= 0:
+		section_failures.inc((current_route(), name, 'timeout'))
+		return SectionUnavailable('timeout')
+
+	timer = None
+	if deadline is not None and isinstance(conn, LazyConnection):
+		timer = threading.Timer(deadline, conn.cancel)
+		timer.daemon = True
+		timer.start()
+	started = time.perf_counter()
+	try:
+		return fetch(conn)
+	except Exception as e:
+		# Includes failing to check out a connection: a dead database costs
+		# the page only the sections it could not serve from the cache
+		if deadline is not None and time.perf_counter() - started >= deadline:
+			reason = 'timeout'
+		elif isinstance(e, (DatabaseUnavailable, exc.OperationalError)):
+			reason = 'unavailable'
+		else:
+			reason = 'error'
+		print(f"Section {name} unavailable ({reason}): {str(e).splitlines()[0] if str(e) else type(e).__name__}")
+		section_failures.inc((current_route(), name, reason))
+		try:
+			conn.rollback()
+		except Exception:
+			pass
+		return SectionUnavailable(reason)
+	finally:
+		if timer is not None:
+			timer.cancel()
+
+
+# ==========================================
+# READ REPLICAS
+# ==========================================
+
+#
+# The read-only routes (lists, detail pages, the dashboard, exports and the
+# JSON API) can run on replicas of the database, so their aggregations do
+# not compete with ingest on the primary. Writes, and every request of a
+# client that wrote in the last READ_YOUR_WRITES_SECONDS, stay on the
+# primary.
+#
+#     DATABASE_REPLICA_URIS     comma-separated replica URIs (none: every
+#                               query runs on the primary)
+#     REPLICA_POLICY            round_robin, or least_connections (fewest
+#                               connections checked out of its pool)
+#     REPLICA_MAX_LAG           seconds of replay lag after which a replica
+#                               is skipped until it catches up
+#     REPLICA_CHECK_INTERVAL    seconds between lag checks
+#     REPLICA_CONNECT_TIMEOUT   seconds before an unreachable replica is
+#                               given up on and the primary used instead
+#     READ_YOUR_WRITES_SECONDS  how long a client stays on the primary after
+#                               a write request
+#
+REPLICA_URIS = [uri.strip() for uri in os.environ.get('DATABASE_REPLICA_URIS', '').split(',') if uri.strip()]
+REPLICA_POLICIES = ('round_robin', 'least_connections')
+REPLICA_POLICY = os.environ.get('REPLICA_POLICY', 'round_robin')
+if REPLICA_POLICY not in REPLICA_POLICIES:
+	raise ValueError(f"REPLICA_POLICY must be one of {', '.join(REPLICA_POLICIES)}, not {REPLICA_POLICY!r}")
+REPLICA_MAX_LAG = env_float('REPLICA_MAX_LAG', 30)
+REPLICA_CHECK_INTERVAL = env_float('REPLICA_CHECK_INTERVAL', 5)
+REPLICA_CONNECT_TIMEOUT = env_int('REPLICA_CONNECT_TIMEOUT', DB_CONNECT_TIMEOUT)
+READ_YOUR_WRITES_SECONDS = env_float('READ_YOUR_WRITES_SECONDS', 10)
+READ_YOUR_WRITES_COOKIE = 'primary_until'
+
+REPLICA_ROUTES = frozenset(['index', 'patients', 'patient_detail', 'patient_admission', 'conditions',
+	'condition_detail', 'admissions', 'analytics', 'medications', 'prescriptions', 'procedures',
+	'export', 'export_condition', 'api_list', 'api_analytics', 'trends', 'api_trends'])
+
+# Zero replay lag when the replica has replayed everything it received (an
+# idle primary writes nothing to replay), or when it is not a streaming
+# standby at all
+REPLICA_LAG_QUERY = """
+	SELECT CASE
+		WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+		ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+	END as lag
+"""
+
+routed_requests = metrics.register(Counter('db_routed_requests_total',
+	'Requests by the database they were routed to', ('target',)))
+replica_fallbacks = metrics.register(Counter('db_replica_fallbacks_total',
+	'Requests moved to the primary because their replica failed', ('target',)))
+
+
+class Replica:
+	"""
+	One replica's engine and its last health check
+	"""
+
+	def __init__(self, name, uri):
+		self.name = name
+		self.engine = create_engine(uri,
+			pool_size=POOL_SIZE,
+			max_overflow=POOL_MAX_OVERFLOW,
+			pool_recycle=POOL_RECYCLE,
+			pool_pre_ping=POOL_PRE_PING,
+			pool_timeout=POOL_TIMEOUT,
+			connect_args={'connect_timeout': REPLICA_CONNECT_TIMEOUT})
+		# The primary's statement metrics and slow query log cover replicas too
+		event.listen(self.engine, 'do_connect', apply_statement_timeout)
+		event.listen(self.engine, 'connect', on_pool_connect)
+		event.listen(self.engine, 'before_cursor_execute', start_statement_timer)
+		event.listen(self.engine, 'after_cursor_execute', record_statement)
+		event.listen(self.engine, 'handle_error', discard_statement_timer)
+		event.listen(self.engine, 'handle_error', self.record_lost_connection)
+		self.healthy = True
+		self.lag = None
+		self.error = None
+		self.checked_at = None
+
+	def check(self):
+		try:
+			with self.engine.connect() as conn:
+				self.lag = float(conn.execute(text(REPLICA_LAG_QUERY)).scalar())
+			self.error = None
+			self.healthy = self.lag <= REPLICA_MAX_LAG
+			if not self.healthy:
+				self.error = f"{self.lag:.1f}s behind"
+		except Exception as e:
+			self.healthy, self.lag, self.error = False, None, str(e).splitlines()[0]
+		self.checked_at = time.time()
+
+	def record_lost_connection(self, context):
+		# A replica that dies mid-statement is skipped until it passes a
+		# check again; the primary's circuit breaker is left alone
+		if context.is_disconnect and context.connection is not None and not context.is_pre_ping:
+			self.healthy, self.error = False, str(context.original_exception).splitlines()[0]
+
+	def stats(self):
+		return {
+			'name': self.name,
+			'url': self.engine.url.render_as_string(hide_password=True),
+			'healthy': self.healthy,
+			'lag_seconds': self.lag,
+			'error': self.error,
+			'checked_out': self.engine.pool.checkedout(),
+			'checked_at': self.checked_at
+		}
+
+
+class ReplicaSet:
+	"""
+	Picks a replica for each read-only request among those that passed the
+	last check. Checks run in a background thread every
+	REPLICA_CHECK_INTERVAL seconds, started by the first request of a
+	process; a replica that fails a connection is skipped until it passes
+	one again.
+	"""
+
+	def __init__(self, uris, policy):
+		self.replicas = [Replica(f'replica-{i}', uri) for i, uri in enumerate(uris)]
+		self.policy = policy
+		self.lock = threading.Lock()
+		self.next = 0
+		self.checker_pid = None
+
+	def choose(self):
+		"""
+		The engine of the replica for the next request, or None when none
+		is usable
+		"""
+		self.start_checker()
+		usable = [replica for replica in self.replicas if replica.healthy]
+		if not usable:
+			return None
+		if self.policy == 'least_connections':
+			return min(usable, key=lambda replica: replica.engine.pool.checkedout()).engine
+		with self.lock:
+			self.next += 1
+			return usable[self.next % len(usable)].engine
+
+	def start_checker(self):
+		if self.checker_pid == os.getpid():
+			return
+		with self.lock:
+			if self.checker_pid == os.getpid():
+				return
+			self.checker_pid = os.getpid()
+
+		def check_forever():
+			while True:
+				for replica in self.replicas:
+					replica.check()
+				time.sleep(REPLICA_CHECK_INTERVAL)
+
+		threading.Thread(target=check_forever, name='replica-checker', daemon=True).start()
+
+	def name_of(self, replica_engine):
+		for replica in self.replicas:
+			if replica.engine is replica_engine:
+				return replica.name
+		return 'primary'
+
+	def mark_failed(self, replica_engine, error):
+		for replica in self.replicas:
+			if replica.engine is replica_engine:
+				replica.healthy, replica.error = False, str(error).splitlines()[0]
+
+	def after_fork(self):
+		for replica in self.replicas:
+			replica.engine.dispose(close=False)
+
+	def stats(self):
+		return [replica.stats() for replica in self.replicas]
+
+
+replicas = ReplicaSet(REPLICA_URIS, REPLICA_POLICY) if REPLICA_URIS else None
+
+
+def route_engine():
+	"""
+	Engine for the current request: a replica for the read-only routes,
+	unless the client wrote recently or no replica is usable
+	"""
+	if replicas is None or request.method not in ('GET', 'HEAD') or request.endpoint not in REPLICA_ROUTES:
+		return engine
+	if request.cookies.get(READ_YOUR_WRITES_COOKIE, 0, type=float) > time.time():
+		return engine
+	return replicas.choose() or engine
+
+
+@app.after_request
+def pin_writers_to_primary(response):
+	"""
+	Keep a client that just wrote on the primary for a while, so its next
+	pages do not come from a replica that has not replayed the write yet
+	"""
+	if replicas is not None and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+		response.set_cookie(READ_YOUR_WRITES_COOKIE, str(time.time() + READ_YOUR_WRITES_SECONDS),
+			max_age=int(READ_YOUR_WRITES_SECONDS) + 1, httponly=True, samesite='Lax')
+	return response
+
+
+@app.route('/replica_stats')
+def replica_stats():
+	"""
+	Health, replay lag and pool use of each replica as JSON
+	"""
+	return jsonify(policy=REPLICA_POLICY, max_lag=REPLICA_MAX_LAG,
+		replicas=replicas.stats() if replicas is not None else [])
+
+
+# ==========================================
+# DATABASE AVAILABILITY
+# ==========================================
+
+#
+# When the database host stops answering, requests fail fast instead of
+# each waiting out a connect timeout: after DB_BREAKER_THRESHOLD
+# consecutive connection failures the circuit breaker opens, new
+# connections to the primary are refused at once, and a background thread
+# probes the database every DB_BREAKER_PROBE_INTERVAL seconds until it
+# answers again. Meanwhile, cached results are served even past their TTL
+# (up to RESULT_CACHE_STALE_SECONDS), and responses built from them are
+# marked stale.
+#
+DB_BREAKER_THRESHOLD = env_int('DB_BREAKER_THRESHOLD', 3)
+DB_BREAKER_PROBE_INTERVAL = env_float('DB_BREAKER_PROBE_INTERVAL', 2)
+
+breaker_opened = metrics.register(Counter('db_breaker_opened_total',
+	'Times the database circuit breaker opened'))
+stale_results_total = metrics.register(Counter('result_cache_stale_total',
+	'Results served past their TTL because the database failed', ('route',)))
+
+
+class DatabaseUnavailable(Exception):
+	pass
+
+
+class CircuitBreaker:
+	"""
+	Counts consecutive connection failures of an engine; opens after
+	`threshold` of them and closes once a background probe connects
+	"""
+
+	def __init__(self, engine, threshold, probe_interval):
+		self.engine = engine
+		self.threshold = threshold
+		self.probe_interval = probe_interval
+		self.lock = threading.Lock()
+		self.failures = 0
+		self.opened_at = None
+		self.last_error = None
+
+	@property
+	def is_open(self):
+		return self.opened_at is not None
+
+	def check(self):
+		"""
+		Raise DatabaseUnavailable while the breaker is open
+		"""
+		if self.opened_at is not None:
+			raise DatabaseUnavailable(f"database unavailable since {datetime.fromtimestamp(self.opened_at):%H:%M:%S}: "
+				f"{self.last_error}")
+
+	def record_success(self):
+		if self.failures:
+			with self.lock:
+				self.failures = 0
+
+	def record_failure(self, error):
+		with self.lock:
+			self.failures += 1
+			self.last_error = str(error).splitlines()[0]
+			if self.opened_at is not None or self.threshold <= 0 or self.failures < self.threshold:
+				return
+			self.opened_at = time.time()
+		print(f"Database circuit breaker open after {self.failures} failures: {self.last_error}")
+		breaker_opened.inc()
+		threading.Thread(target=self.probe, name='db-breaker-probe', daemon=True).start()
+
+	def probe(self):
+		while True:
+			time.sleep(self.probe_interval)
+			try:
+				with self.engine.connect() as conn:
+					conn.execute(text("SELECT 1"))
+			except Exception as e:
+				self.last_error = str(e).splitlines()[0]
+				continue
+			with self.lock:
+				self.failures = 0
+				self.opened_at = None
+			print("Database circuit breaker closed")
+			return
+
+	def stats(self):
+		return {
+			'state': 'open' if self.is_open else 'closed',
+			'consecutive_failures': self.failures,
+			'opened_at': self.opened_at,
+			'last_error': self.last_error
+		}
+
+
+db_breaker = CircuitBreaker(engine, DB_BREAKER_THRESHOLD, DB_BREAKER_PROBE_INTERVAL)
+
+
+def connect_primary():
+	"""
+	A pooled connection to the primary; fails at once while the breaker is
+	open
+	"""
+	db_breaker.check()
+	try:
+		conn = engine.connect()
+	except exc.OperationalError as e:
+		db_breaker.record_failure(e)
+		raise
+	db_breaker.record_success()
+	return conn
+
+
+@event.listens_for(engine, 'handle_error')
+def record_lost_connection(context):
+	# A connection that died mid-statement counts as a failure too
+	if context.is_disconnect and context.connection is not None and not context.is_pre_ping:
+		db_breaker.record_failure(context.original_exception)
+
+
+def mark_stale(route):
+	stale_results_total.inc((route,))
+	stats = request_metrics()
+	if stats is not None:
+		with stats.lock:
+			stats.stale_results += 1
+
+
+@app.template_global()
+def stale_data():
+	"""
+	Whether the current response uses results the database could not
+	refresh
+	"""
+	stats = request_metrics()
+	return stats is not None and stats.stale_results > 0
+
+
+@app.after_request
+def mark_stale_response(response):
+	if stale_data():
+		response.headers['Warning'] = '110 - "Response is Stale"'
+		response.headers['Cache-Control'] = 'no-cache'
+	return response
+
+
+@app.errorhandler(DatabaseUnavailable)
+@app.errorhandler(exc.OperationalError)
+def database_unavailable(e):
+	"""
+	A route that needed the database and had nothing cached to fall back on
+	answers 503 instead of crashing; JSON for the API routes
+	"""
+	message = str(e).splitlines()[0] if str(e) else type(e).__name__
+	print(f"Database unavailable for {request.path}: {message}")
+	retry_after = {'Retry-After': str(max(1, int(DB_BREAKER_PROBE_INTERVAL)))}
+	if request.path.startswith('/api/'):
+		return jsonify(error="database unavailable"), 503, retry_after
+	return "Database unavailable, try again shortly", 503, retry_after
+
+
+@app.route('/db_status')
+def db_status():
+	"""
+	Circuit breaker state as JSON
+	"""
+	return jsonify(db_breaker.stats())
+
+
+# ==========================================
+# RESULT CACHE
+# ==========================================
+
+#
+# Read statements that routes run on g.conn are answered from a cache keyed
+# on the statement and its bound parameters, so a popular condition page or
+# medication search reaches Postgres once per TTL instead of once per
+# visitor. Results are stored as pickled tuples and come back as ordinary
+# SQLAlchemy results, so routes do not know whether a statement was cached.
+#
+#     RESULT_CACHE_MB       size of the cache, least recently used results
+#                           evicted first (0 disables the cache)
+#     RESULT_CACHE_BACKEND  memory: one cache per process
+#                           shared: a SQLite file every worker process on
+#                           the host reads and writes
+#     RESULT_CACHE_PATH     file of the shared backend
+#     RESULT_CACHE_TTL_<ROUTE>  seconds a route's results are served,
+#                           overriding RESULT_CACHE_TTLS (0 disables)
+#     RESULT_CACHE_STALE_SECONDS  how long past its TTL a result is kept to
+#                           be served while the database fails
+#
+# Entries remember the wl2822 tables their statement reads; writers drop
+# them with invalidate_caches() or POST /api/caches/invalidate?table=...
+#
+RESULT_CACHE_MB = env_float('RESULT_CACHE_MB', 64)
+RESULT_CACHE_BACKEND = os.environ.get('RESULT_CACHE_BACKEND', 'memory')
+if RESULT_CACHE_BACKEND not in ('memory', 'shared'):
+	raise ValueError(f"RESULT_CACHE_BACKEND must be memory or shared, not {RESULT_CACHE_BACKEND!r}")
+RESULT_CACHE_STALE_SECONDS = env_float('RESULT_CACHE_STALE_SECONDS', 3600)
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH') or os.path.join(tempfile.gettempdir(),
+	'coms4111-results-%s.sqlite3' % hashlib.sha1(DATABASEURI.encode()).hexdigest()[:12])
+
+# Seconds each route's results are served from the cache
+RESULT_CACHE_TTLS = {route: env_float('RESULT_CACHE_TTL_' + route.upper(), ttl) for route, ttl in {
+	'index': 30,
+	'patients': 60,
+	'patient_detail': 60,
+	'patient_admission': 60,
+	'conditions': 300,
+	'condition_detail': 300,
+	'admissions': 60,
+	'analytics': 60,
+	'medications': 300,
+	'prescriptions': 60,
+	'procedures': 300,
+	'api_list': 60,
+	'api_analytics': 60,
+	'trends': 60,
+	'api_trends': 60
+}.items()}
+
+# No single result may take more than this share of the cache
+RESULT_CACHE_MAX_ENTRY_SHARE = 0.1
+
+result_cache_hits = metrics.register(Counter('result_cache_hits_total',
+	'Statements answered from the result cache', ('route',)))
+result_cache_misses = metrics.register(Counter('result_cache_misses_total',
+	'Cacheable statements sent to the database', ('route',)))
+
+
+# Tables whose reads always go to the database
+UNCACHED_TABLES = frozenset(['data_versions'])
+
+
+@lru_cache(maxsize=1024)
+def cacheable_tables(sql):
+	"""
+	The wl2822 tables a read-only statement reads, as a frozenset, or None
+	when the statement may write or lock rows or reads an uncached table
+	"""
+	if not re.match(r'\s*(SELECT|WITH)\b', sql, re.I):
+		return None
+	if re.search(r'\b(INSERT|UPDATE|DELETE|FOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE)|nextval|setval)\b', sql, re.I):
+		return None
+	tables = frozenset(re.findall(r'\bwl2822\.(\w+)', sql))
+	return None if tables & UNCACHED_TABLES else tables
+
+
+def result_cache_salt():
+	"""
+	Extra result cache key of the current request: the version of the page
+	being served, so a page whose data version changed never reuses older
+	results
+	"""
+	if has_request_context():
+		return g.get('result_cache_salt')
+	return getattr(query_context, 'cache_salt', None)
+
+
+def cached_result(value):
+	"""
+	A Result over cached (column names, rows)
+	"""
+	keys, rows = value
+	return IteratorResult(SimpleResultMetaData(keys), iter(rows))
+
+
+CacheEntry = namedtuple('CacheEntry', ['blob', 'tables', 'expires'])
+
+
+class MemoryResultStore:
+	"""
+	Results held pickled in this process, so max_bytes bounds what they
+	really take, evicted least recently used first once they exceed it
+	"""
+
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		self.entries = OrderedDict()
+		self.bytes = 0
+		self.evictions = 0
+
+	def get(self, key, stale=False):
+		"""
+		The live result stored under `key`; with `stale`, also one past its
+		TTL but within RESULT_CACHE_STALE_SECONDS
+		"""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				return None
+			now = time.time()
+			if entry.expires + RESULT_CACHE_STALE_SECONDS < now:
+				self._remove(key)
+				return None
+			if entry.expires < now and not stale:
+				return None
+			self.entries.move_to_end(key)
+		return pickle.loads(entry.blob)
+
+	def put(self, key, blob, tables, expires):
+		with self.lock:
+			if key in self.entries:
+				self._remove(key)
+			self.entries[key] = CacheEntry(blob, tables, expires)
+			self.bytes += len(blob)
+			while self.bytes > self.max_bytes and self.entries:
+				self._remove(next(iter(self.entries)))
+				self.evictions += 1
+
+	def _remove(self, key):
+		self.bytes -= len(self.entries.pop(key).blob)
+
+	def invalidate(self, tables=None):
+		with self.lock:
+			for key in [key for key, entry in self.entries.items()
+					if tables is None or entry.tables & set(tables)]:
+				self._remove(key)
+
+	def stats(self):
+		with self.lock:
+			return {'entries': len(self.entries), 'bytes': self.bytes, 'evictions': self.evictions}
+
+
+class SharedResultStore:
+	"""
+	Results held in a SQLite file, so every worker process on the host
+	shares them, evicted least recently used first once they exceed
+	max_bytes
+	"""
+
+	def __init__(self, path, max_bytes):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.local = threading.local()
+		self.evictions = 0
+		db = self.connect()
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS results (
+				key TEXT PRIMARY KEY,
+				tables TEXT NOT NULL,
+				expires REAL NOT NULL,
+				used REAL NOT NULL,
+				size INTEGER NOT NULL,
+				value BLOB NOT NULL
+			)
+		""")
+		db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+
+	def connect(self):
+		"""
+		This thread's connection to the file; a forked worker opens its own
+		"""
+		if getattr(self.local, 'pid', None) != os.getpid():
+			db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+			db.execute("PRAGMA journal_mode=WAL")
+			db.execute("PRAGMA synchronous=OFF")
+			self.local.db, self.local.pid = db, os.getpid()
+		return self.local.db
+
+	def get(self, key, stale=False):
+		db = self.connect()
+		row = db.execute("SELECT value, expires FROM results WHERE key = ?", (key,)).fetchone()
+		if row is None:
+			return None
+		now = time.time()
+		if row[1] + RESULT_CACHE_STALE_SECONDS < now:
+			db.execute("DELETE FROM results WHERE key = ?", (key,))
+			return None
+		if row[1] < now and not stale:
+			return None
+		db.execute("UPDATE results SET used = ? WHERE key = ?", (now, key))
+		return pickle.loads(row[0])
+
+	def put(self, key, blob, tables, expires):
+		db = self.connect()
+		now = time.time()
+		db.execute("INSERT OR REPLACE INTO results (key, tables, expires, used, size, value) VALUES (?, ?, ?, ?, ?, ?)",
+			(key, ',' + ','.join(sorted(tables)) + ',', expires, now, len(blob), blob))
+		total = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+		if total > self.max_bytes:
+			db.execute("DELETE FROM results WHERE expires < ?", (now - RESULT_CACHE_STALE_SECONDS,))
+			total = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+		while total > self.max_bytes:
+			oldest = db.execute("SELECT key, size FROM results ORDER BY used LIMIT 16").fetchall()
+			if not oldest:
+				break
+			for old_key, size in oldest:
+				db.execute("DELETE FROM results WHERE key = ?", (old_key,))
+				self.evictions += 1
+				total -= size
+				if total <= self.max_bytes:
+					break
+
+	def invalidate(self, tables=None):
+		db = self.connect()
+		if tables is None:
+			db.execute("DELETE FROM results")
+		for table in tables or ():
+			db.execute("DELETE FROM results WHERE tables LIKE ?", ('%,' + table + ',%',))
+
+	def stats(self):
+		entries, size = self.connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+		return {'entries': entries, 'bytes': size, 'evictions': self.evictions}
+
+
+class ResultCache:
+	"""
+	Serves cacheable statements from a result store, counting hits and
+	misses per route
+	"""
+
+	def __init__(self, store, max_entry_bytes):
+		self.store = store
+		self.max_entry_bytes = max_entry_bytes
+
+	def execute(self, connect, statement, parameters=None):
+		"""
+		Run `statement` on the connection `connect()` returns, unless the
+		current route caches it and a live result is stored
+		"""
+		route = current_route()
+		ttl = RESULT_CACHE_TTLS.get(route, 0)
+		# The index advisor needs every statement to reach the database
+		tables = cacheable_tables(str(statement)) \
+			if ttl > 0 and isinstance(statement, TextClause) and captured_statements is None else None
+		if tables is None:
+			return connect().execute(statement, parameters)
+
+		key = hashlib.sha1('\0'.join((DATABASEURI, result_cache_salt() or '', str(statement),
+			repr(sorted((parameters or {}).items())))).encode()).hexdigest()
+		try:
+			value = self.store.get(key)
+		except Exception as e:
+			print(f"Error reading the result cache: {e}")
+			value = None
+		if value is not None:
+			result_cache_hits.inc((route,))
+			return cached_result(value)
+
+		result_cache_misses.inc((route,))
+		conn = None
+		try:
+			conn = connect()
+			result = conn.execute(statement, parameters)
+		except (DatabaseUnavailable, exc.OperationalError):
+			# Stale while error: the last good result beats no page
+			try:
+				value = self.store.get(key, stale=True)
+			except Exception:
+				value = None
+			if value is None:
+				raise
+			if conn is not None:
+				try:
+					conn.rollback()
+				except Exception:
+					pass
+			mark_stale(route)
+			return cached_result(value)
+		value = (tuple(result.keys()), tuple(tuple(row) for row in result))
+		blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+		if len(blob) <= self.max_entry_bytes:
+			try:
+				self.store.put(key, blob, tables, time.time() + ttl)
+			except Exception as e:
+				print(f"Error writing the result cache: {e}")
+		return cached_result(value)
+
+	def invalidate(self, tables=None):
+		"""
+		Drop the results read from any of `tables` (everything when None)
+		"""
+		self.store.invalidate(tables)
+
+	def stats(self):
+		with result_cache_hits.lock, result_cache_misses.lock:
+			hits = sum(result_cache_hits.values.values())
+			misses = sum(result_cache_misses.values.values())
+		return {
+			'backend': RESULT_CACHE_BACKEND,
+			'hits': hits,
+			'misses': misses,
+			'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else None,
+			'max_bytes': self.store.max_bytes,
+			**self.store.stats()
+		}
+
+
+def create_result_cache():
+	if RESULT_CACHE_MB <= 0:
+		return None
+	max_bytes = int(RESULT_CACHE_MB * 1024 * 1024)
+	store = SharedResultStore(RESULT_CACHE_PATH, max_bytes) if RESULT_CACHE_BACKEND == 'shared' \
+		else MemoryResultStore(max_bytes)
+	return ResultCache(store, int(max_bytes * RESULT_CACHE_MAX_ENTRY_SHARE))
+
+
+result_cache = create_result_cache()
+if result_cache is not None:
+	for stat in ('entries', 'bytes', 'evictions'):
+		# Every worker sees the same shared store
+		metrics.register(Gauge('result_cache_' + stat, f'Result cache {stat}',
+			lambda stat=stat: result_cache.store.stats()[stat],
+			combine=max if RESULT_CACHE_BACKEND == 'shared' else sum))
+
+
+@app.route('/cache_stats')
+def cache_stats():
+	"""
+	Result cache statistics as JSON (hits, misses, size, evictions)
+	"""
+	if result_cache is None:
+		return jsonify(enabled=False)
+	return jsonify(enabled=True, **result_cache.stats())
+
+
+# ==========================================
+# ROW COUNTERS
+# ==========================================
+
+#
+# How table row counts are obtained for the homepage and dashboard:
+#
+#     exact       COUNT(*) on every table (a full scan each)
+#     estimated   planner estimates from pg_class / pg_stat_user_tables
+#     maintained  a trigger-maintained wl2822.table_counts table, installed
+#                 with `python server.py install-counters`
+#
+# Whatever the mode, all counts of a page come back in one round trip.
+#
+COUNTER_MODES = ('exact', 'estimated', 'maintained')
+COUNTER_MODE = os.environ.get('COUNTER_MODE', 'exact')
+if COUNTER_MODE not in COUNTER_MODES:
+	raise ValueError(f"COUNTER_MODE must be one of {', '.join(COUNTER_MODES)}, not {COUNTER_MODE!r}")
+
+# Every table whose size is shown on a page
+COUNTED_TABLES = ['patient', 'admission', 'prescription', 'condition', 'medication',
+	'medical_images', 'provider', 'procedures_performed']
+
+
+def fetch_exact_counts(conn, tables):
+	query = text("SELECT " + ", ".join(
+		f"(SELECT COUNT(*) FROM wl2822.{table}) as {table}" for table in tables))
+	return dict(conn.execute(query).fetchone()._mapping)
+
+
+def fetch_estimated_counts(conn, tables):
+	query = text("""
+		SELECT
+			c.relname,
+			CASE WHEN c.reltuples >= 0 THEN c.reltuples::bigint
+				ELSE COALESCE(s.n_live_tup, 0) END as row_count
+		FROM pg_class c
+		JOIN pg_namespace n ON n.oid = c.relnamespace
+		LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+		WHERE n.nspname = 'wl2822' AND c.relname = ANY(:tables)
+	""")
+	return {row.relname: row.row_count for row in conn.execute(query, {'tables': list(tables)})}
+
+
+def fetch_maintained_counts(conn, tables):
+	query = text("""
+		SELECT table_name, row_count FROM wl2822.table_counts
+		WHERE table_name = ANY(:tables)
+	""")
+	return {row.table_name: row.row_count for row in conn.execute(query, {'tables': list(tables)})}
+
+
+COUNT_FETCHERS = {
+	'exact': fetch_exact_counts,
+	'estimated': fetch_estimated_counts,
+	'maintained': fetch_maintained_counts
+}
+
+
+def fetch_counts(conn, count_tables, mode=None):
+	"""
+	Row counts for a {stat name: table} mapping, as {stat name: count}.
+	Tables the chosen mode has no figure for fall back to an exact count.
+	"""
+	mode = mode or COUNTER_MODE
+	tables = set(count_tables.values())
+	try:
+		counts = COUNT_FETCHERS[mode](conn, tables)
+	except Exception as e:
+		if mode == 'exact':
+			raise
+		print(f"Error fetching {mode} counts, falling back to exact: {e}")
+		conn.rollback()
+		counts = {}
+	missing = tables - set(counts)
+	if missing:
+		counts.update(fetch_exact_counts(conn, sorted(missing)))
+	return {name: counts[table] for name, table in count_tables.items()}
+
+
+def install_counters(conn, tables=COUNTED_TABLES):
+	"""
+	Create wl2822.table_counts and the triggers that keep it up to date,
+	seeded with exact counts. Statement-level triggers with transition
+	tables add one row update per INSERT/DELETE statement, so bulk loads
+	stay cheap.
+	"""
+	conn.execute(text("""
+		CREATE TABLE IF NOT EXISTS wl2822.table_counts (
+			table_name TEXT PRIMARY KEY,
+			row_count BIGINT NOT NULL
+		)
+	"""))
+	conn.execute(text("""
+		CREATE OR REPLACE FUNCTION wl2822.table_counts_insert() RETURNS trigger AS $$
+		BEGIN
+			UPDATE wl2822.table_counts
+			SET row_count = row_count + (SELECT COUNT(*) FROM new_rows)
+			WHERE table_name = TG_TABLE_NAME;
+			RETURN NULL;
+		END $$ LANGUAGE plpgsql
+	"""))
+	conn.execute(text("""
+		CREATE OR REPLACE FUNCTION wl2822.table_counts_delete() RETURNS trigger AS $$
+		BEGIN
+			UPDATE wl2822.table_counts
+			SET row_count = row_count - (SELECT COUNT(*) FROM old_rows)
+			WHERE table_name = TG_TABLE_NAME;
+			RETURN NULL;
+		END $$ LANGUAGE plpgsql
+	"""))
+	conn.execute(text("""
+		CREATE OR REPLACE FUNCTION wl2822.table_counts_truncate() RETURNS trigger AS $$
+		BEGIN
+			UPDATE wl2822.table_counts SET row_count = 0 WHERE table_name = TG_TABLE_NAME;
+			RETURN NULL;
+		END $$ LANGUAGE plpgsql
+	"""))
+
+	for table in tables:
+		# Block writers while the triggers go in so the seed count is exact
+		conn.execute(text(f"LOCK TABLE wl2822.{table} IN SHARE ROW EXCLUSIVE MODE"))
+		for event_name, transition, function in (
+			('INSERT', 'NEW TABLE AS new_rows', 'table_counts_insert'),
+			('DELETE', 'OLD TABLE AS old_rows', 'table_counts_delete')):
+			conn.execute(text(f"DROP TRIGGER IF EXISTS {function} ON wl2822.{table}"))
+			conn.execute(text(f"""
+				CREATE TRIGGER {function} AFTER {event_name} ON wl2822.{table}
+				REFERENCING {transition}
+				FOR EACH STATEMENT EXECUTE FUNCTION wl2822.{function}()
+			"""))
+		conn.execute(text(f"DROP TRIGGER IF EXISTS table_counts_truncate ON wl2822.{table}"))
+		conn.execute(text(f"""
+			CREATE TRIGGER table_counts_truncate AFTER TRUNCATE ON wl2822.{table}
+			FOR EACH STATEMENT EXECUTE FUNCTION wl2822.table_counts_truncate()
+		"""))
+		conn.execute(text(f"""
+			INSERT INTO wl2822.table_counts (table_name, row_count)
+			SELECT :table, COUNT(*) FROM wl2822.{table}
+			ON CONFLICT (table_name) DO UPDATE SET row_count = EXCLUDED.row_count
+		"""), {'table': table})
+
+
+# Homepage statistics (stat name -> table)
+HOME_COUNT_TABLES = {
+	'patient_count': 'patient',
+	'admission_count': 'admission',
+	'prescription_count': 'prescription',
+	'image_count': 'medical_images'
+}
+
+
+#
+# @app.route is a decorator around index() that means:
+#   run index() whenever the user tries to access the "/" path using a GET request
+#
+# If you wanted the user to go to, for example, localhost:8111/foobar/ with POST or GET then you could use:
+#
+#       @app.route("/foobar/", methods=["POST", "GET"])
+#
+# PROTIP: (the trailing / in the path is important)
+# 
+# see for routing: https://flask.palletsprojects.com/en/1.1.x/quickstart/#routing
+# see for decorators: http://simeonfranklin.com/blog/2012/jul/1/python-decorators-in-12-steps/
+#
+@app.route('/')
+def index():
+	"""
+	Home page with database statistics
+	"""
+	# Get statistics from database, all in one round trip
+	try:
+		stats = fetch_counts(g.conn, HOME_COUNT_TABLES)
+	except Exception as e:
+		print(f"Error getting stats: {e}")
+		stats = {
+			'patient_count': 0,
+			'admission_count': 0,
+			'prescription_count': 0,
+			'image_count': 0
+		}
+
+	return render_template("home.html", stats=stats)
+
+# ==========================================
+# PAGINATION
+# ==========================================
+
+# Rows per page for the list routes; ?per_page= may ask for up to PAGE_SIZE_MAX
+PAGE_SIZE_DEFAULT = env_int('PAGE_SIZE_DEFAULT', 100)
+PAGE_SIZE_MAX = env_int('PAGE_SIZE_MAX', 500)
+
+
+def get_page_size():
+	"""
+	Page size requested with ?per_page=, clamped to [1, PAGE_SIZE_MAX]
+	"""
+	per_page = request.args.get('per_page', type=int) or PAGE_SIZE_DEFAULT
+	return max(1, min(per_page, PAGE_SIZE_MAX))
+
+
+def encode_cursor(direction, values):
+	"""
+	Pack a page direction and the sort key of a boundary row into an
+	opaque URL-safe token
+	"""
+	payload = json.dumps([direction, [json_safe(value) for value in values]])
+	return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, key_count):
+	"""
+	Unpack a cursor token into (direction, values). A missing or malformed
+	cursor returns (None, None), which means the first page.
+	"""
+	if not token:
+		return None, None
+	try:
+		padded = token + '=' * (-len(token) % 4)
+		direction, values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+	except (ValueError, TypeError):
+		return None, None
+	if direction not in ('next', 'prev') or not isinstance(values, list) or len(values) != key_count:
+		return None, None
+	return direction, values
+
+
+class Keyset:
+	"""
+	Keyset (cursor) pagination over a fixed sort order. Instead of OFFSET,
+	each page continues from the sort key of the last row shown, so deep
+	pages cost the same index range scan as the first one.
+
+	`columns` is a list of (sql_column, result_key, sql_type) for the sort
+	columns, most significant first; sql_type is used to cast the cursor
+	values back (None for integers). A nullable column takes a fourth
+	element, the value its NULLs sort as (e.g. '-infinity'): a row
+	comparison with a NULL is never true, so the column is ordered and
+	compared as COALESCE(sql_column, value) instead, and a NULL in a cursor
+	becomes that value.
+	"""
+
+	def __init__(self, columns, descending=False):
+		self.columns = []
+		self.null_values = {}
+		for column, key, sql_type, *null_value in columns:
+			if null_value:
+				column = f"COALESCE({column}, CAST('{null_value[0]}' AS {sql_type}))"
+				self.null_values[key] = null_value[0]
+			self.columns.append((column, key, sql_type))
+		self.descending = descending
+
+	def clause(self, direction):
+		"""
+		Return (condition, order_by) SQL fragments for a page in the given
+		direction. The cursor values bind as :cursor_0, :cursor_1, ...
+		"""
+		forward = direction != 'prev'
+		op = '<' if self.descending == forward else '>'
+		order = 'ASC' if op == '>' else 'DESC'
+		order_by = ', '.join(f'{column} {order}' for column, _, _ in self.columns)
+		if direction is None:
+			return 'TRUE', order_by
+		left = ', '.join(column for column, _, _ in self.columns)
+		right = ', '.join(
+			f'CAST(:cursor_{i} AS {sql_type})' if sql_type else f':cursor_{i}'
+			for i, (_, _, sql_type) in enumerate(self.columns))
+		return f'({left}) {op} ({right})', order_by
+
+	def params(self, values):
+		return {f'cursor_{i}': value for i, value in enumerate(values or [])}
+
+	def key_of(self, row):
+		"""
+		The sort key of a row as a cursor stores it
+		"""
+		key = []
+		for _, name, _ in self.columns:
+			value = getattr(row, name)
+			key.append(self.null_values.get(name) if value is None else value)
+		return key
+
+	def page(self, rows, per_page, direction):
+		"""
+		Trim the per_page + 1 rows fetched for a page, restore display order
+		and work out the cursors for the neighbouring pages
+		"""
+		has_more = len(rows) > per_page
+		rows = list(rows[:per_page])
+		if direction == 'prev':
+			rows.reverse()
+		if not rows:
+			return Page(rows, None, None)
+
+		first, last = self.key_of(rows[0]), self.key_of(rows[-1])
+		if direction == 'prev':
+			next_cursor = encode_cursor('next', last)
+			prev_cursor = encode_cursor('prev', first) if has_more else None
+		else:
+			next_cursor = encode_cursor('next', last) if has_more else None
+			prev_cursor = encode_cursor('prev', first) if direction == 'next' else None
+		return Page(rows, next_cursor, prev_cursor)
+
+
+class Page:
+	"""
+	One page of a list route with the cursors of its neighbours
+	"""
+
+	def __init__(self, rows, next_cursor, prev_cursor):
+		self.rows = rows
+		self.next_cursor = next_cursor
+		self.prev_cursor = prev_cursor
+
+
+@app.template_global()
+def page_url(cursor):
+	"""
+	URL of the current list route with the same filters at another cursor
+	"""
+	args = request.args.to_dict()
+	args['cursor'] = cursor
+	return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+
+PATIENTS_KEYSET = Keyset([('p.subject_id', 'subject_id', None)])
+# Admissions and prescriptions without a time sort after all the others
+ADMISSIONS_KEYSET = Keyset([
+	('a.admission_intime', 'admission_intime', 'timestamp', '-infinity'),
+	('a.hadm_id', 'hadm_id', None)
+], descending=True)
+PRESCRIPTIONS_KEYSET = Keyset([
+	('p.start_time', 'start_time', 'timestamp', '-infinity'),
+	('p.prescription_id', 'prescription_id', None)
+], descending=True)
+
+
+# ==========================================
+# LIST FILTERS
+# ==========================================
+
+#
+# List statements are compiled with only the filters a request actually
+# uses, rather than one statement guarding every filter with
+# `(:x IS NULL OR ...)`, so Postgres plans each filter combination on its
+# own and can use the index that suits it.
+#
+
+class Filter:
+	"""
+	One optional filter of a list route: the request argument it reads, the
+	SQL condition it adds when the argument is set, and how the argument
+	value becomes bind parameters (by default {arg: value})
+	"""
+
+	def __init__(self, arg, condition, type=str, bind=None):
+		self.arg = arg
+		self.condition = condition
+		self.type = type
+		self.bind = bind or (lambda value: {arg: value})
+
+	def value(self, args):
+		value = args.get(self.arg, type=self.type)
+		return None if value in (None, '') else value
+
+
+class FilterQuery:
+	"""
+	A list statement whose {where} placeholder is filled with the conditions
+	of the active filters. Compiled statements are cached per filter
+	signature (the active filter names plus the other format fragments).
+	"""
+
+	def __init__(self, template, filters):
+		self.template = template
+		self.filters = filters
+		self.statements = {}
+
+	def bind(self, args):
+		"""
+		Return (signature, params) for the filters set in `args`
+		"""
+		signature = []
+		params = {}
+		for flt in self.filters:
+			value = flt.value(args)
+			if value is not None:
+				signature.append(flt.arg)
+				params.update(flt.bind(value))
+		return tuple(signature), params
+
+	def statement(self, signature, **fragments):
+		"""
+		The compiled statement for a filter signature, with the remaining
+		template placeholders filled from `fragments`
+		"""
+		key = (signature, tuple(sorted(fragments.items())))
+		statement = self.statements.get(key)
+		if statement is None:
+			conditions = [flt.condition for flt in self.filters if flt.arg in signature]
+			statement = self.statements.setdefault(key, text(self.template.format(
+				where='\n\t\t\tAND '.join(conditions) or 'TRUE', **fragments)))
+		return statement
+
+
+def iso_date(value):
+	"""
+	Parse a YYYY-MM-DD filter argument (ValueError makes the filter inactive)
+	"""
+	return date.fromisoformat(value)
+
+
+def born_before_age(min_age):
+	"""
+	Sargable bound for `2110 - birth year >= min_age`: born before Jan 1st
+	of the year after 2110 - min_age
+	"""
+	return {'born_before': date(min(max(2110 - min_age + 1, 1), 9999), 1, 1)}
+
+
+def born_from_age(max_age):
+	"""
+	Sargable bound for `2110 - birth year <= max_age`: born on or after
+	Jan 1st of 2110 - max_age
+	"""
+	return {'born_from': date(min(max(2110 - max_age, 1), 9999), 1, 1)}
+
+
+# ==========================================
+# FILTER FACETS
+# ==========================================
+
+# Seconds a table's facet values are served from memory before reloading
+FACET_CACHE_TTL = env_int('FACET_CACHE_TTL', 600)
+
+# Filter dropdown columns, per table
+FACET_COLUMNS = {
+	'admission': ['admission_type', 'admission_location'],
+	'medication': ['form'],
+	'prescription': ['route']
+}
+
+FacetValue = namedtuple('FacetValue', ['value', 'count'])
+
+
+class FacetCache:
+	"""
+	In-memory cache of the distinct values (with row counts) of the filter
+	dropdown columns. All facets of a table are loaded together with one
+	grouped query, served for FACET_CACHE_TTL seconds, and can be dropped
+	early with invalidate() after a data load.
+	"""
+
+	def __init__(self, columns, ttl):
+		self.columns = columns
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		self.entries = {}
+
+	def load(self, conn, table):
+		"""
+		Compute every facet of a table with a single GROUPING SETS query
+		"""
+		columns = self.columns[table]
+		query = text(f"""
+			SELECT {', '.join(columns)},
+				{', '.join(f'GROUPING({column}) as grouping_{column}' for column in columns)},
+				COUNT(*) as row_count
+			FROM wl2822.{table}
+			GROUP BY GROUPING SETS ({', '.join(f'({column})' for column in columns)})
+		""")
+		facets = {column: [] for column in columns}
+		for row in conn.execute(query):
+			for column in columns:
+				value = getattr(row, column)
+				if getattr(row, f'grouping_{column}') == 0 and value is not None:
+					facets[column].append(FacetValue(value, row.row_count))
+		for values in facets.values():
+			values.sort()
+		return facets
+
+	def get(self, conn, table, column):
+		"""
+		Values of one facet as FacetValue(value, count), sorted by value
+		"""
+		with self.lock:
+			entry = self.entries.get(table)
+		if entry is None or time.time() - entry[0] > self.ttl:
+			entry = (time.time(), self.load(conn, table))
+			with self.lock:
+				self.entries[table] = entry
+		return entry[1][column]
+
+	def invalidate(self, table=None):
+		"""
+		Drop the cached facets of one table, or of every table
+		"""
+		with self.lock:
+			if table is None:
+				self.entries.clear()
+			else:
+				self.entries.pop(table, None)
+
+
+facet_cache = FacetCache(FACET_COLUMNS, FACET_CACHE_TTL)
+
+
+@app.route('/api/facets/invalidate', methods=['POST'])
+@admin_only
+def invalidate_facets():
+	"""
+	Drop cached filter facets after a data load (?table= for just one table)
+	"""
+	table = request.args.get('table')
+	if table is not None and table not in FACET_COLUMNS:
+		abort(400)
+	facet_cache.invalidate(table)
+	return jsonify(invalidated=[table] if table else list(FACET_COLUMNS))
+
+
+# ==========================================
+# ADMISSION SUMMARY
+# ==========================================
+
+#
+# wl2822.admission_summary keeps one row of counts per admission, so the
+# admission list joins it 1:1 instead of joining the diagnosis and
+# prescription tables and grouping their cross product. It is installed
+# with `python server.py install-admission-summary`; statement-level
+# triggers on the child tables keep it current, and
+# refresh_admission_summary() rebuilds it after a bulk load.
+#
+# Summary column -> table counted per hadm_id
+ADMISSION_SUMMARY_COLUMNS = {
+	'diagnosis_count': 'admission_diagnosis',
+	'prescription_count': 'prescription',
+	'procedure_count': 'procedures_performed',
+	'image_count': 'medical_images',
+	'order_count': 'orders'
+}
+
+# Seconds before a missing summary table is looked for again
+ADMISSION_SUMMARY_RECHECK = 60
+
+admission_summary_state = {'installed': False, 'checked_at': None}
+
+
+def admission_summary_installed(conn):
+	"""
+	Whether wl2822.admission_summary exists. A positive answer is kept for
+	the life of the process, a negative one for ADMISSION_SUMMARY_RECHECK.
+	"""
+	now = time.monotonic()
+	checked_at = admission_summary_state['checked_at']
+	if not admission_summary_state['installed'] and (checked_at is None or now - checked_at >= ADMISSION_SUMMARY_RECHECK):
+		admission_summary_state['installed'] = conn.execute(
+			text("SELECT to_regclass('wl2822.admission_summary') IS NOT NULL")).scalar()
+		admission_summary_state['checked_at'] = now
+	return admission_summary_state['installed']
+
+
+def admission_summary_sql(conn, alias='a'):
+	"""
+	SQL fragments that add the per-admission counts to a query over
+	wl2822.admission {alias}: {'summary_columns': ..., 'summary_join': ...}.
+	Without the summary table each count is a correlated COUNT(*), which is
+	still one indexed lookup per admission rather than a join fan-out.
+	"""
+	if admission_summary_installed(conn):
+		return {
+			'summary_columns': ",\n\t\t\t".join(
+				f"COALESCE(s.{column}, 0) as {column}" for column in ADMISSION_SUMMARY_COLUMNS),
+			'summary_join': f"LEFT JOIN wl2822.admission_summary s ON s.hadm_id = {alias}.hadm_id"
+		}
+	return {
+		'summary_columns': ",\n\t\t\t".join(
+			f"(SELECT COUNT(*) FROM wl2822.{table} x WHERE x.hadm_id = {alias}.hadm_id) as {column}"
+			for column, table in ADMISSION_SUMMARY_COLUMNS.items()),
+		'summary_join': ''
+	}
+
+
+def refresh_admission_summary(conn):
+	"""
+	Recompute every row of wl2822.admission_summary from the child tables.
+	Writers are blocked meanwhile so no trigger update is lost.
+	"""
+	for table in ['admission'] + list(ADMISSION_SUMMARY_COLUMNS.values()):
+		conn.execute(text(f"LOCK TABLE wl2822.{table} IN SHARE ROW EXCLUSIVE MODE"))
+	conn.execute(text("TRUNCATE wl2822.admission_summary"))
+	conn.execute(text(
+		"INSERT INTO wl2822.admission_summary (hadm_id, " + ", ".join(ADMISSION_SUMMARY_COLUMNS) + ")\n"
+		"SELECT a.hadm_id, " + ", ".join(f"COALESCE({column}.n, 0)" for column in ADMISSION_SUMMARY_COLUMNS) + "\n"
+		"FROM wl2822.admission a\n" + "\n".join(
+			f"LEFT JOIN (SELECT hadm_id, COUNT(*) as n FROM wl2822.{table} GROUP BY hadm_id) {column} "
+			f"ON {column}.hadm_id = a.hadm_id"
+			for column, table in ADMISSION_SUMMARY_COLUMNS.items())))
+
+
+def install_admission_summary(conn):
+	"""
+	Create wl2822.admission_summary and the triggers that maintain it, then
+	fill it. Each INSERT/UPDATE/DELETE statement on a child table adjusts
+	the counts of the admissions it touched, grouped from its transition
+	tables, so bulk loads cost one summary upsert per statement.
+	"""
+	conn.execute(text("""
+		CREATE TABLE IF NOT EXISTS wl2822.admission_summary (
+			hadm_id INTEGER PRIMARY KEY,
+			diagnosis_count INTEGER NOT NULL DEFAULT 0,
+			prescription_count INTEGER NOT NULL DEFAULT 0,
+			procedure_count INTEGER NOT NULL DEFAULT 0,
+			image_count INTEGER NOT NULL DEFAULT 0,
+			order_count INTEGER NOT NULL DEFAULT 0
+		)
+	"""))
+	# TG_ARGV[0] is the summary column the child table feeds
+	conn.execute(text("""
+		CREATE OR REPLACE FUNCTION wl2822.admission_summary_add() RETURNS trigger AS $$
+		BEGIN
+			EXECUTE format('
+				INSERT INTO wl2822.admission_summary AS s (hadm_id, %1$I)
+				SELECT hadm_id, COUNT(*) FROM new_rows WHERE hadm_id IS NOT NULL GROUP BY hadm_id
+				ON CONFLICT (hadm_id) DO UPDATE SET %1$I = s.%1$I + EXCLUDED.%1$I', TG_ARGV[0]);
+			RETURN NULL;
+		END $$ LANGUAGE plpgsql
+	"""))
+	conn.execute(text("""
+		CREATE OR REPLACE FUNCTION wl2822.admission_summary_remove() RETURNS trigger AS $$
+		BEGIN
+			EXECUTE format('
+				UPDATE wl2822.admission_summary s SET %1$I = s.%1$I - d.n
+				FROM (SELECT hadm_id, COUNT(*) as n FROM old_rows GROUP BY hadm_id) d
+				WHERE s.hadm_id = d.hadm_id', TG_ARGV[0]);
+			RETURN NULL;
+		END $$ LANGUAGE plpgsql
+	"""))
+	conn.execute(text("""
+		CREATE OR REPLACE FUNCTION wl2822.admission_summary_move() RETURNS trigger AS $$
+		BEGIN
+			-- Only admissions whose count changed are touched
+			EXECUTE format('
+				UPDATE wl2822.admission_summary s SET %1$I = s.%1$I - d.n
+				FROM (SELECT hadm_id, COUNT(*) as n FROM old_rows GROUP BY hadm_id
+					EXCEPT ALL SELECT hadm_id, COUNT(*) FROM new_rows GROUP BY hadm_id) d
+				WHERE s.hadm_id = d.hadm_id', TG_ARGV[0]);
+			EXECUTE format('
+				INSERT INTO wl2822.admission_summary AS s (hadm_id, %1$I)
+				SELECT hadm_id, n FROM (SELECT hadm_id, COUNT(*) as n FROM new_rows WHERE hadm_id IS NOT NULL GROUP BY hadm_id
+					EXCEPT ALL SELECT hadm_id, COUNT(*) FROM old_rows GROUP BY hadm_id) d
+				ON CONFLICT (hadm_id) DO UPDATE SET %1$I = s.%1$I + EXCLUDED.%1$I', TG_ARGV[0]);
+			RETURN NULL;
+		END $$ LANGUAGE plpgsql
+	"""))
+	conn.execute(text("""
+		CREATE OR REPLACE FUNCTION wl2822.admission_summary_clear() RETURNS trigger AS $$
+		BEGIN
+			IF TG_ARGV[0] = 'admission' THEN
+				DELETE FROM wl2822.admission_summary;
+			ELSE
+				EXECUTE format('UPDATE wl2822.admission_summary SET %1$I = 0 WHERE %1$I <> 0', TG_ARGV[0]);
+			END IF;
+			RETURN NULL;
+		END $$ LANGUAGE plpgsql
+	"""))
+	conn.execute(text("""
+		CREATE OR REPLACE FUNCTION wl2822.admission_summary_drop() RETURNS trigger AS $$
+		BEGIN
+			DELETE FROM wl2822.admission_summary s USING old_rows o WHERE s.hadm_id = o.hadm_id;
+			RETURN NULL;
+		END $$ LANGUAGE plpgsql
+	"""))
+
+	for column, table in ADMISSION_SUMMARY_COLUMNS.items():
+		for event_name, transition, function in (
+			('INSERT', 'NEW TABLE AS new_rows', 'admission_summary_add'),
+			('DELETE', 'OLD TABLE AS old_rows', 'admission_summary_remove'),
+			('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows', 'admission_summary_move')):
+			conn.execute(text(f"DROP TRIGGER IF EXISTS {function} ON wl2822.{table}"))
+			conn.execute(text(f"""
+				CREATE TRIGGER {function} AFTER {event_name} ON wl2822.{table}
+				REFERENCING {transition}
+				FOR EACH STATEMENT EXECUTE FUNCTION wl2822.{function}('{column}')
+			"""))
+		conn.execute(text(f"DROP TRIGGER IF EXISTS admission_summary_clear ON wl2822.{table}"))
+		conn.execute(text(f"""
+			CREATE TRIGGER admission_summary_clear AFTER TRUNCATE ON wl2822.{table}
+			FOR EACH STATEMENT EXECUTE FUNCTION wl2822.admission_summary_clear('{column}')
+		"""))
+
+	# Deleted admissions lose their summary row
+	conn.execute(text("DROP TRIGGER IF EXISTS admission_summary_drop ON wl2822.admission"))
+	conn.execute(text("""
+		CREATE TRIGGER admission_summary_drop AFTER DELETE ON wl2822.admission
+		REFERENCING OLD TABLE AS old_rows
+		FOR EACH STATEMENT EXECUTE FUNCTION wl2822.admission_summary_drop()
+	"""))
+	conn.execute(text("DROP TRIGGER IF EXISTS admission_summary_clear ON wl2822.admission"))
+	conn.execute(text("""
+		CREATE TRIGGER admission_summary_clear AFTER TRUNCATE ON wl2822.admission
+		FOR EACH STATEMENT EXECUTE FUNCTION wl2822.admission_summary_clear('admission')
+	"""))
+
+	refresh_admission_summary(conn)
+
+
+# ==========================================
+# CONDITIONAL GET
+# ==========================================
+
+#
+# wl2822.data_versions keeps a version counter per patient and per
+# condition, bumped by statement-level triggers on every table their detail
+# pages read. The pages send it as their ETag and its time as Last-Modified,
+# so a browser or proxy revalidating a copy it already has gets a 304 after
+# one primary-key lookup instead of the page's queries and rendering.
+# Catalog tables whose rows show on many pages (condition names on a
+# patient's diagnoses, ...) have one version for the whole table, and each
+# kind has an epoch that bulk loads bump instead of running the per-row
+# triggers. Installed with `python server.py install-data-versions`.
+#
+# List pages are sent with `Cache-Control: public, max-age=LIST_CACHE_MAX_AGE`
+# (seconds, 0 disables) so a reverse proxy can serve them.
+#
+# Table -> (version kind, key expression over the table's rows)
+DATA_VERSION_KEYS = {
+	'patient': (('patient', 'subject_id::text'),),
+	'admission': (('patient', 'subject_id::text'),),
+	'admission_diagnosis': (('patient', 'subject_id::text'), ('condition', "icd_code || '/' || icd_version")),
+	'prescription': (('patient', 'subject_id::text'),),
+	'procedures_performed': (('patient', 'subject_id::text'),),
+	'medical_images': (('patient', 'subject_id::text'),),
+	'orders': (('patient', 'subject_id::text'),),
+	'condition': (('condition', "icd_code || '/' || icd_version"),)
+}
+
+# Tables versioned as a whole
+DATA_VERSION_TABLES = ('patient', 'admission', 'condition', 'medication', 'procedures')
+
+# Page kind -> whole-table versions its pages also depend on
+DATA_VERSION_DEPENDENCIES = {
+	'patient': ('condition', 'medication', 'procedures'),
+	'condition': ('patient', 'admission')
+}
+
+# Seconds before a missing data_versions table is looked for again
+DATA_VERSIONS_RECHECK = 60
+
+LIST_CACHE_MAX_AGE = env_int('LIST_CACHE_MAX_AGE', 60)
+LIST_PAGES = ('index', 'patients', 'conditions', 'admissions', 'analytics', 'medications', 'prescriptions', 'procedures')
+
+data_versions_state = {'installed': False, 'checked_at': None}
+
+
+def app_version():
+	"""
+	Digest of the code and templates, so a deploy changes every ETag
+	"""
+	digest = hashlib.sha1()
+	for path in [os.path.abspath(__file__)] + sorted(
+			os.path.join(tmpl_dir, name) for name in os.listdir(tmpl_dir)):
+		with open(path, 'rb') as f:
+			digest.update(f.read())
+	return digest.hexdigest()[:12]
+
+
+APP_VERSION = app_version()
+
+
+def data_versions_installed(conn):
+	"""
+	Whether wl2822.data_versions exists. A positive answer is kept for the
+	life of the process, a negative one for DATA_VERSIONS_RECHECK.
+	"""
+	now = time.monotonic()
+	checked_at = data_versions_state['checked_at']
+	if not data_versions_state['installed'] and (checked_at is None or now - checked_at >= DATA_VERSIONS_RECHECK):
+		data_versions_state['installed'] = conn.execute(
+			text("SELECT to_regclass('wl2822.data_versions') IS NOT NULL")).scalar()
+		data_versions_state['checked_at'] = now
+	return data_versions_state['installed']
+
+
+def data_version_resets(tables):
+	"""
+	(kind, key) versions to bump when `tables` change wholesale (truncated
+	or bulk loaded): the epochs of the kinds they key and their own
+	whole-table versions
+	"""
+	resets = set()
+	for table in tables:
+		resets.update(('epoch', kind) for kind, _ in DATA_VERSION_KEYS.get(table, ()))
+		if table in DATA_VERSION_TABLES:
+			resets.add(('table', table))
+	return sorted(resets)
+
+
+def bump_data_versions(conn, versions):
+	conn.execute(text("""
+		INSERT INTO wl2822.data_versions AS v (kind, key, version, modified_at)
+		SELECT kind, key, 1, now() FROM unnest(CAST(:kinds AS text[]), CAST(:keys AS text[])) AS b (kind, key)
+		ORDER BY kind, key
+		ON CONFLICT (kind, key) DO UPDATE SET version = v.version + 1, modified_at = EXCLUDED.modified_at
+	"""), {'kinds': [kind for kind, _ in versions], 'keys': [key for _, key in versions]})
+
+
+def install_data_versions(conn):
+	"""
+	Create wl2822.data_versions and the triggers that bump it, and bump
+	every epoch so pages tagged before the install are revalidated
+	"""
+	conn.execute(text("""
+		CREATE TABLE IF NOT EXISTS wl2822.data_versions (
+			kind TEXT NOT NULL,
+			key TEXT NOT NULL,
+			version BIGINT NOT NULL,
+			modified_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+			PRIMARY KEY (kind, key)
+		)
+	"""))
+	# Arguments are (kind, key expression) pairs. Keys are upserted in
+	# order, so concurrent writers lock shared version rows in the same order.
+	conn.execute(text("""
+		CREATE OR REPLACE FUNCTION wl2822.data_versions_touch() RETURNS trigger AS $$
+		DECLARE
+			changed TEXT;
+			i INT := 0;
+		BEGIN
+			changed := CASE TG_OP
+				WHEN 'INSERT' THEN 'SELECT * FROM new_rows'
+				WHEN 'DELETE' THEN 'SELECT * FROM old_rows'
+				ELSE 'SELECT * FROM new_rows UNION ALL SELECT * FROM old_rows' END;
+			WHILE i < TG_NARGS LOOP
+				EXECUTE format('
+					INSERT INTO wl2822.data_versions AS v (kind, key, version, modified_at)
+					SELECT DISTINCT %L, %s, 1::bigint, now() FROM (%s) c WHERE %2$s IS NOT NULL ORDER BY 2
+					ON CONFLICT (kind, key) DO UPDATE SET version = v.version + 1, modified_at = EXCLUDED.modified_at',
+					TG_ARGV[i], TG_ARGV[i + 1], changed);
+				i := i + 2;
+			END LOOP;
+			RETURN NULL;
+		END $$ LANGUAGE plpgsql
+	"""))
+	# Arguments are (kind, key) pairs to bump
+	conn.execute(text("""
+		CREATE OR REPLACE FUNCTION wl2822.data_versions_reset() RETURNS trigger AS $$
+		DECLARE
+			i INT := 0;
+		BEGIN
+			WHILE i < TG_NARGS LOOP
+				INSERT INTO wl2822.data_versions AS v (kind, key, version, modified_at)
+				VALUES (TG_ARGV[i], TG_ARGV[i + 1], 1, now())
+				ON CONFLICT (kind, key) DO UPDATE SET version = v.version + 1, modified_at = EXCLUDED.modified_at;
+				i := i + 2;
+			END LOOP;
+			RETURN NULL;
+		END $$ LANGUAGE plpgsql
+	"""))
+
+	for table in sorted(set(DATA_VERSION_KEYS) | set(DATA_VERSION_TABLES)):
+		keys = list(DATA_VERSION_KEYS.get(table, ()))
+		if table in DATA_VERSION_TABLES:
+			keys.append(('table', f"'{table}'"))
+		touch_args = ', '.join(f"'{value}'" for pair in keys for value in (pair[0], pair[1].replace("'", "''")))
+		for event_name, transition, trigger in (
+			('INSERT', 'NEW TABLE AS new_rows', 'data_versions_insert'),
+			('DELETE', 'OLD TABLE AS old_rows', 'data_versions_delete'),
+			('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows', 'data_versions_update')):
+			conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger} ON wl2822.{table}"))
+			conn.execute(text(f"""
+				CREATE TRIGGER {trigger} AFTER {event_name} ON wl2822.{table}
+				REFERENCING {transition}
+				FOR EACH STATEMENT EXECUTE FUNCTION wl2822.data_versions_touch({touch_args})
+			"""))
+		reset_args = ', '.join(f"'{value}'" for pair in data_version_resets([table]) for value in pair)
+		conn.execute(text(f"DROP TRIGGER IF EXISTS data_versions_truncate ON wl2822.{table}"))
+		conn.execute(text(f"""
+			CREATE TRIGGER data_versions_truncate AFTER TRUNCATE ON wl2822.{table}
+			FOR EACH STATEMENT EXECUTE FUNCTION wl2822.data_versions_reset({reset_args})
+		"""))
+
+	bump_data_versions(conn, [('epoch', kind) for kind in DATA_VERSION_DEPENDENCIES])
+
+
+# The latest version of the most recently served pages, {(kind, key):
+# (ETag, Last-Modified)}
+LAST_PAGE_VERSIONS = 10000
+last_page_versions = OrderedDict()
+last_page_versions_lock = threading.Lock()
+
+
+def page_version(kind, key, daily=False):
+	"""
+	(ETag, Last-Modified) of the detail page of one patient or condition,
+	or None when data_versions is not installed. `daily` pages also change
+	at midnight (ages are computed from today's date).
+	"""
+	try:
+		if not data_versions_installed(g.conn):
+			return None
+		wanted = [(kind, key), ('epoch', kind)] + [('table', table) for table in DATA_VERSION_DEPENDENCIES[kind]]
+		query = text("SELECT kind, key, version, modified_at FROM wl2822.data_versions WHERE "
+			+ " OR ".join(f"(kind = :kind{i} AND key = :key{i})" for i in range(len(wanted))))
+		params = {}
+		for i, (wanted_kind, wanted_key) in enumerate(wanted):
+			params[f'kind{i}'], params[f'key{i}'] = wanted_kind, wanted_key
+		found = {(row.kind, row.key): row for row in g.conn.execute(query, params)}
+	except Exception as e:
+		print(f"Error reading the {kind} version: {e}")
+		g.conn.rollback()
+		# While the database is down, the last version seen still finds the
+		# page's cached results
+		version = last_page_versions.get((kind, key))
+		if version is not None and isinstance(e, (DatabaseUnavailable, exc.OperationalError)):
+			g.result_cache_salt = version[0]
+			return version
+		return None
+
+	versions = [str(found[item].version) if item in found else '0' for item in wanted]
+	modified = [found[item].modified_at for item in wanted if item in found]
+	if daily:
+		versions.append(date.today().isoformat())
+		modified.append(datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0))
+	etag = hashlib.sha1('/'.join([APP_VERSION, kind, key] + versions).encode()).hexdigest()[:20]
+	g.result_cache_salt = etag
+	version = etag, max(modified).replace(microsecond=0) if modified else None
+	with last_page_versions_lock:
+		last_page_versions[(kind, key)] = version
+		last_page_versions.move_to_end((kind, key))
+		if len(last_page_versions) > LAST_PAGE_VERSIONS:
+			last_page_versions.popitem(last=False)
+	return version
+
+
+def not_modified(version):
+	"""
+	A 304 response when the client's copy of the page is still `version`
+	"""
+	if version is None:
+		return None
+	etag, last_modified = version
+	if request.if_none_match:
+		current = request.if_none_match.contains(etag)
+	else:
+		current = request.if_modified_since is not None and last_modified is not None \
+			and last_modified <= request.if_modified_since
+	return tag_response(Response(status=304), version) if current else None
+
+
+def tag_response(response, version):
+	"""
+	Add the page's validators; clients revalidate before every reuse
+	"""
+	if version is not None and response.status_code in (200, 304):
+		etag, last_modified = version
+		response.set_etag(etag)
+		if last_modified is not None:
+			response.last_modified = last_modified
+		response.cache_control.no_cache = True
+	return response
+
+
+@app.after_request
+def list_cache_control(response):
+	"""
+	Let a reverse proxy serve list pages for LIST_CACHE_MAX_AGE seconds
+	"""
+	if LIST_CACHE_MAX_AGE > 0 and request.method == 'GET' and request.endpoint in LIST_PAGES \
+			and response.status_code == 200 and 'Cache-Control' not in response.headers:
+		response.cache_control.public = True
+		response.cache_control.max_age = LIST_CACHE_MAX_AGE
+	return response
+
+
+# ==========================================
+# PATIENT ROUTES
+# ==========================================
+
+# Age bounds are ranges on date_of_birth itself, applied before the join
+# rather than in HAVING after the GROUP BY
+PATIENTS_QUERY = FilterQuery("""
+		SELECT
+			p.subject_id,
+			p.sex,
+			p.date_of_birth,
+			p.race,
+			2110 - EXTRACT(YEAR FROM p.date_of_birth) as age,
+			COUNT(a.hadm_id) as admission_count
+		FROM wl2822.patient p
+		LEFT JOIN wl2822.admission a ON p.subject_id = a.subject_id
+		WHERE {where}
+			AND {keyset_condition}
+		GROUP BY p.subject_id, p.sex, p.date_of_birth, p.race
+		ORDER BY {order_by}
+		LIMIT :limit
+""", [
+	Filter('subject_id', 'p.subject_id = :subject_id', type=int),
+	Filter('sex', 'p.sex = :sex'),
+	Filter('race', 'p.race = :race'),
+	Filter('min_age', 'p.date_of_birth < :born_before', type=int, bind=born_before_age),
+	Filter('max_age', 'p.date_of_birth >= :born_from', type=int, bind=born_from_age)
+])
+
+
+@app.route('/patients')
+def patients():
+	"""
+	Patient list with search/filter functionality
+	"""
+	per_page = get_page_size()
+	direction, cursor = decode_cursor(request.args.get('cursor'), 1)
+	keyset_condition, order_by = PATIENTS_KEYSET.clause(direction)
+
+	# Build query with the filters from the URL
+	signature, params = PATIENTS_QUERY.bind(request.args)
+	query = PATIENTS_QUERY.statement(signature,
+		keyset_condition=keyset_condition,
+		order_by=order_by)
+
+	try:
+		result = g.conn.execute(query, {
+			**params,
+			'limit': per_page + 1,
+			**PATIENTS_KEYSET.params(cursor)
+		})
+		page = PATIENTS_KEYSET.page(result.fetchall(), per_page, direction)
+	except Exception as e:
+		print(f"Error fetching patients: {e}")
+		page = Page([], None, None)
+
+	return render_template("patients.html", patients=page.rows, page=page)
+
+
+#
+# How the patient timeline is delivered:
+#
+#     full    rendered once every admission's details are fetched
+#     stream  sent progressively: the demographics header as soon as the
+#             patient and admission rows are in, then each admission as its
+#             details arrive. The details are fetched in rounds:
+#             STREAM_DETAIL_BATCH admissions first, then twice as many as
+#             the round before, so the first admissions go out after a
+#             small round and a long history costs a few rounds (0 fetches
+#             them all in one round, before the first admission is sent)
+#     lazy    only the admission headers; each admission's details are
+#             fetched from /api/patient/<id>/admission/<hadm_id> when it is
+#             expanded
+#
+PATIENT_TIMELINE_MODES = ('full', 'stream', 'lazy')
+PATIENT_TIMELINE_MODE = os.environ.get('PATIENT_TIMELINE_MODE', 'stream')
+if PATIENT_TIMELINE_MODE not in PATIENT_TIMELINE_MODES:
+	raise ValueError(f"PATIENT_TIMELINE_MODE must be one of {', '.join(PATIENT_TIMELINE_MODES)}, not {PATIENT_TIMELINE_MODE!r}")
+STREAM_DETAIL_BATCH = env_int('STREAM_DETAIL_BATCH', 10)
+
+# Rendered at the points where a streamed page is flushed; never sent
+STREAM_FLUSH_MARKER = '\x1e'
+
+# A patient's admissions (chronological) with their full diagnosis,
+# prescription, procedure, image and order counts for the section headers
+PATIENT_ADMISSIONS_QUERY = """
+		SELECT a.*,
+		{summary_columns}
+		FROM wl2822.admission a
+		{summary_join}
+		WHERE a.subject_id = :subject_id {hadm_condition}
+		ORDER BY a.admission_intime DESC
+"""
+
+
+def group_by_admission(rows):
+	"""
+	Group result rows into lists keyed by their hadm_id, keeping row order
+	"""
+	grouped = {}
+	for row in rows:
+		grouped.setdefault(row.hadm_id, []).append(row)
+	return grouped
+
+
+def fetch_patient_admissions(conn, subject_id, hadm_id=None):
+	"""
+	The patient's admissions, or just `hadm_id` when given
+	"""
+	query = text(PATIENT_ADMISSIONS_QUERY.format(
+		hadm_condition='AND a.hadm_id = :hadm_id' if hadm_id is not None else '',
+		**admission_summary_sql(conn)))
+	return conn.execute(query, {'subject_id': subject_id, 'hadm_id': hadm_id}).fetchall()
+
+
+def fetch_section(conn, name, query, params):
+	"""
+	The rows of one timeline section grouped by hadm_id, or
+	SectionUnavailable when it misses its deadline
+	"""
+	return run_section(conn, name, lambda conn: group_by_admission(conn.execute(query, params).fetchall()))
+
+
+def fetch_admission_details(conn, admissions):
+	"""
+	The diagnoses, prescriptions, procedures, images and orders of
+	`admissions`, fetched for all of them at once, so it costs a fixed
+	number of queries no matter how many admissions there are. Returns one
+	detail dict per admission, in order.
+	"""
+	params = {'hadm_ids': [admission.hadm_id for admission in admissions]}
+	if not params['hadm_ids']:
+		return []
+
+	# Get diagnoses with condition names
+	diagnoses_query = text("""
+		SELECT ad.*, c.condition_name
+		FROM wl2822.admission_diagnosis ad
+		JOIN wl2822.condition c
+			ON ad.icd_code = c.icd_code
+			AND ad.icd_version = c.icd_version
+		WHERE ad.hadm_id = ANY(:hadm_ids)
+		ORDER BY ad.hadm_id, ad.rank
+	""")
+	diagnoses_by_admission = fetch_section(conn, 'diagnoses', diagnoses_query, params)
+
+	# Get prescriptions with medication details (first 20 per admission)
+	prescriptions_query = text("""
+		SELECT * FROM (
+			SELECT p.*, m.name as medication_name, m.strength, m.form,
+				ROW_NUMBER() OVER (PARTITION BY p.hadm_id ORDER BY p.start_time) as row_num
+			FROM wl2822.prescription p
+			JOIN wl2822.medication m ON p.medication_id = m.medication_id
+			WHERE p.hadm_id = ANY(:hadm_ids)
+		) ranked
+		WHERE row_num <= 20
+		ORDER BY hadm_id, row_num
+	""")
+	prescriptions_by_admission = fetch_section(conn, 'prescriptions', prescriptions_query, params)
+
+	# Get procedures with procedure names
+	procedures_query = text("""
+		SELECT pp.*, pr.procedure_name
+		FROM wl2822.procedures_performed pp
+		JOIN wl2822.procedures pr
+			ON pp.icd_code = pr.icd_code
+			AND pp.icd_version = pr.icd_version
+		WHERE pp.hadm_id = ANY(:hadm_ids)
+		ORDER BY pp.hadm_id, pp.procedure_date
+	""")
+	procedures_by_admission = fetch_section(conn, 'procedures', procedures_query, params)
+
+	# Get medical images
+	images_query = text("""
+		SELECT * FROM wl2822.medical_images
+		WHERE hadm_id = ANY(:hadm_ids)
+		ORDER BY hadm_id, acquisition_date
+	""")
+	images_by_admission = fetch_section(conn, 'images', images_query, params)
+
+	# Get orders (first 20 per admission)
+	orders_query = text("""
+		SELECT * FROM (
+			SELECT o.*,
+				ROW_NUMBER() OVER (PARTITION BY o.hadm_id ORDER BY o.order_time) as row_num
+			FROM wl2822.orders o
+			WHERE o.hadm_id = ANY(:hadm_ids)
+		) ranked
+		WHERE row_num <= 20
+		ORDER BY hadm_id, row_num
+	""")
+	orders_by_admission = fetch_section(conn, 'orders', orders_query, params)
+
+	def rows_of(rows_by_admission, hadm_id):
+		if isinstance(rows_by_admission, SectionUnavailable):
+			return rows_by_admission
+		return rows_by_admission.get(hadm_id, [])
+
+	# Compile all data for each admission
+	return [{
+		'admission': admission,
+		'diagnoses': rows_of(diagnoses_by_admission, admission.hadm_id),
+		'prescriptions': rows_of(prescriptions_by_admission, admission.hadm_id),
+		'procedures': rows_of(procedures_by_admission, admission.hadm_id),
+		'images': rows_of(images_by_admission, admission.hadm_id),
+		'orders': rows_of(orders_by_admission, admission.hadm_id)
+	} for admission in admissions]
+
+
+def detail_batches(admissions):
+	"""
+	`admissions` split into the rounds a streamed timeline fetches their
+	details in, each twice the size of the one before
+	"""
+	size = STREAM_DETAIL_BATCH if STREAM_DETAIL_BATCH > 0 else len(admissions)
+	start = 0
+	while start < len(admissions):
+		yield admissions[start:start + size]
+		start += size
+		size *= 2
+
+
+def stream_admission_details(conn, admissions):
+	"""
+	Yield the detail dicts of `admissions` as fetch_admission_details()
+	returns them. Each batch is fetched in one set-based round, only once
+	the template reaches it, so an admission is flushed as soon as its
+	round is in rather than after the details of the whole history.
+	"""
+	for batch in detail_batches(admissions):
+		yield from fetch_admission_details(conn, batch)
+
+
+def flushed_stream(chunks):
+	"""
+	Join a streamed template's small chunks into one write per
+	STREAM_FLUSH_MARKER. Once the first byte is out the status can no
+	longer change, so an error ends the page with a notice instead.
+	"""
+	buffer = []
+	try:
+		for chunk in chunks:
+			if STREAM_FLUSH_MARKER in chunk:
+				buffer.append(chunk.replace(STREAM_FLUSH_MARKER, ''))
+				yield ''.join(buffer)
+				buffer = []
+			else:
+				buffer.append(chunk)
+	except Exception as e:
+		print(f"Error streaming page: {e}")
+		import traceback
+		traceback.print_exc()
+		buffer.append('<div class="alert alert-danger">Error loading the rest of this page.</div>')
+	if buffer:
+		yield ''.join(buffer)
+
+
+@app.route('/patient/<int:subject_id>')
+def patient_detail(subject_id):
+	"""
+	Patient detail page with complete medical timeline
+	SHOWCASE PAGE - Complex multi-table JOINs
+	"""
+	version = page_version('patient', str(subject_id), daily=True)
+	response = not_modified(version)
+	if response is not None:
+		return response
+
+	try:
+		# 1. Get patient basic info
+		patient_query = text("SELECT * FROM wl2822.patient WHERE subject_id = :subject_id")
+		patient_result = g.conn.execute(patient_query, {'subject_id': subject_id})
+		patient = patient_result.fetchone()
+
+		if not patient:
+			return "Patient not found", 404
+
+		# 2. Get all admissions for this patient (chronological)
+		admissions = fetch_patient_admissions(g.conn, subject_id)
+
+		# Calculate patient age
+		if patient.date_of_birth:
+			today = date.today()
+			age = today.year - patient.date_of_birth.year - ((today.month, today.day) < (patient.date_of_birth.month, patient.date_of_birth.day))
+		else:
+			age = None
+
+		context = {
+			'patient': patient,
+			'age': age,
+			'total_admissions': len(admissions),
+			'timeline_mode': PATIENT_TIMELINE_MODE
+		}
+
+		# 3. Fetch the details of the admissions, keyed on their hadm_ids
+		if PATIENT_TIMELINE_MODE == 'lazy':
+			admission_details = [{'admission': admission} for admission in admissions]
+		elif PATIENT_TIMELINE_MODE == 'stream':
+			# The headers go out before the details are fetched, so the page
+			# cannot vouch for its sections and is sent without validators
+			response = Response(flushed_stream(stream_template("patient_detail.html",
+				admission_details=stream_admission_details(g.conn, admissions),
+				flush_marker=STREAM_FLUSH_MARKER,
+				**context)), mimetype='text/html')
+			response.cache_control.no_cache = True
+			return response
+		else:
+			admission_details = fetch_admission_details(g.conn, admissions)
+
+		response = make_response(render_template("patient_detail.html",
+			admission_details=admission_details,
+			**context))
+		# A page missing a section must not be revalidated as complete
+		if any(is_unavailable(value) for detail in admission_details for value in detail.values()):
+			return response
+		return tag_response(response, version)
+
+	except Exception as e:
+		print(f"Error fetching patient details: {e}")
+		import traceback
+		traceback.print_exc()
+		return f"Error loading patient: {str(e)}", 500
+
+
+@app.route('/api/patient/<int:subject_id>/admission/<int:hadm_id>')
+def patient_admission(subject_id, hadm_id):
+	"""
+	The details of one admission of a patient timeline as an HTML fragment
+	in JSON, for timelines that load them when an admission is expanded
+	"""
+	version = page_version('patient', str(subject_id))
+	response = not_modified(version)
+	if response is not None:
+		return response
+
+	try:
+		admissions = fetch_patient_admissions(g.conn, subject_id, hadm_id)
+		detail = fetch_admission_details(g.conn, admissions)[0] if admissions else None
+		response = jsonify(hadm_id=hadm_id,
+			html=render_template("patient_admission_body.html", detail=detail)) if detail else None
+	except Exception as e:
+		print(f"Error fetching admission {hadm_id} of patient {subject_id}: {e}")
+		status = 503 if isinstance(e, (DatabaseUnavailable, exc.OperationalError)) else 500
+		return jsonify(hadm_id=hadm_id, error=str(e).splitlines()[0] if str(e) else type(e).__name__), status
+
+	if detail is None:
+		abort(404)
+	# A fragment missing a section must not be revalidated as complete
+	if any(is_unavailable(value) for value in detail.values()):
+		return response
+	return tag_response(response, version)
+
+
+# ==========================================
+# CATALOG SEARCH INDEX
+# ==========================================
+
+# Seconds before a catalog index is rebuilt on its next use
+SEARCH_INDEX_TTL = env_int('SEARCH_INDEX_TTL', 3600)
+
+
+def trigrams(value):
+	"""
+	Set of the three-character substrings of a lowercased string
+	"""
+	return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class TrigramIndex:
+	"""
+	In-memory trigram index over one of the small, mostly static catalogs
+	(conditions, medications, procedures). A search term is matched as a
+	case-insensitive substring of any of the indexed columns, like
+	LOWER(col) LIKE '%term%', but candidates come from the intersection of
+	the term's trigram posting lists instead of a sequential scan.
+
+	The index is built lazily on first use, rebuilt after SEARCH_INDEX_TTL
+	seconds, and can be rebuilt at any time with reload().
+	"""
+
+	def __init__(self, name, query, key_columns, text_columns, label):
+		self.name = name
+		self.query = query
+		self.key_columns = key_columns
+		self.text_columns = text_columns
+		self.label = label
+		self.lock = threading.Lock()
+		self.loaded_at = None
+		self.keys = []
+		self.labels = []
+		self.texts = []
+		self.postings = {}
+
+	def reload(self):
+		"""
+		Rebuild the index from the database
+		"""
+		with connect_primary() as conn:
+			rows = conn.execute(text(self.query)).fetchall()
+
+		keys, labels, texts, postings = [], [], [], {}
+		for doc_id, row in enumerate(rows):
+			fields = [str(getattr(row, column)).lower() for column in self.text_columns
+				if getattr(row, column) is not None]
+			keys.append(tuple(getattr(row, column) for column in self.key_columns))
+			labels.append(self.label(row))
+			texts.append(fields)
+			for gram in set().union(*(trigrams(field) for field in fields)):
+				postings.setdefault(gram, []).append(doc_id)
+
+		with self.lock:
+			self.keys, self.labels, self.texts, self.postings = keys, labels, texts, postings
+			self.loaded_at = time.time()
+
+	def ensure_loaded(self):
+		if self.loaded_at is None or time.time() - self.loaded_at > SEARCH_INDEX_TTL:
+			self.reload()
+
+	def invalidate(self):
+		"""
+		Rebuild on next use
+		"""
+		with self.lock:
+			self.loaded_at = None
+
+	def _candidates(self, term):
+		grams = trigrams(term)
+		if not grams:
+			# Too short for trigrams: the catalog is small enough to scan
+			return range(len(self.keys))
+		lists = sorted((self.postings.get(gram, []) for gram in grams), key=len)
+		candidates = set(lists[0])
+		for posting in lists[1:]:
+			if len(candidates) < 64:
+				break
+			candidates.intersection_update(posting)
+		return candidates
+
+	def _matches(self, term):
+		"""
+		Ranked (rank, doc_id) pairs of the entries containing the term
+		"""
+		term = term.strip().lower()
+		matches = []
+		for doc_id in self._candidates(term):
+			best = None
+			for field in self.texts[doc_id]:
+				position = field.find(term)
+				if position < 0:
+					continue
+				# exact match, then prefix, then word start, then anywhere
+				if field == term:
+					rank = 0
+				elif position == 0:
+					rank = 1
+				elif not field[position - 1].isalnum():
+					rank = 2
+				else:
+					rank = 3
+				best = rank if best is None else min(best, rank)
+			if best is not None:
+				matches.append((best, len(self.labels[doc_id]), doc_id))
+		matches.sort()
+		return matches
+
+	def search(self, term):
+		"""
+		Keys of every entry whose indexed columns contain the term, best
+		matches first
+		"""
+		self.ensure_loaded()
+		with self.lock:
+			return [self.keys[doc_id] for _, _, doc_id in self._matches(term)]
+
+	def suggest(self, term, limit=10):
+		"""
+		Top (key, label) pairs for a typeahead box
+		"""
+		self.ensure_loaded()
+		with self.lock:
+			return [(self.keys[doc_id], self.labels[doc_id]) for _, _, doc_id in self._matches(term)[:limit]]
+
+
+condition_index = TrigramIndex('condition',
+	"SELECT icd_code, icd_version, condition_name FROM wl2822.condition",
+	key_columns=['icd_code', 'icd_version'],
+	text_columns=['condition_name', 'icd_code'],
+	label=lambda row: row.condition_name)
+
+medication_index = TrigramIndex('medication',
+	"SELECT medication_id, name, strength FROM wl2822.medication",
+	key_columns=['medication_id'],
+	text_columns=['name'],
+	label=lambda row: f"{row.name} ({row.strength})" if row.strength else row.name)
+
+procedure_index = TrigramIndex('procedure',
+	"SELECT icd_code, icd_version, procedure_name FROM wl2822.procedures",
+	key_columns=['icd_code', 'icd_version'],
+	text_columns=['procedure_name', 'icd_code'],
+	label=lambda row: row.procedure_name)
+
+SEARCH_INDEXES = {index.name: index for index in (condition_index, medication_index, procedure_index)}
+
+
+def reload_search_indexes():
+	"""
+	Rebuild every catalog index, e.g. after the catalogs were reloaded
+	"""
+	for index in SEARCH_INDEXES.values():
+		index.reload()
+
+
+def icd_key_params(keys):
+	"""
+	Split (icd_code, icd_version) keys into the two arrays bound by
+	`IN (SELECT * FROM unnest(:codes, :versions))`
+	"""
+	return {
+		'codes': [code for code, _ in keys],
+		'versions': [version for _, version in keys]
+	}
+
+
+def suggestion_url(kind, key, label):
+	if kind == 'medication':
+		return url_for('prescriptions', medication_name=label.split(' (')[0])
+	if kind == 'condition':
+		return url_for('condition_detail', icd_code=key[0], icd_version=key[1])
+	return url_for('procedures', search=key[0])
+
+
+@app.route('/api/suggest')
+def suggest():
+	"""
+	Typeahead suggestions from the catalog indexes as JSON.
+	?q= is the search term, ?type= one of condition, medication or procedure
+	(all three by default), ?limit= the number of suggestions per type.
+	"""
+	term = request.args.get('q', '').strip()
+	kinds = [request.args.get('type')] if request.args.get('type') else list(SEARCH_INDEXES)
+	limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+	if any(kind not in SEARCH_INDEXES for kind in kinds):
+		abort(400)
+
+	suggestions = []
+	if term:
+		for kind in kinds:
+			for key, label in SEARCH_INDEXES[kind].suggest(term, limit):
+				suggestions.append({
+					'type': kind,
+					'key': [json_safe(part) for part in key],
+					'label': label,
+					'url': suggestion_url(kind, key, label)
+				})
+	return jsonify(query=term, suggestions=suggestions)
+
+
+@app.route('/api/search/reload', methods=['POST'])
+@admin_only
+def reload_search():
+	"""
+	Rebuild the catalog indexes after the catalogs change
+	"""
+	# Drops what else was read from the catalogs, here and in the other
+	# workers, which rebuild their indexes on next use
+	invalidate_caches(list(SEARCH_INDEX_SOURCES))
+	reload_search_indexes()
+	return jsonify({name: len(index.keys) for name, index in SEARCH_INDEXES.items()})
+
+
+# ==========================================
+# CONDITION ROUTES
+# ==========================================
+
+# Complex analytics query with JOINs and aggregations. A search restricts
+# the aggregation to the conditions the search index matched.
+CONDITIONS_QUERY = FilterQuery("""
+		SELECT
+			c.icd_code,
+			c.icd_version,
+			c.condition_name,
+			COUNT(DISTINCT ad.subject_id) as patient_count,
+			COUNT(ad.hadm_id) as diagnosis_count,
+			MIN(ad.diagnosed_on) as first_diagnosis,
+			MAX(ad.diagnosed_on) as latest_diagnosis
+		FROM wl2822.condition c
+		LEFT JOIN wl2822.admission_diagnosis ad
+			ON c.icd_code = ad.icd_code
+			AND c.icd_version = ad.icd_version
+		WHERE {where}
+		GROUP BY c.icd_code, c.icd_version, c.condition_name
+		ORDER BY patient_count DESC NULLS LAST, diagnosis_count DESC
+		LIMIT 100
+""", [
+	Filter('search', """(c.icd_code, c.icd_version) IN (
+				SELECT * FROM unnest(CAST(:codes AS TEXT[]), CAST(:versions AS INTEGER[])))""",
+		bind=lambda search: icd_key_params(condition_index.search(search)))
+])
+
+
+@app.route('/conditions')
+def conditions():
+	"""
+	Condition analytics browser - SHOWCASE PAGE
+	Displays conditions with patient counts and diagnosis statistics
+	"""
+	search = request.args.get('search', '')
+
+	try:
+		signature, params = CONDITIONS_QUERY.bind(request.args)
+		result = g.conn.execute(CONDITIONS_QUERY.statement(signature), params)
+		conditions = result.fetchall()
+	except Exception as e:
+		print(f"Error fetching conditions: {e}")
+		import traceback
+		traceback.print_exc()
+		conditions = []
+
+	return render_template("conditions.html", conditions=conditions, search=search)
+
+
+# Patients diagnosed with a condition, shared by /condition/<icd>/<ver>
+# and its export
+CONDITION_PATIENTS_QUERY = """
+		SELECT
+			p.subject_id,
+			p.sex,
+			p.date_of_birth,
+			p.race,
+			2110 - EXTRACT(YEAR FROM p.date_of_birth) as age,
+			ad.hadm_id,
+			ad.diagnosed_on,
+			ad.rank,
+			a.admission_intime,
+			a.admission_type
+		FROM wl2822.admission_diagnosis ad
+		JOIN wl2822.patient p ON ad.subject_id = p.subject_id
+		JOIN wl2822.admission a ON ad.hadm_id = a.hadm_id
+		WHERE ad.icd_code = :icd_code AND ad.icd_version = :icd_version
+		ORDER BY ad.diagnosed_on DESC, ad.rank
+		{limit_clause}
+"""
+
+
+@app.route('/condition/<icd_code>/<int:icd_version>')
+def condition_detail(icd_code, icd_version):
+	"""
+	Detailed view of a specific condition showing all diagnosed patients
+	"""
+	version = page_version('condition', f'{icd_code}/{icd_version}')
+	response = not_modified(version)
+	if response is not None:
+		return response
+
+	try:
+		params = {
+			'icd_code': icd_code,
+			'icd_version': icd_version
+		}
+		# The condition, its patients and its statistics are independent
+		# lookups, so they run concurrently
+		results = run_parallel({
+			# Get condition info
+			'condition': fetch_rows("""
+				SELECT * FROM wl2822.condition
+				WHERE icd_code = :icd_code AND icd_version = :icd_version
+			""", params),
+
+			# Get all patients diagnosed with this condition
+			'patients': lambda conn: run_section(conn, 'condition_patients',
+				fetch_rows(CONDITION_PATIENTS_QUERY.format(limit_clause='LIMIT 200'), params)),
+
+			# Get statistics
+			'stats': lambda conn: run_section(conn, 'condition_stats', fetch_rows("""
+				SELECT
+					COUNT(DISTINCT subject_id) as total_patients,
+					COUNT(*) as total_diagnoses,
+					AVG(rank) as avg_rank,
+					MIN(diagnosed_on) as first_diagnosis,
+					MAX(diagnosed_on) as latest_diagnosis
+				FROM wl2822.admission_diagnosis
+				WHERE icd_code = :icd_code AND icd_version = :icd_version
+			""", params))
+		}, g.conn)
+
+		if not results['condition']:
+			return "Condition not found", 404
+
+		stats = results['stats'][0] if results['stats'] else results['stats']
+		response = make_response(render_template("condition_detail.html",
+			condition=results['condition'][0],
+			patients=results['patients'],
+			stats=stats))
+		# A page missing a section must not be revalidated as complete
+		if is_unavailable(stats) or is_unavailable(results['patients']):
+			return response
+		return tag_response(response, version)
+
+	except (DatabaseUnavailable, exc.OperationalError) as e:
+		print(f"Error fetching condition details: {e}")
+		return f"Database unavailable: {str(e).splitlines()[0]}", 503
+
+	except Exception as e:
+		print(f"Error fetching condition details: {e}")
+		import traceback
+		traceback.print_exc()
+		return f"Error loading condition: {str(e)}", 500
+
+
+# ==========================================
+# ADMISSION ROUTES
+# ==========================================
+
+# Admission list query shared by /admissions and its export. The keyset
+# condition, sort order and limit are filled in per use.
+ADMISSIONS_QUERY = FilterQuery("""
+		SELECT
+			a.*,
+			p.sex,
+			p.race,
+			2110 - EXTRACT(YEAR FROM p.date_of_birth) as patient_age,
+			{summary_columns}
+		FROM wl2822.admission a
+		JOIN wl2822.patient p ON a.subject_id = p.subject_id
+		{summary_join}
+		WHERE {where}
+			AND {keyset_condition}
+		ORDER BY {order_by}
+		{limit_clause}
+""", [
+	Filter('hadm_id', 'a.hadm_id = :hadm_id', type=int),
+	Filter('subject_id', 'a.subject_id = :subject_id', type=int),
+	Filter('admission_type', 'a.admission_type = :admission_type'),
+	Filter('admission_location', 'a.admission_location = :admission_location'),
+	Filter('from_date', 'a.admission_intime >= :from_date', type=iso_date),
+	Filter('to_date', 'a.admission_intime <= :to_date', type=iso_date)
+])
+
+
+@app.route('/admissions')
+def admissions():
+	"""
+	Admission search and browse functionality
+	"""
+	per_page = get_page_size()
+	direction, cursor = decode_cursor(request.args.get('cursor'), 2)
+	keyset_condition, order_by = ADMISSIONS_KEYSET.clause(direction)
+
+	try:
+		# Build query with filters; the counts come from the admission summary
+		signature, params = ADMISSIONS_QUERY.bind(request.args)
+		query = ADMISSIONS_QUERY.statement(signature,
+			keyset_condition=keyset_condition,
+			order_by=order_by,
+			limit_clause='LIMIT :limit',
+			**admission_summary_sql(g.conn))
+
+		result = g.conn.execute(query, {
+			**params,
+			'limit': per_page + 1,
+			**ADMISSIONS_KEYSET.params(cursor)
+		})
+		page = ADMISSIONS_KEYSET.page(result.fetchall(), per_page, direction)
+	except Exception as e:
+		print(f"Error fetching admissions: {e}")
+		import traceback
+		traceback.print_exc()
+		g.conn.rollback()
+		page = Page([], None, None)
+
+	# Get admission types and locations for filter dropdowns
+	try:
+		admission_types = facet_cache.get(g.conn, 'admission', 'admission_type')
+		admission_locations = facet_cache.get(g.conn, 'admission', 'admission_location')
+	except Exception as e:
+		print(f"Error fetching filter options: {e}")
+		admission_types = []
+		admission_locations = []
+
+	return render_template("admissions.html",
+		admissions=page.rows,
+		page=page,
+		admission_types=admission_types,
+		admission_locations=admission_locations)
+
+
+# ==========================================
+# ANALYTICS DASHBOARD
+# ==========================================
+
+#
+# The dashboard aggregations, in the order they appear on the page.
+# They are materialized into the analytics_snapshot table by
+# refresh_analytics_snapshot() so a page view reads a handful of small
+# rows instead of scanning every table.
+#
+ANALYTICS_QUERIES = {
+	# 1. Top 10 most common diagnoses
+	'top_diagnoses': """
+		SELECT
+			c.condition_name,
+			c.icd_code,
+			COUNT(DISTINCT ad.subject_id) as patient_count,
+			COUNT(*) as total_diagnoses
+		FROM wl2822.condition c
+		JOIN wl2822.admission_diagnosis ad
+			ON c.icd_code = ad.icd_code
+			AND c.icd_version = ad.icd_version
+		GROUP BY c.condition_name, c.icd_code
+		ORDER BY patient_count DESC
+		LIMIT 10
+	""",
+
+	# 2. Top 10 most prescribed medications
+	'top_medications': """
+		SELECT
+			m.name as medication_name,
+			m.strength,
+			COUNT(*) as prescription_count
+		FROM wl2822.medication m
+		JOIN wl2822.prescription p ON m.medication_id = p.medication_id
+		GROUP BY m.name, m.strength
+		ORDER BY prescription_count DESC
+		LIMIT 10
+	""",
+
+	# 3. Admission statistics by type
+	'admission_stats': """
+		SELECT
+			admission_type,
+			COUNT(*) as admission_count,
+			COUNT(DISTINCT subject_id) as unique_patients,
+			AVG(EXTRACT(days FROM (admission_outtime::timestamp - admission_intime::timestamp))) as avg_length_days
+		FROM wl2822.admission
+		WHERE admission_outtime IS NOT NULL
+		GROUP BY admission_type
+		ORDER BY admission_count DESC
+	""",
+
+	# 4. Patient demographics breakdown
+	'demographics': """
+		SELECT
+			p.sex,
+			p.race,
+			COUNT(DISTINCT p.subject_id) as patient_count,
+			AVG(2110 - EXTRACT(YEAR FROM p.date_of_birth)) as avg_age
+		FROM wl2822.patient p
+		LEFT JOIN wl2822.admission a ON p.subject_id = a.subject_id
+		GROUP BY p.sex, p.race
+		ORDER BY patient_count DESC
+		LIMIT 15
+	""",
+
+	# 5. Medical imaging statistics
+	'imaging_stats': """
+		SELECT
+			viewpoint,
+			COUNT(*) as image_count,
+			COUNT(DISTINCT subject_id) as patient_count
+		FROM wl2822.medical_images
+		GROUP BY viewpoint
+		ORDER BY image_count DESC
+	""",
+
+	# 6. Provider order statistics
+	'provider_stats': """
+		SELECT
+			p.provider_id,
+			COUNT(DISTINCT o.hadm_id) as admissions_served,
+			COUNT(o.poe_id) as total_orders,
+			COUNT(DISTINCT o.order_type) as order_types
+		FROM wl2822.provider p
+		LEFT JOIN wl2822.orders o ON p.provider_id = o.order_provider_id
+		GROUP BY p.provider_id
+		ORDER BY total_orders DESC
+		LIMIT 10
+	""",
+
+	# 7. Monthly admission trends (last 12 months of data)
+	'monthly_trends': """
+		SELECT
+			TO_CHAR(admission_intime, 'YYYY-MM') as month,
+			COUNT(*) as admission_count,
+			COUNT(DISTINCT subject_id) as unique_patients
+		FROM wl2822.admission
+		GROUP BY TO_CHAR(admission_intime, 'YYYY-MM')
+		ORDER BY month DESC
+		LIMIT 12
+	""",
+}
+
+# 8. Overall database statistics (stat name -> table)
+ANALYTICS_COUNT_TABLES = {
+	'patient_count': 'patient',
+	'admission_count': 'admission',
+	'prescription_count': 'prescription',
+	'condition_count': 'condition',
+	'medication_count': 'medication',
+	'image_count': 'medical_images',
+	'provider_count': 'provider',
+	'procedure_count': 'procedures_performed'
+}
+
+# Seconds between background snapshot refreshes; 0 disables the refresher
+ANALYTICS_REFRESH_INTERVAL = env_int('ANALYTICS_REFRESH_INTERVAL', 0)
+
+
+def json_safe(value):
+	"""
+	Convert database values (Decimal, date, datetime) into JSON-friendly ones
+	"""
+	if isinstance(value, Decimal):
+		return float(value)
+	if isinstance(value, (date, datetime)):
+		return value.isoformat()
+	return value
+
+
+def row_to_dict(row):
+	"""
+	Turn a result row into a plain dict of JSON-friendly values
+	"""
+	return {key: json_safe(value) for key, value in row._mapping.items()}
+
+
+def analytics_tasks():
+	"""
+	One task per dashboard section, for compute_analytics()
+	"""
+	def section(query):
+		return lambda conn: [row_to_dict(row) for row in conn.execute(text(query))]
+
+	tasks = {name: section(query) for name, query in ANALYTICS_QUERIES.items()}
+	# From the month rollup once it is installed
+	live_trends = tasks['monthly_trends']
+	tasks['monthly_trends'] = lambda conn: fetch_monthly_trends(conn) if rollups_installed(conn) else live_trends(conn)
+	# All eight counts in a single round trip
+	tasks['overall_stats'] = lambda conn: fetch_counts(conn, ANALYTICS_COUNT_TABLES)
+	return tasks
+
+
+def compute_analytics(conn, parallel=False, partial=False):
+	"""
+	Run every dashboard aggregation and return the template variables.
+	With `parallel` the aggregations run concurrently (see run_parallel);
+	with `partial` each is a page section, SectionUnavailable when it
+	misses its deadline.
+	"""
+	tasks = analytics_tasks()
+	if partial:
+		tasks = {name: lambda conn, name=name, task=task: run_section(conn, name, task)
+			for name, task in tasks.items()}
+	if parallel:
+		return run_parallel(tasks, conn)
+	return {name: task(conn) for name, task in tasks.items()}
+
+
+def ensure_analytics_snapshot_table(conn):
+	"""
+	Create the table that holds the materialized dashboard sections
+	"""
+	conn.execute(text("""
+		CREATE TABLE IF NOT EXISTS wl2822.analytics_snapshot (
+			section TEXT PRIMARY KEY,
+			payload JSONB NOT NULL,
+			refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+		)
+	"""))
+
+
+def refresh_analytics_snapshot():
+	"""
+	Recompute the dashboard and replace the stored snapshot in one
+	transaction. Returns the new refresh timestamp.
+	"""
+	with engine.begin() as conn:
+		ensure_analytics_snapshot_table(conn)
+		sections = compute_analytics(conn)
+		upsert = text("""
+			INSERT INTO wl2822.analytics_snapshot (section, payload, refreshed_at)
+			VALUES (:section, CAST(:payload AS JSONB), now())
+			ON CONFLICT (section) DO UPDATE
+			SET payload = EXCLUDED.payload, refreshed_at = EXCLUDED.refreshed_at
+		""")
+		for section, payload in sections.items():
+			conn.execute(upsert, {'section': section, 'payload': json.dumps(payload)})
+		refreshed_at = conn.execute(text("SELECT now()")).scalar()
+	if result_cache is not None:
+		result_cache.invalidate(['analytics_snapshot'])
+	return refreshed_at
+
+
+def load_analytics_snapshot(conn):
+	"""
+	Read the materialized dashboard. Returns (sections, refreshed_at), or
+	(None, None) when no complete snapshot has been stored yet.
+	"""
+	rows = conn.execute(text("""
+		SELECT section, payload, refreshed_at FROM wl2822.analytics_snapshot
+	""")).fetchall()
+	sections = {row.section: row.payload for row in rows}
+	if any(name not in sections for name in list(ANALYTICS_QUERIES) + ['overall_stats']):
+		return None, None
+	return sections, min(row.refreshed_at for row in rows)
+
+
+def start_analytics_refresher(interval):
+	"""
+	Refresh the analytics snapshot every `interval` seconds in a daemon thread
+	"""
+	def refresh_forever():
+		while True:
+			try:
+				refreshed_at = refresh_analytics_snapshot()
+				print(f"Analytics snapshot refreshed at {refreshed_at}")
+			except Exception as e:
+				print(f"Error refreshing analytics snapshot: {e}")
+				import traceback
+				traceback.print_exc()
+			time.sleep(interval)
+
+	thread = threading.Thread(target=refresh_forever, name='analytics-refresher', daemon=True)
+	thread.start()
+	return thread
+
+
+@app.route('/analytics')
+def analytics():
+	"""
+	Comprehensive analytics dashboard with multiple aggregation queries,
+	served from the precomputed snapshot when one exists
+	"""
+	try:
+		sections, data_as_of = load_analytics_snapshot(g.conn)
+	except Exception as e:
+		print(f"Analytics snapshot unavailable, computing live: {e}")
+		g.conn.rollback()
+		sections, data_as_of = None, None
+
+	try:
+		if sections is None:
+			sections = compute_analytics(g.conn, parallel=True, partial=True)
+
+		return render_template("analytics.html", data_as_of=data_as_of, **sections)
+
+	except Exception as e:
+		print(f"Error loading analytics: {e}")
+		import traceback
+		traceback.print_exc()
+		return f"Error loading analytics: {str(e)}", 500
+
+
+# ==========================================
+# TREND ROLLUPS
+# ==========================================
+
+#
+# Day, week and month rollups of admissions (with their distinct patients
+# and length of stay), prescriptions per medication and diagnoses per ICD
+# code, installed with `python server.py install-rollups`. /trends serves
+# any date range from them, and the dashboard's monthly trends read them
+# instead of grouping the whole admission table.
+#
+# They are kept current from a change log. Triggers on the source tables
+# write each inserted, deleted or updated row that counts towards a rollup
+# to wl2822.rollup_changes, signed +1 or -1, in the transaction that makes
+# the change. A refresh takes a source's pending changes off the log and
+# adds them to its rollups in one transaction, so every change is counted
+# once, whatever its key and whenever its transaction commits. Truncating
+# a source logs a reset, which the next refresh answers with a rebuild.
+#
+# A rebuild fills shadow copies of the rollup tables and swaps them in at
+# the end, so /trends reads the old ones meanwhile. Refreshes of a source
+# take turns on an advisory lock and run in one repeatable-read snapshot,
+# which a rebuild also aggregates the source from: changes committed after
+# it stay on the log for the next refresh, and writers never wait. Every
+# ROLLUP_VERIFY_INTERVAL seconds the rollups are compared bucket by bucket
+# with a fresh aggregation of their source, and a source that no longer
+# matches is rebuilt. `ingest` switches the triggers off and rebuilds the
+# loaded sources after (`refresh-rollups --full` rebuilds all).
+#
+#     ROLLUP_REFRESH_INTERVAL  seconds between background refreshes
+#                              (0 disables)
+#     ROLLUP_VERIFY_INTERVAL   seconds between verifications of a source
+#                              by the background refresher (0 disables)
+#     TRENDS_DEFAULT_PERIODS   periods /trends shows without a range
+#     TRENDS_MAX_PERIODS       periods one /trends request may span
+#
+ROLLUP_REFRESH_INTERVAL = env_int('ROLLUP_REFRESH_INTERVAL', 60)
+ROLLUP_VERIFY_INTERVAL = env_int('ROLLUP_VERIFY_INTERVAL', 86400)
+TRENDS_DEFAULT_PERIODS = env_int('TRENDS_DEFAULT_PERIODS', 12)
+TRENDS_MAX_PERIODS = env_int('TRENDS_MAX_PERIODS', 1000)
+
+ROLLUP_GRAINS = ('day', 'week', 'month')
+ROLLUP_GRAIN_ROWS = "(VALUES " + ", ".join(f"('{grain}')" for grain in ROLLUP_GRAINS) + ") g(grain)"
+
+# Period of a change `c` at grain `g`
+ROLLUP_PERIOD = "date_trunc(g.grain, c.happened_at)::date"
+
+# First key of the advisory locks serializing each source's refreshes
+ROLLUP_LOCK_SPACE = 2822
+
+# What a change records of its row; each source fills the columns its
+# rollups group or sum by
+ROLLUP_CHANGE_COLUMNS = [
+	('happened_at', 'TIMESTAMP'),
+	('subject_id', 'INTEGER'),
+	('length_days', 'INTEGER'),
+	('medication_id', 'INTEGER'),
+	('icd_code', 'TEXT'),
+	('icd_version', 'INTEGER')
+]
+
+# A rollup table: its (name, type) columns, its key, the measures a change
+# adds to, its secondary indexes ({name suffix: columns}), and the SELECT
+# of its rows from the signed changes in {rows}. A row goes when the first
+# measure, its count, reaches 0.
+RollupTable = namedtuple('RollupTable', ['columns', 'key', 'measures', 'indexes', 'aggregate'])
+
+ROLLUP_TABLES = {
+	# Distinct patients cannot be added up, so each period keeps its
+	# patients with their number of admissions
+	'rollup_admission_patients': RollupTable(
+		[('grain', 'TEXT'), ('period', 'DATE'), ('subject_id', 'INTEGER'), ('admissions', 'INTEGER')],
+		['grain', 'period', 'subject_id'], ['admissions'], {}, f"""
+		SELECT g.grain, {ROLLUP_PERIOD} as period, c.subject_id, SUM(c.sign) as admissions
+		FROM {{rows}} c
+		CROSS JOIN {ROLLUP_GRAIN_ROWS}
+		WHERE c.subject_id IS NOT NULL
+		GROUP BY 1, 2, 3
+	"""),
+	'rollup_admissions': RollupTable(
+		[('grain', 'TEXT'), ('period', 'DATE'), ('admissions', 'INTEGER'), ('patients', 'INTEGER'),
+			('length_days_sum', 'BIGINT'), ('length_count', 'INTEGER')],
+		['grain', 'period'], ['admissions', 'length_days_sum', 'length_count'], {}, f"""
+		SELECT g.grain, {ROLLUP_PERIOD} as period, SUM(c.sign) as admissions,
+			COUNT(DISTINCT c.subject_id) as patients,
+			COALESCE(SUM(c.sign * c.length_days), 0) as length_days_sum,
+			COALESCE(SUM(c.sign) FILTER (WHERE c.length_days IS NOT NULL), 0) as length_count
+		FROM {{rows}} c
+		CROSS JOIN {ROLLUP_GRAIN_ROWS}
+		GROUP BY 1, 2
+	"""),
+	'rollup_prescriptions': RollupTable(
+		[('grain', 'TEXT'), ('period', 'DATE'), ('medication_id', 'INTEGER'), ('prescriptions', 'INTEGER')],
+		['grain', 'period', 'medication_id'], ['prescriptions'],
+		# One medication's series
+		{'medication': 'medication_id, grain, period'}, f"""
+		SELECT g.grain, {ROLLUP_PERIOD} as period, c.medication_id, SUM(c.sign) as prescriptions
+		FROM {{rows}} c
+		CROSS JOIN {ROLLUP_GRAIN_ROWS}
+		GROUP BY 1, 2, 3
+	"""),
+	'rollup_diagnoses': RollupTable(
+		[('grain', 'TEXT'), ('period', 'DATE'), ('icd_code', 'TEXT'), ('icd_version', 'INTEGER'), ('diagnoses', 'INTEGER')],
+		['grain', 'period', 'icd_code', 'icd_version'], ['diagnoses'],
+		# One code's series
+		{'code': 'icd_code, icd_version, grain, period'}, f"""
+		SELECT g.grain, {ROLLUP_PERIOD} as period, c.icd_code, c.icd_version, SUM(c.sign) as diagnoses
+		FROM {{rows}} c
+		CROSS JOIN {ROLLUP_GRAIN_ROWS}
+		GROUP BY 1, 2, 3, 4
+	""")
+}
+
+# A source table, the rows of it that are rolled up, what their changes
+# record ({change column: expression over the row}), the rollup tables
+# fed, and statements run after its changes are added to them (they read
+# the changes from rollup_batch)
+RollupSource = namedtuple('RollupSource', ['table', 'condition', 'columns', 'tables', 'finish'])
+
+ROLLUP_SOURCES = {
+	'admission': RollupSource('admission', 'admission_intime IS NOT NULL', {
+		'happened_at': 'admission_intime',
+		'subject_id': 'subject_id',
+		'length_days': 'EXTRACT(days FROM (admission_outtime - admission_intime))::integer'
+	}, ['rollup_admission_patients', 'rollup_admissions'], [f"""
+		UPDATE wl2822.rollup_admissions r SET patients = (
+			SELECT COUNT(*) FROM wl2822.rollup_admission_patients p
+			WHERE p.grain = r.grain AND p.period = r.period
+		)
+		FROM (SELECT DISTINCT g.grain, {ROLLUP_PERIOD} as period FROM rollup_batch c CROSS JOIN {ROLLUP_GRAIN_ROWS}) t
+		WHERE r.grain = t.grain AND r.period = t.period
+	"""]),
+	'prescription': RollupSource('prescription', 'start_time IS NOT NULL AND medication_id IS NOT NULL', {
+		'happened_at': 'start_time',
+		'medication_id': 'medication_id'
+	}, ['rollup_prescriptions'], []),
+	'diagnosis': RollupSource('admission_diagnosis', 'diagnosed_on IS NOT NULL', {
+		'happened_at': 'diagnosed_on::timestamp',
+		'icd_code': 'icd_code',
+		'icd_version': 'icd_version'
+	}, ['rollup_diagnoses'], [])
+}
+
+# Seconds before missing rollup tables are looked for again
+ROLLUPS_RECHECK = 60
+
+rollups_state = {'installed': False, 'checked_at': None}
+
+
+class TrendsError(ValueError):
+	pass
+
+
+def rollups_installed(conn):
+	"""
+	Whether the rollups are installed. A positive answer is kept for the
+	life of the process, a negative one for ROLLUPS_RECHECK.
+	"""
+	now = time.monotonic()
+	checked_at = rollups_state['checked_at']
+	if not rollups_state['installed'] and (checked_at is None or now - checked_at >= ROLLUPS_RECHECK):
+		rollups_state['installed'] = conn.execute(
+			text("SELECT to_regclass('wl2822.rollup_changes') IS NOT NULL")).scalar()
+		rollups_state['checked_at'] = now
+	return rollups_state['installed']
+
+
+def create_rollup_table(conn, table, name=None):
+	"""
+	Create rollup table `table` as `name` (itself by default), without its
+	secondary indexes. Its primary key is named after `name`, so a shadow
+	copy can take over the names when it is swapped in.
+	"""
+	spec, name = ROLLUP_TABLES[table], name or table
+	columns = ", ".join(f"{column} {column_type} NOT NULL" for column, column_type in spec.columns)
+	conn.execute(text(f"""
+		CREATE TABLE IF NOT EXISTS wl2822.{name} ({columns}, CONSTRAINT {name}_pkey PRIMARY KEY ({", ".join(spec.key)}))
+	"""))
+
+
+def create_rollup_indexes(conn, table, name=None):
+	name = name or table
+	for suffix, columns in ROLLUP_TABLES[table].indexes.items():
+		conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name}_{suffix} ON wl2822.{name} ({columns})"))
+
+
+def install_rollups(conn):
+	"""
+	Create the rollup tables, the change log and the triggers that fill
+	it; refresh_rollups(full=True) fills the rollups
+	"""
+	conn.execute(text("""
+		CREATE TABLE IF NOT EXISTS wl2822.rollup_state (
+			source TEXT PRIMARY KEY,
+			refreshed_at TIMESTAMPTZ,
+			verified_at TIMESTAMPTZ
+		)
+	"""))
+	# Rollups of high-water mark installations are rebuilt by install-rollups
+	conn.execute(text("ALTER TABLE wl2822.rollup_state DROP COLUMN IF EXISTS high_water"))
+	conn.execute(text("ALTER TABLE wl2822.rollup_state ADD COLUMN IF NOT EXISTS verified_at TIMESTAMPTZ"))
+	# sign 0 marks a truncated source
+	conn.execute(text(f"""
+		CREATE TABLE IF NOT EXISTS wl2822.rollup_changes (
+			source TEXT NOT NULL,
+			sign SMALLINT NOT NULL,
+			{", ".join(f"{column} {column_type}" for column, column_type in ROLLUP_CHANGE_COLUMNS)}
+		)
+	"""))
+	conn.execute(text("CREATE INDEX IF NOT EXISTS rollup_changes_source ON wl2822.rollup_changes (source)"))
+	for table in ROLLUP_TABLES:
+		create_rollup_table(conn, table)
+		create_rollup_indexes(conn, table)
+
+	for name, source in ROLLUP_SOURCES.items():
+		columns = ", ".join(source.columns)
+		values = ", ".join(source.columns.values())
+		# An update logs only the rows whose rolled-up values changed
+		conn.execute(text(f"""
+			CREATE OR REPLACE FUNCTION wl2822.rollup_log_{name}() RETURNS trigger AS $$
+			BEGIN
+				IF TG_OP = 'TRUNCATE' THEN
+					INSERT INTO wl2822.rollup_changes (source, sign) VALUES ('{name}', 0);
+				ELSIF TG_OP = 'INSERT' THEN
+					INSERT INTO wl2822.rollup_changes (source, sign, {columns})
+					SELECT '{name}', 1, {values} FROM new_rows WHERE {source.condition};
+				ELSIF TG_OP = 'DELETE' THEN
+					INSERT INTO wl2822.rollup_changes (source, sign, {columns})
+					SELECT '{name}', -1, {values} FROM old_rows WHERE {source.condition};
+				ELSE
+					INSERT INTO wl2822.rollup_changes (source, sign, {columns})
+					SELECT '{name}', -1, * FROM (
+						SELECT {values} FROM old_rows WHERE {source.condition}
+						EXCEPT ALL SELECT {values} FROM new_rows WHERE {source.condition}) d;
+					INSERT INTO wl2822.rollup_changes (source, sign, {columns})
+					SELECT '{name}', 1, * FROM (
+						SELECT {values} FROM new_rows WHERE {source.condition}
+						EXCEPT ALL SELECT {values} FROM old_rows WHERE {source.condition}) d;
+				END IF;
+				RETURN NULL;
+			END $$ LANGUAGE plpgsql
+		"""))
+		for event_name, transition in (
+			('INSERT', 'REFERENCING NEW TABLE AS new_rows'),
+			('DELETE', 'REFERENCING OLD TABLE AS old_rows'),
+			('UPDATE', 'REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+			('TRUNCATE', '')):
+			trigger = f"rollup_log_{event_name.lower()}"
+			conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger} ON wl2822.{source.table}"))
+			conn.execute(text(f"""
+				CREATE TRIGGER {trigger} AFTER {event_name} ON wl2822.{source.table}
+				{transition}
+				FOR EACH STATEMENT EXECUTE FUNCTION wl2822.rollup_log_{name}()
+			"""))
+		conn.execute(text("INSERT INTO wl2822.rollup_state (source) VALUES (:source) ON CONFLICT DO NOTHING"),
+			{'source': name})
+
+
+@contextmanager
+def rollup_transaction(name):
+	"""
+	A repeatable-read transaction holding source `name`'s rollup lock, so
+	its refreshes take turns and each sees one snapshot of the source, its
+	pending changes and its rollups
+	"""
+	lock = {'space': ROLLUP_LOCK_SPACE, 'source': name}
+	with engine.connect() as conn:
+		# Locked before the transaction starts, so its snapshot includes
+		# whatever the previous holder committed
+		conn.execute(text("SELECT pg_advisory_lock(:space, hashtext(:source))"), lock)
+		conn.commit()
+		try:
+			conn.execution_options(isolation_level='REPEATABLE READ')
+			with conn.begin():
+				yield conn
+		finally:
+			conn.execute(text("SELECT pg_advisory_unlock(:space, hashtext(:source))"), lock)
+			conn.commit()
+
+
+def rollup_source_rows(source):
+	"""
+	The rows of a source table as changes that add them
+	"""
+	columns = ", ".join(f"{expression} as {column}" for column, expression in source.columns.items())
+	return f"(SELECT 1 as sign, {columns} FROM wl2822.{source.table} WHERE {source.condition})"
+
+
+def apply_rollup_changes(conn, source):
+	"""
+	Add the changes in rollup_batch to the source's rollups and drop the
+	rows they empty
+	"""
+	for table in source.tables:
+		spec = ROLLUP_TABLES[table]
+		columns = ", ".join(column for column, _ in spec.columns)
+		conn.execute(text(f"""
+			INSERT INTO wl2822.{table} AS r ({columns})
+			{spec.aggregate.format(rows='rollup_batch')}
+			ON CONFLICT ({", ".join(spec.key)}) DO UPDATE SET
+			{", ".join(f"{measure} = r.{measure} + EXCLUDED.{measure}" for measure in spec.measures)}
+		"""))
+		touched = ", ".join(['g.grain', f"{ROLLUP_PERIOD} as period"] + [f"c.{column}" for column in spec.key[2:]])
+		conn.execute(text(f"""
+			DELETE FROM wl2822.{table} r
+			USING (SELECT DISTINCT {touched} FROM rollup_batch c CROSS JOIN {ROLLUP_GRAIN_ROWS}) t
+			WHERE {" AND ".join(f"r.{column} = t.{column}" for column in spec.key)} AND r.{spec.measures[0]} = 0
+		"""))
+	for statement in source.finish:
+		conn.execute(text(statement))
+
+
+def rebuild_rollups(conn, source):
+	"""
+	Aggregate the source's rollups afresh into shadow tables and swap them
+	in. Returns the number of rollup rows written.
+	"""
+	written = 0
+	for table in source.tables:
+		spec, shadow = ROLLUP_TABLES[table], f'{table}_rebuild'
+		conn.execute(text(f"DROP TABLE IF EXISTS wl2822.{shadow}"))
+		create_rollup_table(conn, table, shadow)
+		columns = ", ".join(column for column, _ in spec.columns)
+		written += conn.execute(text(f"""
+			INSERT INTO wl2822.{shadow} ({columns}) {spec.aggregate.format(rows=rollup_source_rows(source))}
+		""")).rowcount
+		create_rollup_indexes(conn, table, shadow)
+	# Readers of the old tables hold the swap up only as long as they take
+	for table in source.tables:
+		conn.execute(text(f"DROP TABLE wl2822.{table}"))
+		conn.execute(text(f"ALTER TABLE wl2822.{table}_rebuild RENAME TO {table}"))
+		for suffix in ['pkey', *ROLLUP_TABLES[table].indexes]:
+			conn.execute(text(f"ALTER INDEX wl2822.{table}_rebuild_{suffix} RENAME TO {table}_{suffix}"))
+	return written
+
+
+def rollup_drift(conn, source):
+	"""
+	Buckets of the source's rollups (rows, one per grain, period and key)
+	that differ from a fresh aggregation of the source table, or that only
+	one of them has. The pending changes must have been applied in the
+	same snapshot.
+	"""
+	drift = 0
+	for table in source.tables:
+		spec = ROLLUP_TABLES[table]
+		fresh = spec.aggregate.format(rows=rollup_source_rows(source))
+		stored = f"SELECT {', '.join(column for column, _ in spec.columns)} FROM wl2822.{table}"
+		key = ", ".join(spec.key)
+		drift += conn.execute(text(f"""
+			SELECT COUNT(*) FROM (
+				SELECT {key} FROM (({fresh}) EXCEPT ({stored})) missing
+				UNION SELECT {key} FROM (({stored}) EXCEPT ({fresh})) extra
+			) buckets
+		""")).scalar()
+	return drift
+
+
+def refresh_rollup(name, full=False, verify=False):
+	"""
+	Add the pending changes of one source to its rollups, or rebuild them
+	with `full` or after the source was truncated. With `verify`, the
+	rollups are compared with the source afterwards and rebuilt when they
+	differ. Returns (changes applied, buckets found off when verifying,
+	rows written by a rebuild or None).
+	"""
+	source = ROLLUP_SOURCES[name]
+	drift, rebuilt = None, None
+	with rollup_transaction(name) as conn:
+		conn.execute(text("CREATE TEMP TABLE rollup_batch (LIKE wl2822.rollup_changes) ON COMMIT DROP"))
+		applied = conn.execute(text("""
+			WITH taken AS (DELETE FROM wl2822.rollup_changes WHERE source = :source RETURNING *)
+			INSERT INTO rollup_batch SELECT * FROM taken
+		"""), {'source': name}).rowcount
+		full = full or conn.execute(text("SELECT EXISTS (SELECT 1 FROM rollup_batch WHERE sign = 0)")).scalar()
+		if not full and applied:
+			apply_rollup_changes(conn, source)
+		if verify and not full:
+			drift = rollup_drift(conn, source)
+			full = drift > 0
+		if full:
+			rebuilt = rebuild_rollups(conn, source)
+		conn.execute(text(f"""
+			UPDATE wl2822.rollup_state SET refreshed_at = now()
+			{", verified_at = now()" if verify or full else ""}
+			WHERE source = :source
+		"""), {'source': name})
+	if result_cache is not None and (applied or rebuilt is not None):
+		result_cache.invalidate(source.tables)
+	return applied, drift, rebuilt
+
+
+def refresh_rollups(full=False, verify=False, sources=None, log=print):
+	"""
+	Bring the rollups of `sources` (all by default) up to date. With
+	`verify`, a source whose rollups no longer match its table is rebuilt.
+	"""
+	for name in ROLLUP_SOURCES if sources is None else sources:
+		started = time.perf_counter()
+		applied, drift, rebuilt = refresh_rollup(name, full, verify)
+		if drift:
+			log(f"{name} rollups: {drift} bucket(s) did not match the table")
+		if rebuilt is not None:
+			log(f"{name} rollups: rebuilt with {rebuilt} row(s) in {time.perf_counter() - started:.2f}s")
+		elif applied:
+			log(f"{name} rollups: {applied} change(s) applied in {time.perf_counter() - started:.2f}s")
+
+
+def rollups_due_for_verification(conn):
+	"""
+	Sources last verified more than ROLLUP_VERIFY_INTERVAL seconds ago
+	"""
+	return {row.source for row in conn.execute(text("""
+		SELECT source FROM wl2822.rollup_state
+		WHERE verified_at IS NULL OR verified_at < now() - make_interval(secs => :interval)
+	"""), {'interval': ROLLUP_VERIFY_INTERVAL})}
+
+
+def start_rollup_refresher(interval):
+	"""
+	Refresh the rollups every `interval` seconds in a daemon thread, once
+	they are installed, verifying each source every ROLLUP_VERIFY_INTERVAL
+	"""
+	def refresh_forever():
+		while True:
+			try:
+				with engine.connect() as conn:
+					installed = rollups_installed(conn)
+					due = rollups_due_for_verification(conn) if installed and ROLLUP_VERIFY_INTERVAL > 0 else set()
+				if installed:
+					for name in ROLLUP_SOURCES:
+						refresh_rollups(verify=name in due, sources=[name])
+			except Exception as e:
+				print(f"Error refreshing rollups: {e}")
+			time.sleep(interval)
+
+	thread = threading.Thread(target=refresh_forever, name='rollup-refresher', daemon=True)
+	thread.start()
+	return thread
+
+
+def period_start(day, grain):
+	"""
+	First day of the period of `grain` holding `day`
+	"""
+	if grain == 'week':
+		return day - timedelta(days=day.weekday())
+	if grain == 'month':
+		return day.replace(day=1)
+	return day
+
+
+def shift_periods(day, grain, periods):
+	"""
+	The period start `periods` periods of `grain` after `day`'s
+	"""
+	day = period_start(day, grain)
+	if grain == 'month':
+		months = day.year * 12 + day.month - 1 + periods
+		return date(months // 12, months % 12 + 1, 1)
+	return day + timedelta(days=periods * (7 if grain == 'week' else 1))
+
+
+def period_count(start, end, grain):
+	if grain == 'month':
+		return (end.year - start.year) * 12 + end.month - start.month + 1
+	return (end - start).days // (7 if grain == 'week' else 1) + 1
+
+
+TRENDS_ADMISSIONS_QUERY = """
+	SELECT period, admissions, patients, length_days_sum, length_count
+	FROM wl2822.rollup_admissions
+	WHERE grain = :grain AND period BETWEEN :start AND :end
+"""
+
+TRENDS_PRESCRIPTIONS_QUERY = """
+	SELECT period, SUM(prescriptions) as prescriptions
+	FROM wl2822.rollup_prescriptions
+	WHERE grain = :grain AND period BETWEEN :start AND :end {medication_condition}
+	GROUP BY period
+"""
+
+TRENDS_DIAGNOSES_QUERY = """
+	SELECT period, SUM(diagnoses) as diagnoses
+	FROM wl2822.rollup_diagnoses
+	WHERE grain = :grain AND period BETWEEN :start AND :end {code_condition}
+	GROUP BY period
+"""
+
+TRENDS_TOP_MEDICATIONS_QUERY = """
+	SELECT r.medication_id, m.name as medication_name, m.strength, r.prescriptions
+	FROM (
+		SELECT medication_id, SUM(prescriptions) as prescriptions
+		FROM wl2822.rollup_prescriptions
+		WHERE grain = :grain AND period BETWEEN :start AND :end
+		GROUP BY medication_id
+		ORDER BY prescriptions DESC
+		LIMIT 10
+	) r
+	JOIN wl2822.medication m ON m.medication_id = r.medication_id
+	ORDER BY r.prescriptions DESC
+"""
+
+TRENDS_TOP_DIAGNOSES_QUERY = """
+	SELECT r.icd_code, r.icd_version, c.condition_name, r.diagnoses
+	FROM (
+		SELECT icd_code, icd_version, SUM(diagnoses) as diagnoses
+		FROM wl2822.rollup_diagnoses
+		WHERE grain = :grain AND period BETWEEN :start AND :end
+		GROUP BY icd_code, icd_version
+		ORDER BY diagnoses DESC
+		LIMIT 10
+	) r
+	LEFT JOIN wl2822.condition c ON c.icd_code = r.icd_code AND c.icd_version = r.icd_version
+	ORDER BY r.diagnoses DESC
+"""
+
+
+def trends_range(conn, args):
+	"""
+	(grain, start, end) asked for with ?grain=, ?from= and ?to=; without a
+	range, the last TRENDS_DEFAULT_PERIODS periods of data
+	"""
+	grain = args.get('grain', 'month')
+	if grain not in ROLLUP_GRAINS:
+		raise TrendsError(f"grain must be one of {', '.join(ROLLUP_GRAINS)}")
+	try:
+		start = date.fromisoformat(args['from']) if args.get('from') else None
+		end = date.fromisoformat(args['to']) if args.get('to') else None
+	except ValueError:
+		raise TrendsError("from and to must be dates (YYYY-MM-DD)")
+	if end is None:
+		end = conn.execute(text("SELECT MAX(period) FROM wl2822.rollup_admissions WHERE grain = :grain"),
+			{'grain': grain}).scalar() or date.today()
+	start = period_start(start, grain) if start else shift_periods(end, grain, 1 - TRENDS_DEFAULT_PERIODS)
+	if start > end:
+		raise TrendsError("from must not be after to")
+	if period_count(start, end, grain) > TRENDS_MAX_PERIODS:
+		raise TrendsError(f"at most {TRENDS_MAX_PERIODS} {grain}s at a time; narrow the range or use a coarser grain")
+	return grain, start, end
+
+
+def fetch_trends(conn, args):
+	"""
+	The trends of a date range from the rollups: one row per period with
+	admissions, distinct patients, average length of stay, prescriptions
+	(of ?medication_id= only, when given) and diagnoses (of ?icd_code= and
+	?icd_version= only), the range's totals, and its top medications and
+	diagnoses
+	"""
+	if not rollups_installed(conn):
+		raise TrendsError("trend rollups are not installed; run `python server.py install-rollups`")
+	grain, start, end = trends_range(conn, args)
+	params = {'grain': grain, 'start': start, 'end': end}
+
+	medication_condition = code_condition = ''
+	medication_id = args.get('medication_id', type=int)
+	if medication_id is not None:
+		medication_condition = 'AND medication_id = :medication_id'
+		params['medication_id'] = medication_id
+	icd_code = args.get('icd_code')
+	if icd_code:
+		code_condition = 'AND icd_code = :icd_code'
+		params['icd_code'] = icd_code
+		if args.get('icd_version', type=int) is not None:
+			code_condition += ' AND icd_version = :icd_version'
+			params['icd_version'] = args.get('icd_version', type=int)
+
+	periods = {}
+
+	def period(day):
+		return periods.setdefault(day, {'period': day, 'admissions': 0, 'patients': 0, 'avg_length_days': None,
+			'prescriptions': 0, 'diagnoses': 0})
+
+	totals = {'admissions': 0, 'length_days_sum': 0, 'length_count': 0, 'prescriptions': 0, 'diagnoses': 0}
+	for row in conn.execute(text(TRENDS_ADMISSIONS_QUERY), params):
+		entry = period(row.period)
+		entry.update(admissions=row.admissions, patients=row.patients,
+			avg_length_days=row.length_days_sum / row.length_count if row.length_count else None)
+		totals['admissions'] += row.admissions
+		totals['length_days_sum'] += row.length_days_sum
+		totals['length_count'] += row.length_count
+	for row in conn.execute(text(TRENDS_PRESCRIPTIONS_QUERY.format(medication_condition=medication_condition)), params):
+		period(row.period)['prescriptions'] = row.prescriptions
+		totals['prescriptions'] += row.prescriptions
+	for row in conn.execute(text(TRENDS_DIAGNOSES_QUERY.format(code_condition=code_condition)), params):
+		period(row.period)['diagnoses'] = row.diagnoses
+		totals['diagnoses'] += row.diagnoses
+
+	return {
+		'grain': grain,
+		'from': start,
+		'to': end,
+		'medication_id': medication_id,
+		'icd_code': icd_code or None,
+		'icd_version': params.get('icd_version'),
+		'periods': [periods[day] for day in sorted(periods)],
+		'totals': {
+			'admissions': totals['admissions'],
+			'avg_length_days': totals['length_days_sum'] / totals['length_count'] if totals['length_count'] else None,
+			'prescriptions': totals['prescriptions'],
+			'diagnoses': totals['diagnoses']
+		},
+		'top_medications': [row_to_dict(row) for row in conn.execute(text(TRENDS_TOP_MEDICATIONS_QUERY), params)],
+		'top_diagnoses': [row_to_dict(row) for row in conn.execute(text(TRENDS_TOP_DIAGNOSES_QUERY), params)]
+	}
+
+
+def fetch_monthly_trends(conn):
+	"""
+	The dashboard's monthly trends from the month rollup
+	"""
+	return [row_to_dict(row) for row in conn.execute(text("""
+		SELECT TO_CHAR(period, 'YYYY-MM') as month, admissions as admission_count, patients as unique_patients
+		FROM wl2822.rollup_admissions
+		WHERE grain = 'month'
+		ORDER BY period DESC
+		LIMIT 12
+	"""))]
+
+
+@app.route('/trends')
+def trends():
+	"""
+	Admission, prescription and diagnosis trends over any date range, from
+	the rollups
+	"""
+	try:
+		result, error = fetch_trends(g.conn, request.args), None
+	except TrendsError as e:
+		g.conn.rollback()
+		result, error = None, str(e)
+	return render_template("trends.html", trends=result, error=error, grains=ROLLUP_GRAINS)
+
+
+@app.route('/api/v1/trends')
+def api_trends():
+	"""
+	/trends as JSON
+	"""
+	try:
+		return api_response(fetch_trends(g.conn, request.args))
+	except TrendsError as e:
+		raise ApiError(str(e))
+
+
+# ==========================================
+# MEDICATION ROUTES
+# ==========================================
+
+# A search restricts the aggregation to the medications the search index
+# matched
+MEDICATIONS_QUERY = FilterQuery("""
+		SELECT
+			m.medication_id,
+			m.name,
+			m.strength,
+			m.form,
+			COUNT(DISTINCT p.subject_id) as patient_count,
+			COUNT(p.prescription_id) as prescription_count
+		FROM wl2822.medication m
+		LEFT JOIN wl2822.prescription p ON m.medication_id = p.medication_id
+		WHERE {where}
+		GROUP BY m.medication_id, m.name, m.strength, m.form
+		ORDER BY prescription_count DESC NULLS LAST, m.name
+		LIMIT 100
+""", [
+	Filter('search', 'm.medication_id = ANY(:medication_ids)',
+		bind=lambda search: {'medication_ids': [medication_id for medication_id, in medication_index.search(search)]}),
+	Filter('form', 'm.form = :form')
+])
+
+
+@app.route('/medications')
+def medications():
+	"""
+	Medication catalog with search functionality
+	"""
+	search = request.args.get('search', '')
+
+	try:
+		# Build query with filters
+		signature, params = MEDICATIONS_QUERY.bind(request.args)
+		result = g.conn.execute(MEDICATIONS_QUERY.statement(signature), params)
+		medications = result.fetchall()
+
+		# Get medication forms for filter dropdown
+		medication_forms = facet_cache.get(g.conn, 'medication', 'form')
+
+	except Exception as e:
+		print(f"Error fetching medications: {e}")
+		import traceback
+		traceback.print_exc()
+		medications = []
+		medication_forms = []
+
+	return render_template("medications.html",
+		medications=medications,
+		medication_forms=medication_forms,
+		search=search)
+
+
+# ==========================================
+# PRESCRIPTION ROUTES
+# ==========================================
+
+# Prescription list query shared by /prescriptions and its export. The
+# keyset condition, sort order and limit are filled in per use.
+PRESCRIPTIONS_QUERY = FilterQuery("""
+		SELECT
+			p.prescription_id,
+			a.subject_id,
+			p.hadm_id,
+			m.name as medication_name,
+			m.strength,
+			m.form,
+			p.dose,
+			p.route,
+			p.frequency,
+			p.start_time,
+			p.end_time,
+			pat.sex,
+			2110 - EXTRACT(YEAR FROM pat.date_of_birth) as patient_age
+		FROM wl2822.prescription p
+		JOIN wl2822.medication m ON p.medication_id = m.medication_id
+		JOIN wl2822.admission a ON p.hadm_id = a.hadm_id
+		JOIN wl2822.patient pat ON a.subject_id = pat.subject_id
+		WHERE {where}
+			AND {keyset_condition}
+		ORDER BY {order_by}
+		{limit_clause}
+""", [
+	Filter('subject_id', 'a.subject_id = :subject_id', type=int),
+	Filter('medication_name', 'LOWER(m.name) LIKE LOWER(:medication_pattern)',
+		bind=lambda name: {'medication_pattern': f'%{name}%'}),
+	Filter('route', 'p.route = :route'),
+	Filter('from_date', 'p.start_time >= :from_date', type=iso_date),
+	Filter('to_date', 'p.start_time <= :to_date', type=iso_date)
+])
+
+
+@app.route('/prescriptions')
+def prescriptions():
+	"""
+	Prescription browser with filtering
+	"""
+	per_page = get_page_size()
+	direction, cursor = decode_cursor(request.args.get('cursor'), 2)
+	keyset_condition, order_by = PRESCRIPTIONS_KEYSET.clause(direction)
+
+	# Build query with filters
+	signature, params = PRESCRIPTIONS_QUERY.bind(request.args)
+	query = PRESCRIPTIONS_QUERY.statement(signature,
+		keyset_condition=keyset_condition,
+		order_by=order_by,
+		limit_clause='LIMIT :limit')
+
+	try:
+		result = g.conn.execute(query, {
+			**params,
+			'limit': per_page + 1,
+			**PRESCRIPTIONS_KEYSET.params(cursor)
+		})
+		page = PRESCRIPTIONS_KEYSET.page(result.fetchall(), per_page, direction)
+
+		# Get routes for filter dropdown
+		prescription_routes = facet_cache.get(g.conn, 'prescription', 'route')
+
+	except Exception as e:
+		print(f"Error fetching prescriptions: {e}")
+		import traceback
+		traceback.print_exc()
+		page = Page([], None, None)
+		prescription_routes = []
+
+	return render_template("prescriptions.html",
+		prescriptions=page.rows,
+		page=page,
+		prescription_routes=prescription_routes)
+
+
+# ==========================================
+# PROCEDURE ROUTES
+# ==========================================
+
+# A search restricts the aggregation to the procedures the search index
+# matched
+PROCEDURES_QUERY = FilterQuery("""
+		SELECT
+			pr.icd_code,
+			pr.icd_version,
+			pr.procedure_name,
+			COUNT(DISTINCT pp.subject_id) as patient_count,
+			COUNT(pp.hadm_id) as procedure_count,
+			MIN(pp.procedure_date) as first_performed,
+			MAX(pp.procedure_date) as last_performed
+		FROM wl2822.procedures pr
+		LEFT JOIN wl2822.procedures_performed pp
+			ON pr.icd_code = pp.icd_code
+			AND pr.icd_version = pp.icd_version
+		WHERE {where}
+		GROUP BY pr.icd_code, pr.icd_version, pr.procedure_name
+		ORDER BY procedure_count DESC NULLS LAST, patient_count DESC
+		LIMIT 100
+""", [
+	Filter('search', """(pr.icd_code, pr.icd_version) IN (
+				SELECT * FROM unnest(CAST(:codes AS TEXT[]), CAST(:versions AS INTEGER[])))""",
+		bind=lambda search: icd_key_params(procedure_index.search(search))),
+	Filter('icd_version', 'pr.icd_version = :icd_version', type=int)
+])
+
+
+@app.route('/procedures')
+def procedures():
+	"""
+	Procedure catalog with statistics
+	"""
+	search = request.args.get('search', '')
+
+	try:
+		# Build query with filters - similar to medications
+		signature, params = PROCEDURES_QUERY.bind(request.args)
+		result = g.conn.execute(PROCEDURES_QUERY.statement(signature), params)
+		procedures = result.fetchall()
+
+	except Exception as e:
+		print(f"Error fetching procedures: {e}")
+		import traceback
+		traceback.print_exc()
+		procedures = []
+
+	return render_template("procedures.html",
+		procedures=procedures,
+		search=search)
+
+
+# ==========================================
+# EXPORTS
+# ==========================================
+
+# Rows fetched per round trip from the server-side cursor of an export
+EXPORT_FETCH_SIZE = env_int('EXPORT_FETCH_SIZE', 2000)
+
+EXPORT_MIMETYPES = {
+	'csv': 'text/csv',
+	'ndjson': 'application/x-ndjson'
+}
+
+
+def export_lines(result, fmt):
+	"""
+	Yield a result set as CSV or NDJSON text, one chunk per fetched batch
+	"""
+	columns = list(result.keys())
+	buffer = io.StringIO()
+	writer = csv.writer(buffer)
+
+	if fmt == 'csv':
+		writer.writerow(columns)
+		yield buffer.getvalue()
+
+	for rows in result.partitions():
+		buffer.seek(0)
+		buffer.truncate()
+		if fmt == 'csv':
+			writer.writerows(rows)
+		else:
+			for row in rows:
+				buffer.write(json.dumps(dict(zip(columns, map(json_safe, row)))))
+				buffer.write('\n')
+		yield buffer.getvalue()
+
+
+def stream_export(query, params, fmt, filename):
+	"""
+	Stream the full result of a query as a chunked download. The rows come
+	from a server-side cursor EXPORT_FETCH_SIZE at a time on the request's
+	own connection, so memory stays flat however many rows are exported.
+	"""
+	def generate():
+		# The export transaction runs without DB_STATEMENT_TIMEOUT_MS, which
+		# would otherwise end a long export at whichever FETCH crossed it
+		g.conn.execute(text("SET LOCAL statement_timeout = 0"))
+		result = g.conn.execution_options(
+			stream_results=True,
+			yield_per=EXPORT_FETCH_SIZE).execute(query, params)
+		yield from export_lines(result, fmt)
+
+	return Response(stream_with_context(generate()),
+		mimetype=EXPORT_MIMETYPES[fmt],
+		headers={'Content-Disposition': f'attachment; filename="{filename}.{fmt}"'})
+
+
+@app.route('/export/<any(prescriptions, admissions):resource>.<any(csv, ndjson):fmt>')
+def export(resource, fmt):
+	"""
+	Full, unpaged export of /prescriptions or /admissions, taking the same
+	filter parameters as the HTML pages
+	"""
+	if resource == 'prescriptions':
+		query, keyset, fragments = PRESCRIPTIONS_QUERY, PRESCRIPTIONS_KEYSET, {}
+	else:
+		query, keyset, fragments = ADMISSIONS_QUERY, ADMISSIONS_KEYSET, admission_summary_sql(g.conn)
+
+	signature, params = query.bind(request.args)
+	_, order_by = keyset.clause(None)
+	statement = query.statement(signature, keyset_condition='TRUE', order_by=order_by, limit_clause='', **fragments)
+	return stream_export(statement, params, fmt, resource)
+
+
+@app.route('/export/condition/<icd_code>/<int:icd_version>.<any(csv, ndjson):fmt>')
+def export_condition(icd_code, icd_version, fmt):
+	"""
+	Full export of the patients diagnosed with a condition
+	"""
+	query = text(CONDITION_PATIENTS_QUERY.format(limit_clause=''))
+	params = {'icd_code': icd_code, 'icd_version': icd_version}
+	return stream_export(query, params, fmt, f'condition_{icd_code}_{icd_version}')
+
+
+# ==========================================
+# JSON API
+# ==========================================
+
+#
+# /api/v1/<resource> serves the rows of the list pages as JSON and takes the
+# same filter parameters, plus:
+#
+#     fields=a,b         only these columns. The list statement is wrapped in
+#                        SELECT a, b FROM (...), and Postgres leaves out the
+#                        expressions (and removable joins) of the others.
+#     format=objects     one object per row (the default)
+#     format=columnar    one array per column, in `fields` order: smaller,
+#                        and encoded straight from the row tuples
+#     per_page=, cursor= keyset paging as on the pages, for patients,
+#                        admissions and prescriptions
+#
+# /api/v1/analytics serves the dashboard sections. Responses of at least
+# API_GZIP_MIN_BYTES are gzip-compressed for clients that accept it.
+#
+API_GZIP_MIN_BYTES = env_int('API_GZIP_MIN_BYTES', 1024)
+API_GZIP_LEVEL = env_int('API_GZIP_LEVEL', 5)
+API_FORMATS = ('objects', 'columnar')
+
+# A list query, its keyset (None for the top-100 catalogs) and the extra
+# format fragments it needs per request
+ApiResource = namedtuple('ApiResource', ['query', 'keyset', 'fragments'])
+
+API_RESOURCES = {
+	'patients': ApiResource(PATIENTS_QUERY, PATIENTS_KEYSET, None),
+	'conditions': ApiResource(CONDITIONS_QUERY, None, None),
+	'admissions': ApiResource(ADMISSIONS_QUERY, ADMISSIONS_KEYSET, admission_summary_sql),
+	'medications': ApiResource(MEDICATIONS_QUERY, None, None),
+	'prescriptions': ApiResource(PRESCRIPTIONS_QUERY, PRESCRIPTIONS_KEYSET, None),
+	'procedures': ApiResource(PROCEDURES_QUERY, None, None)
+}
+
+
+class ApiError(Exception):
+	pass
+
+
+@app.errorhandler(ApiError)
+def api_error(e):
+	return jsonify(error=str(e)), 400
+
+
+def json_default(value):
+	"""
+	json.dumps hook for the database types json cannot encode by itself
+	"""
+	if isinstance(value, SectionUnavailable):
+		return {'unavailable': value.reason}
+	converted = json_safe(value)
+	if converted is value:
+		raise TypeError(f"{type(value).__name__} is not JSON serializable")
+	return converted
+
+
+def api_response(payload):
+	"""
+	JSON response, gzip-compressed when it is large enough and the client
+	accepts it
+	"""
+	if stale_data():
+		payload = {**payload, 'stale': True}
+	body = json.dumps(payload, default=json_default, separators=(',', ':')).encode()
+	response = Response(body, mimetype='application/json')
+	response.vary.add('Accept-Encoding')
+	if len(body) >= API_GZIP_MIN_BYTES and request.accept_encodings['gzip'] > 0:
+		response.set_data(gzip.compress(body, API_GZIP_LEVEL))
+		response.headers['Content-Encoding'] = 'gzip'
+	return response
+
+
+def api_fields(value):
+	"""
+	Column names asked for with ?fields=, or None for all of them
+	"""
+	if not value:
+		return None
+	fields = [field.strip() for field in value.split(',') if field.strip()]
+	invalid = [field for field in fields if not re.fullmatch(r'[A-Za-z_]\w*', field)]
+	if invalid:
+		raise ApiError(f"invalid field name(s): {', '.join(invalid)}")
+	return list(dict.fromkeys(fields))
+
+
+@lru_cache(maxsize=256)
+def projected_statement(sql, columns):
+	"""
+	`sql` narrowed to `columns`
+	"""
+	return text(f'SELECT {", ".join(f"q.{column}" for column in columns)} FROM ({sql}) q')
+
+
+def api_statement(resource, signature, direction, columns=None):
+	"""
+	The list statement of a resource for a filter signature and page
+	direction, projected to `columns` when given
+	"""
+	fragments = dict(resource.fragments(g.conn)) if resource.fragments else {}
+	if resource.keyset is not None:
+		fragments['keyset_condition'], fragments['order_by'] = resource.keyset.clause(direction)
+		if '{limit_clause}' in resource.query.template:
+			fragments['limit_clause'] = 'LIMIT :limit'
+	statement = resource.query.statement(signature, **fragments)
+	if columns is None:
+		return statement
+	return projected_statement(str(statement), tuple(f'"{column}"' for column in columns))
+
+
+@app.route('/api/v1/<any(patients, conditions, admissions, medications, prescriptions, procedures):resource>')
+def api_list(resource):
+	"""
+	Rows of a list page as JSON (see JSON API above)
+	"""
+	resource_name, resource = resource, API_RESOURCES[resource]
+	fields = api_fields(request.args.get('fields'))
+	fmt = request.args.get('format', 'objects')
+	if fmt not in API_FORMATS:
+		raise ApiError(f"format must be one of {', '.join(API_FORMATS)}")
+
+	signature, params = resource.query.bind(request.args)
+	per_page = get_page_size()
+	direction, cursor = None, None
+	columns = fields
+	if resource.keyset is not None:
+		key_names = [key for _, key, _ in resource.keyset.columns]
+		direction, cursor = decode_cursor(request.args.get('cursor'), len(key_names))
+		params.update({'limit': per_page + 1, **resource.keyset.params(cursor)})
+		# Page cursors need the sort key even when it is not asked for
+		if fields is not None:
+			columns = fields + [key for key in key_names if key not in fields]
+
+	try:
+		result = g.conn.execute(api_statement(resource, signature, direction, columns), params)
+	except exc.ProgrammingError as e:
+		g.conn.rollback()
+		if fields is None or getattr(e.orig, 'pgcode', None) != '42703':
+			raise
+		available = g.conn.execute(text(f"SELECT * FROM ({api_statement(resource, signature, direction)}) q LIMIT 0"),
+			params).keys()
+		raise ApiError(f"unknown field(s): {', '.join(field for field in fields if field not in available)}; "
+			f"available: {', '.join(available)}")
+	names = fields or list(result.keys())
+	rows = result.fetchall()
+
+	payload = {'resource': resource_name, 'fields': names}
+	if resource.keyset is not None:
+		page = resource.keyset.page(rows, per_page, direction)
+		rows = page.rows
+		payload.update(next_cursor=page.next_cursor, prev_cursor=page.prev_cursor)
+	payload['count'] = len(rows)
+
+	if fmt == 'columnar':
+		payload['columns'] = list(zip(*rows))[:len(names)] if rows else [[] for _ in names]
+	else:
+		payload['rows'] = [dict(zip(names, row)) for row in rows]
+	return api_response(payload)
+
+
+@app.route('/api/v1/analytics')
+def api_analytics():
+	"""
+	The dashboard sections as JSON, from the snapshot when there is one
+	"""
+	try:
+		sections, data_as_of = load_analytics_snapshot(g.conn)
+	except Exception as e:
+		print(f"Analytics snapshot unavailable, computing live: {e}")
+		g.conn.rollback()
+		sections, data_as_of = None, None
+	if sections is None:
+		sections = compute_analytics(g.conn, parallel=True, partial=True)
+	return api_response({'data_as_of': data_as_of, 'sections': sections})
+
+
+# ==========================================
+# COHORTS
+# ==========================================
+
+#
+# Multi-criteria cohorts ("diagnosed with X, prescribed Y, never had
+# procedure Z") are answered from an in-memory bitmap index instead of SQL.
+# Every patient gets a position, and each value of each dimension keeps the
+# patients having it as a bitmap over those positions (a Python int), or as
+# a sorted array of positions when that is smaller. Expressions combine
+# terms with AND, OR, NOT and parentheses (terms side by side are ANDed):
+#
+#     condition:4019 AND medication:furosemide AND NOT procedure:3893
+#     (sex:f OR race:"asian") AND age>=65 AND admission_type:urgent
+#
+# condition: and procedure: take an ICD code, code/version for one version
+# only; medication: a drug name; age (2110 minus the birth year, as on the
+# patient list) also compares with <, <=, >, >=.
+#
+# Each source below is indexed on first use and again after
+# COHORT_INDEX_TTL seconds or once its tables change (invalidate_caches()),
+# so a load of prescriptions rebuilds the medication bitmaps only. Only the
+# first indexing of a source makes a request wait: later ones run in a
+# background thread while queries keep using the previous bitmaps, which
+# are swapped for the new ones when they are complete. Patient positions
+# never move, which keeps the other sources' bitmaps valid.
+#
+COHORT_INDEX_TTL = env_int('COHORT_INDEX_TTL', 3600)
+
+# Patients listed under a cohort on /cohort, and the most /api/v1/cohort
+# returns with ?limit=
+COHORT_PAGE_PATIENTS = 50
+COHORT_MAX_PATIENTS = 100000
+
+# A source query returns subject_id and one column per dimension; the patient
+# source also decides which patients exist
+CohortSource = namedtuple('CohortSource', ['tables', 'query'])
+
+COHORT_SOURCES = {
+	'patient': CohortSource({'patient'}, """
+		SELECT subject_id, lower(sex) as sex, lower(race) as race,
+			(2110 - EXTRACT(YEAR FROM date_of_birth))::int as age
+		FROM wl2822.patient
+		ORDER BY subject_id
+	"""),
+	'admission': CohortSource({'admission'}, """
+		SELECT DISTINCT subject_id, lower(admission_type) as admission_type
+		FROM wl2822.admission
+	"""),
+	'diagnosis': CohortSource({'admission_diagnosis'}, """
+		SELECT DISTINCT subject_id, lower(icd_code) || '/' || icd_version as condition
+		FROM wl2822.admission_diagnosis
+	"""),
+	'procedure': CohortSource({'procedures_performed'}, """
+		SELECT DISTINCT subject_id, lower(icd_code) || '/' || icd_version as procedure
+		FROM wl2822.procedures_performed
+	"""),
+	'prescription': CohortSource({'prescription', 'medication'}, """
+		SELECT DISTINCT p.subject_id, lower(m.name) as medication
+		FROM wl2822.prescription p
+		JOIN wl2822.medication m ON m.medication_id = p.medication_id
+	""")
+}
+
+COHORT_COMPARISONS = {
+	'<': lambda value, bound: value < bound,
+	'<=': lambda value, bound: value <= bound,
+	'>': lambda value, bound: value > bound,
+	'>=': lambda value, bound: value >= bound
+}
+
+COHORT_TOKEN = re.compile(r"""
+	\s*(?:
+		(?P<paren>[()])
+		| (?P<dimension>[a-z_]+)\s*(?P<op><=|>=|[:=<>])\s*(?P<value>"[^"]*"|[^\s()"]+)
+		| (?P<word>[a-z]+)
+		| (?P<junk>\S)
+	)""", re.I | re.X)
+
+
+class CohortSyntaxError(ValueError):
+	pass
+
+
+def positions_bitmap(positions):
+	"""
+	Bitmap with the bits of `positions` set
+	"""
+	if not positions:
+		return 0
+	bits = bytearray(max(positions) // 8 + 1)
+	for position in positions:
+		bits[position >> 3] |= 1 << (position & 7)
+	return int.from_bytes(bits, 'little')
+
+
+def bitmap_positions(bitmap, limit=None):
+	"""
+	Set positions of a bitmap in ascending order, the first `limit` only
+	"""
+	positions = []
+	for index, byte in enumerate(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')):
+		while byte:
+			low = byte & -byte
+			positions.append(index * 8 + low.bit_length() - 1)
+			if limit is not None and len(positions) >= limit:
+				return positions
+			byte ^= low
+	return positions
+
+
+def compact_posting(positions, size):
+	"""
+	The smaller of a sorted array of positions and a bitmap of `size` bits
+	"""
+	if len(positions) * 32 < size:
+		return array('I', sorted(positions))
+	return positions_bitmap(positions)
+
+
+def parse_cohort(expression):
+	"""
+	Parse a cohort expression into nested tuples: ('term', dimension, op,
+	value, text), ('not', node), ('and', left, right), ('or', left, right)
+	"""
+	tokens = []
+	for match in COHORT_TOKEN.finditer(expression):
+		if match.group('junk'):
+			raise CohortSyntaxError(f"unexpected {match.group('junk')!r} at position {match.start('junk') + 1}")
+		if match.group('paren'):
+			tokens.append(match.group('paren'))
+		elif match.group('word'):
+			word = match.group('word').upper()
+			if word not in ('AND', 'OR', 'NOT'):
+				raise CohortSyntaxError(f"expected dimension:value, AND, OR or NOT, not {match.group('word')!r}")
+			tokens.append(word)
+		elif match.group('dimension'):
+			value = match.group('value')
+			if value.startswith('"'):
+				value = value[1:-1]
+			op = '=' if match.group('op') == ':' else match.group('op')
+			tokens.append(('term', match.group('dimension').lower(), op, value.strip().lower(),
+				match.group(0).strip()))
+	if not tokens:
+		raise CohortSyntaxError("empty cohort expression")
+	position = 0
+
+	def peek():
+		return tokens[position] if position < len(tokens) else None
+
+	def take():
+		nonlocal position
+		position += 1
+		return tokens[position - 1]
+
+	def either():
+		node = both()
+		while peek() == 'OR':
+			take()
+			node = ('or', node, both())
+		return node
+
+	def both():
+		node = negation()
+		while peek() == 'AND' or isinstance(peek(), tuple) or peek() in ('(', 'NOT'):
+			if peek() == 'AND':
+				take()
+			node = ('and', node, negation())
+		return node
+
+	def negation():
+		if peek() == 'NOT':
+			take()
+			return ('not', negation())
+		token = take() if peek() is not None else None
+		if token == '(':
+			node = either()
+			if peek() != ')':
+				raise CohortSyntaxError("missing )")
+			take()
+			return node
+		if isinstance(token, tuple):
+			return token
+		raise CohortSyntaxError(f"expected a term, not {token or 'the end'}")
+
+	node = either()
+	if peek() is not None:
+		token = peek()
+		raise CohortSyntaxError(f"unexpected {token[4] if isinstance(token, tuple) else token}")
+	return node
+
+
+class CohortIndex:
+	"""
+	Bitmaps of the patients having each value of each cohort dimension,
+	built per source (see COHORTS above)
+	"""
+
+	def __init__(self, sources):
+		self.sources = sources
+		# Held while indexing, by one thread at a time; queries never take it
+		self.lock = threading.Lock()
+		self.refresh_lock = threading.Lock()
+		self.refreshing = False
+		self.positions = {}          # subject_id -> position
+		self.subject_ids = []        # position -> subject_id
+		self.universe = 0            # positions of the existing patients
+		self.postings = {}           # dimension -> {value: bitmap or array}
+		self.aliases = {}            # dimension -> {icd code: [code/version]}
+		self.dimensions = {}         # source -> its dimensions
+		self.loaded_at = {}          # source -> time its last indexing started
+		self.invalidated_at = {}     # source -> time its tables last changed
+
+	def scan(self, name):
+		"""
+		Read one source from the database: (dimensions, {dimension: {value:
+		[position]}}, [position of every row])
+		"""
+		groups = {}
+		members = []
+		with connect_primary() as conn:
+			result = conn.execution_options(stream_results=True, yield_per=10000).execute(
+				text(self.sources[name].query))
+			dimensions = [column for column in result.keys() if column != 'subject_id']
+			for dimension in dimensions:
+				groups[dimension] = {}
+			for row in result:
+				position = self.positions.get(row[0])
+				if position is None:
+					# Appended before it is mapped, so a concurrent query never
+					# sees a position without its subject_id
+					self.subject_ids.append(row[0])
+					position = self.positions[row[0]] = len(self.subject_ids) - 1
+				members.append(position)
+				for dimension, value in zip(dimensions, row[1:]):
+					if value is not None:
+						groups[dimension].setdefault(value, []).append(position)
+		return dimensions, groups, members
+
+	def rebuild(self, name):
+		"""
+		Index one source from the database, unless another thread just did.
+		Queries keep using the previous bitmaps until the new ones replace
+		them.
+		"""
+		started = time.perf_counter()
+		with self.lock:
+			if self.fresh(name):
+				return
+			indexed_at = time.time()
+			dimensions, groups, members = self.scan(name)
+
+			size = len(self.subject_ids)
+			postings, aliases = {}, {}
+			for dimension, values in groups.items():
+				postings[dimension] = {value: compact_posting(positions, size) for value, positions in values.items()}
+				aliases[dimension] = {}
+				for value in values:
+					if isinstance(value, str) and '/' in value:
+						aliases[dimension].setdefault(value.rsplit('/', 1)[0], []).append(value)
+			if name == 'patient':
+				self.universe = positions_bitmap(members)
+			self.postings = {**self.postings, **postings}
+			self.aliases = {**self.aliases, **aliases}
+			self.dimensions[name] = dimensions
+			self.loaded_at[name] = indexed_at
+		print(f"Cohort index: {name} indexed in {time.perf_counter() - started:.2f}s")
+
+	def refresh(self, names):
+		"""
+		Reindex `names` in turn; run in the background
+		"""
+		try:
+			for name in names:
+				try:
+					self.rebuild(name)
+				except Exception as e:
+					print(f"Cohort index: {name} not rebuilt, serving the previous bitmaps: {e}")
+		finally:
+			self.refreshing = False
+
+	def ensure_loaded(self, background=True):
+		"""
+		Index the sources that were never indexed, and start reindexing the
+		expired or invalidated ones in the background (without `background`,
+		reindex them before returning)
+		"""
+		stale = []
+		for name in self.sources:
+			if self.fresh(name):
+				continue
+			if name in self.dimensions and background:
+				stale.append(name)
+			else:
+				self.rebuild(name)
+		if not stale:
+			return
+		# Bitmaps the database cannot refresh are served as stale
+		if db_breaker.is_open and has_request_context():
+			mark_stale(current_route())
+		with self.refresh_lock:
+			if self.refreshing:
+				return
+			self.refreshing = True
+		threading.Thread(target=self.refresh, args=(stale,), name='cohort-index', daemon=True).start()
+
+	def after_fork(self):
+		"""
+		In a forked worker: the locks and the refreshing flag are the
+		parent's, whose indexing thread was not forked with it
+		"""
+		self.lock = threading.Lock()
+		self.refresh_lock = threading.Lock()
+		self.refreshing = False
+
+	def invalidate(self, tables=None):
+		"""
+		Reindex the sources that read `tables` (all of them when None) on
+		next use. Returns their names.
+		"""
+		names = [name for name, source in self.sources.items()
+			if tables is None or source.tables & set(tables)]
+		for name in names:
+			self.invalidated_at[name] = time.time()
+		return names
+
+	def fresh(self, name):
+		loaded_at = self.loaded_at.get(name)
+		return (loaded_at is not None and time.time() - loaded_at <= COHORT_INDEX_TTL
+			and loaded_at > self.invalidated_at.get(name, 0))
+
+	def term_bitmap(self, dimension, op, value):
+		postings = self.postings.get(dimension)
+		if postings is None:
+			raise CohortSyntaxError(f"unknown dimension {dimension!r}; use one of {', '.join(sorted(self.postings))}")
+		if op in COHORT_COMPARISONS:
+			try:
+				bound = int(value)
+			except ValueError:
+				raise CohortSyntaxError(f"{dimension} {op} needs a whole number, not {value!r}")
+			keys = [key for key in postings if isinstance(key, int) and COHORT_COMPARISONS[op](key, bound)]
+		elif value in postings:
+			keys = [value]
+		elif value.isdigit() and int(value) in postings:
+			keys = [int(value)]
+		else:
+			keys = self.aliases.get(dimension, {}).get(value, [])
+
+		bitmap = 0
+		for key in keys:
+			posting = postings[key]
+			bitmap |= posting if isinstance(posting, int) else positions_bitmap(posting)
+		return bitmap
+
+	def evaluate(self, node, counts):
+		"""
+		Bitmap of the patients matching a parsed expression; counts gets
+		the patients matching each term
+		"""
+		kind = node[0]
+		if kind == 'term':
+			bitmap = self.term_bitmap(*node[1:4]) & self.universe
+			counts[node[4]] = bitmap.bit_count()
+			return bitmap
+		if kind == 'not':
+			return self.universe & ~self.evaluate(node[1], counts)
+		left, right = self.evaluate(node[1], counts), self.evaluate(node[2], counts)
+		return left & right if kind == 'and' else left | right
+
+	def query(self, expression, limit=COHORT_PAGE_PATIENTS):
+		"""
+		Count the patients matching a cohort expression. Returns a dict with
+		the count, the per-term counts and the first `limit` subject_ids.
+		"""
+		node = parse_cohort(expression)
+		self.ensure_loaded()
+		started = time.perf_counter()
+		counts = {}
+		bitmap = self.evaluate(node, counts)
+		subject_ids = self.subject_ids
+		return {
+			'count': bitmap.bit_count(),
+			'patients': self.universe.bit_count(),
+			'terms': counts,
+			'subject_ids': [subject_ids[position] for position in bitmap_positions(bitmap, limit)] if limit else [],
+			'elapsed_ms': round((time.perf_counter() - started) * 1000, 3)
+		}
+
+	def stats(self):
+		postings = self.postings
+		values = sum(len(values) for values in postings.values())
+		arrays = [posting for values in postings.values() for posting in values.values() if not isinstance(posting, int)]
+		return {
+			'patients': self.universe.bit_count(),
+			'dimensions': {dimension: len(values) for dimension, values in sorted(postings.items())},
+			'values': values,
+			'array_postings': len(arrays),
+			'bitmap_postings': values - len(arrays),
+			'bytes': sum(posting.buffer_info()[1] * posting.itemsize for posting in arrays)
+				+ sum((posting.bit_length() + 7) // 8 for values in postings.values()
+					for posting in values.values() if isinstance(posting, int)),
+			'indexed_at': {name: datetime.fromtimestamp(loaded_at).isoformat(timespec='seconds')
+				for name, loaded_at in sorted(self.loaded_at.items())}
+		}
+
+
+cohort_index = CohortIndex(COHORT_SOURCES)
+
+
+@app.route('/cohort')
+def cohort():
+	"""
+	Count and list the patients matching a cohort expression (?q=)
+	"""
+	expression = request.args.get('q', '').strip()
+	result, error = None, None
+	if expression:
+		try:
+			result = cohort_index.query(expression)
+		except CohortSyntaxError as e:
+			error = str(e)
+		except Exception as e:
+			print(f"Error evaluating cohort: {e}")
+			error = "The cohort index could not be built; try again later."
+	return render_template("cohort.html", expression=expression, result=result, error=error,
+		dimensions=cohort_index.stats()['dimensions'])
+
+
+@app.route('/api/v1/cohort')
+def api_cohort():
+	"""
+	A cohort as JSON: ?q= is the expression, ?limit= how many subject_ids
+	to return (0 for the count only)
+	"""
+	expression = request.args.get('q', '').strip()
+	limit = max(0, min(request.args.get('limit', COHORT_PAGE_PATIENTS, type=int), COHORT_MAX_PATIENTS))
+	try:
+		result = cohort_index.query(expression, limit)
+	except CohortSyntaxError as e:
+		raise ApiError(str(e))
+	return api_response({'expression': expression, **result})
+
+
+@app.route('/api/cohort/stats')
+def cohort_stats():
+	"""
+	Size and freshness of the cohort index as JSON
+	"""
+	return jsonify(cohort_index.stats())
+
+
+# ==========================================
+# SCHEMA MIGRATIONS AND INDEX ADVISOR
+# ==========================================
+
+#
+# Indexes behind the routes' access paths, applied in order by
+# `python server.py migrate` and recorded in wl2822.schema_migrations.
+# Append new migrations with the next version; never renumber or edit an
+# applied one.
+#
+# (version, index name, CREATE INDEX statement)
+INDEX_MIGRATIONS = [
+	# Patient timeline admissions, /admissions?subject_id=, admission counts
+	(1, 'admission_subject_intime_idx',
+		"CREATE INDEX CONCURRENTLY IF NOT EXISTS admission_subject_intime_idx ON wl2822.admission (subject_id, admission_intime)"),
+	# Condition detail and /conditions aggregation
+	(2, 'admission_diagnosis_icd_idx',
+		"CREATE INDEX CONCURRENTLY IF NOT EXISTS admission_diagnosis_icd_idx ON wl2822.admission_diagnosis (icd_code, icd_version)"),
+	# Patient timeline prescriptions (first 20 per admission), admission summary
+	(3, 'prescription_hadm_start_idx',
+		"CREATE INDEX CONCURRENTLY IF NOT EXISTS prescription_hadm_start_idx ON wl2822.prescription (hadm_id, start_time)"),
+	# /medications aggregation
+	(4, 'prescription_medication_idx',
+		"CREATE INDEX CONCURRENTLY IF NOT EXISTS prescription_medication_idx ON wl2822.prescription (medication_id)"),
+	# Patient timeline orders (first 20 per admission)
+	(5, 'orders_hadm_time_idx',
+		"CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_hadm_time_idx ON wl2822.orders (hadm_id, order_time)"),
+	# Patient timeline procedures
+	(6, 'procedures_performed_hadm_idx',
+		"CREATE INDEX CONCURRENTLY IF NOT EXISTS procedures_performed_hadm_idx ON wl2822.procedures_performed (hadm_id)"),
+	# Patient timeline images
+	(7, 'medical_images_hadm_date_idx',
+		"CREATE INDEX CONCURRENTLY IF NOT EXISTS medical_images_hadm_date_idx ON wl2822.medical_images (hadm_id, acquisition_date)"),
+	# /admissions date range filters
+	(8, 'admission_intime_hadm_idx',
+		"CREATE INDEX CONCURRENTLY IF NOT EXISTS admission_intime_hadm_idx ON wl2822.admission (admission_intime, hadm_id)"),
+	# Prescriptions by start time (the keyset order before migration 12)
+	(9, 'prescription_start_id_idx',
+		"CREATE INDEX CONCURRENTLY IF NOT EXISTS prescription_start_id_idx ON wl2822.prescription (start_time, prescription_id)"),
+	# /patients age filter
+	(10, 'patient_date_of_birth_idx',
+		"CREATE INDEX CONCURRENTLY IF NOT EXISTS patient_date_of_birth_idx ON wl2822.patient (date_of_birth)"),
+	# /admissions keyset order, admissions without a time last
+	(11, 'admission_intime_coalesced_hadm_idx',
+		"CREATE INDEX CONCURRENTLY IF NOT EXISTS admission_intime_coalesced_hadm_idx ON wl2822.admission "
+		"(COALESCE(admission_intime, CAST('-infinity' AS timestamp)), hadm_id)"),
+	# /prescriptions keyset order, prescriptions without a start time last
+	(12, 'prescription_start_coalesced_id_idx',
+		"CREATE INDEX CONCURRENTLY IF NOT EXISTS prescription_start_coalesced_id_idx ON wl2822.prescription "
+		"(COALESCE(start_time, CAST('-infinity' AS timestamp)), prescription_id)"),
+]
+
+# Pages the advisor requests to collect each route's statements; filled
+# from sample_advisor_values()
+ADVISOR_PAGES = [
+	'/',
+	'/patients',
+	'/patients?sex=m&min_age=40&max_age=80',
+	'/patient/{subject_id}',
+	'/conditions',
+	'/conditions?search={condition_word}',
+	'/condition/{icd_code}/{icd_version}',
+	'/admissions',
+	'/admissions?subject_id={subject_id}',
+	'/admissions?admission_type={admission_type}',
+	'/analytics',
+	'/trends',
+	'/medications',
+	'/medications?search={medication_word}',
+	'/prescriptions',
+	'/prescriptions?subject_id={subject_id}',
+	'/procedures',
+	'/export/condition/{icd_code}/{icd_version}.csv',
+]
+
+
+def apply_index_migrations(engine, log=print):
+	"""
+	Apply the INDEX_MIGRATIONS not yet recorded in wl2822.schema_migrations.
+	CREATE INDEX CONCURRENTLY cannot run in a transaction, so this uses an
+	autocommit connection; an invalid index left by an interrupted build is
+	dropped and rebuilt. Returns the versions applied.
+	"""
+	applied = []
+	with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+		conn.execute(text("""
+			CREATE TABLE IF NOT EXISTS wl2822.schema_migrations (
+				version INTEGER PRIMARY KEY,
+				name TEXT NOT NULL,
+				applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+			)
+		"""))
+		done = {row.version for row in conn.execute(text("SELECT version FROM wl2822.schema_migrations"))}
+
+		for version, name, statement in INDEX_MIGRATIONS:
+			if version in done:
+				continue
+			invalid = conn.execute(text("""
+				SELECT NOT i.indisvalid
+				FROM pg_index i
+				JOIN pg_class c ON c.oid = i.indexrelid
+				JOIN pg_namespace n ON n.oid = c.relnamespace
+				WHERE n.nspname = 'wl2822' AND c.relname = :name
+			"""), {'name': name}).scalar()
+			if invalid:
+				log(f"dropping invalid index {name}")
+				conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS wl2822.{name}"))
+
+			started = time.perf_counter()
+			conn.execute(text(statement))
+			conn.execute(text("""
+				INSERT INTO wl2822.schema_migrations (version, name) VALUES (:version, :name)
+			"""), {'version': version, 'name': name})
+			log(f"{version:>4}  {name}  ({time.perf_counter() - started:.1f}s)")
+			applied.append(version)
+	return applied
 
-		if not condition:
-			return "Condition not found", 404
 
-		# Get all patients diagnosed with this condition
-		patients_query = text("""
-			SELECT
-				p.subject_id,
-				p.sex,
-				p.date_of_birth,
-				p.race,
-				2110 - EXTRACT(YEAR FROM p.date_of_birth) as age,
-				ad.hadm_id,
-				ad.diagnosed_on,
-				ad.rank,
-				a.admission_intime,
-				a.admission_type
-			FROM wl2822.admission_diagnosis ad
-			JOIN wl2822.patient p ON ad.subject_id = p.subject_id
-			JOIN wl2822.admission a ON ad.hadm_id = a.hadm_id
-			WHERE ad.icd_code = :icd_code AND ad.icd_version = :icd_version
-			ORDER BY ad.diagnosed_on DESC, ad.rank
-			LIMIT 200
-		""")
-		patients = g.conn.execute(patients_query, {
-			'icd_code': icd_code,
-			'icd_version': icd_version
-		}).fetchall()
-
-		# Get statistics
-		stats_query = text("""
-			SELECT
-				COUNT(DISTINCT subject_id) as total_patients,
-				COUNT(*) as total_diagnoses,
-				AVG(rank) as avg_rank,
-				MIN(diagnosed_on) as first_diagnosis,
-				MAX(diagnosed_on) as latest_diagnosis
-			FROM wl2822.admission_diagnosis
-			WHERE icd_code = :icd_code AND icd_version = :icd_version
-		""")
-		stats = g.conn.execute(stats_query, {
-			'icd_code': icd_code,
-			'icd_version': icd_version
-		}).fetchone()
+def sample_advisor_values(conn):
+	"""
+	Real ids and search words to fill ADVISOR_PAGES with
+	"""
+	admission = conn.execute(text("""
+		SELECT subject_id, admission_type FROM wl2822.admission
+		WHERE admission_type IS NOT NULL LIMIT 1
+	""")).fetchone()
+	diagnosis = conn.execute(text("""
+		SELECT ad.icd_code, ad.icd_version, c.condition_name
+		FROM wl2822.admission_diagnosis ad
+		JOIN wl2822.condition c ON c.icd_code = ad.icd_code AND c.icd_version = ad.icd_version
+		LIMIT 1
+	""")).fetchone()
+	medication = conn.execute(text("SELECT name FROM wl2822.medication WHERE name IS NOT NULL LIMIT 1")).scalar()
+	if admission is None or diagnosis is None:
+		raise RuntimeError("the index advisor needs at least one admission and one diagnosis")
 
-		return render_template("condition_detail.html",
-			condition=condition,
-			patients=patients,
-			stats=stats)
+	def first_word(value):
+		words = [word for word in (value or '').split() if len(word) >= 3]
+		return words[0].lower() if words else 'a'
 
-	except Exception as e:
-		print(f"Error fetching condition details: {e}")
-		import traceback
-		traceback.print_exc()
-		return f"Error loading condition: {str(e)}", 500
+	return {
+		'subject_id': admission.subject_id,
+		'admission_type': admission.admission_type,
+		'icd_code': diagnosis.icd_code,
+		'icd_version': diagnosis.icd_version,
+		'condition_word': first_word(diagnosis.condition_name),
+		'medication_word': first_word(medication)[:4]
+	}
 
 
-# ==========================================
-# ADMISSION ROUTES
-# ==========================================
+def seq_scans(plan):
+	"""
+	The Seq Scan nodes of an EXPLAIN (FORMAT JSON) plan tree
+	"""
+	found = []
+	if plan.get('Node Type') == 'Seq Scan':
+		found.append(plan)
+	for child in plan.get('Plans', []):
+		found.extend(seq_scans(child))
+	return found
 
-@app.route('/admissions')
-def admissions():
+
+def explain_routes(engine, min_rows=1000):
 	"""
-	Admission search and browse functionality
+	Request every ADVISOR_PAGES page, EXPLAIN each distinct statement the
+	routes ran and return [(route, statement, [seq scan nodes])]. Seq scans
+	of tables with fewer than `min_rows` rows are left out, since an index
+	would not help there.
 	"""
-	# Get filter parameters
-	hadm_id = request.args.get('hadm_id', type=int)
-	subject_id = request.args.get('subject_id', type=int)
-	admission_type = request.args.get('admission_type', '')
-	admission_location = request.args.get('admission_location', '')
-	from_date = request.args.get('from_date', '')
-	to_date = request.args.get('to_date', '')
+	global captured_statements
+	from urllib.parse import quote
 
-	# Build query with filters
-	query = text("""
-		SELECT
-			a.*,
-			p.sex,
-			p.race,
-			2110 - EXTRACT(YEAR FROM p.date_of_birth) as patient_age,
-			COUNT(DISTINCT ad.icd_code) as diagnosis_count,
-			COUNT(DISTINCT pr.prescription_id) as prescription_count
-		FROM wl2822.admission a
-		JOIN wl2822.patient p ON a.subject_id = p.subject_id
-		LEFT JOIN wl2822.admission_diagnosis ad ON a.hadm_id = ad.hadm_id
-		LEFT JOIN wl2822.prescription pr ON a.hadm_id = pr.hadm_id
-		WHERE 1=1
-			AND (:hadm_id IS NULL OR a.hadm_id = :hadm_id)
-			AND (:subject_id IS NULL OR a.subject_id = :subject_id)
-			AND (:admission_type = '' OR a.admission_type = :admission_type)
-			AND (:admission_location = '' OR a.admission_location = :admission_location)
-			AND (:from_date = '' OR a.admission_intime >= :from_date::timestamp)
-			AND (:to_date = '' OR a.admission_intime <= :to_date::timestamp)
-		GROUP BY a.hadm_id, a.subject_id, a.admission_intime, a.admission_outtime,
-				 a.admission_type, a.admission_location, a.discharge_location,
-				 p.sex, p.race, p.date_of_birth
-		ORDER BY a.admission_intime DESC
-		LIMIT 100
-	""")
+	with engine.connect() as conn:
+		values = {key: quote(str(value)) for key, value in sample_advisor_values(conn).items()}
 
+	captured_statements = []
 	try:
-		result = g.conn.execute(query, {
-			'hadm_id': hadm_id,
-			'subject_id': subject_id,
-			'admission_type': admission_type,
-			'admission_location': admission_location,
-			'from_date': from_date,
-			'to_date': to_date
-		})
-		admissions = result.fetchall()
-	except Exception as e:
-		print(f"Error fetching admissions: {e}")
-		import traceback
-		traceback.print_exc()
-		admissions = []
+		client = app.test_client()
+		for page in ADVISOR_PAGES:
+			url = page.format(**values)
+			response = client.get(url)
+			response.get_data()
+			if response.status_code != 200:
+				print(f"warning: {url} returned {response.status_code}")
+		statements = captured_statements
+	finally:
+		captured_statements = None
 
-	# Get unique admission types and locations for filter dropdowns
+	report = []
+	seen = set()
+	explain_state.active = True
 	try:
-		types_result = g.conn.execute(text("SELECT DISTINCT admission_type FROM wl2822.admission ORDER BY admission_type"))
-		admission_types = [row[0] for row in types_result.fetchall()]
+		with engine.connect() as conn:
+			# Planner row estimates per table (-1 until first analyzed)
+			table_rows = dict(conn.execute(text("""
+				SELECT c.relname, c.reltuples FROM pg_class c
+				JOIN pg_namespace n ON n.oid = c.relnamespace
+				WHERE n.nspname = 'wl2822' AND c.relkind IN ('r', 'p', 'm')
+			""")).fetchall())
+			for route, statement, parameters in statements:
+				first_word = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+				if first_word not in ('SELECT', 'WITH') or (route, statement) in seen:
+					continue
+				seen.add((route, statement))
+				plan = conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+				conn.rollback()
+				if isinstance(plan, str):
+					plan = json.loads(plan)
+				scans = [node for node in seq_scans(plan[0]['Plan'])
+					if table_rows.get(node.get('Relation Name'), -1) < 0
+					or table_rows[node['Relation Name']] >= min_rows]
+				report.append((route, statement, scans))
+	finally:
+		explain_state.active = False
+	return report
 
-		locations_result = g.conn.execute(text("SELECT DISTINCT admission_location FROM wl2822.admission ORDER BY admission_location"))
-		admission_locations = [row[0] for row in locations_result.fetchall()]
-	except Exception as e:
-		print(f"Error fetching filter options: {e}")
-		admission_types = []
-		admission_locations = []
 
-	return render_template("admissions.html",
-		admissions=admissions,
-		admission_types=admission_types,
-		admission_locations=admission_locations)
+def print_explain_report(report):
+	"""
+	Print the routes' statements with their sequential scans. Returns the
+	number of statements that have any.
+	"""
+	flagged = 0
+	for route, statement, scans in report:
+		if not scans:
+			continue
+		flagged += 1
+		print(f"\n[{route}] {' '.join(statement.split())[:160]}")
+		for node in scans:
+			condition = f" filter: {node['Filter']}" if node.get('Filter') else ''
+			print(f"    Seq Scan on {node.get('Relation Name')}{condition}")
+	print(f"\n{len(report)} statements explained, {flagged} with sequential scans")
+	return flagged
 
 
 # ==========================================
-# ANALYTICS DASHBOARD
+# BULK LOAD
 # ==========================================
 
-@app.route('/analytics')
-def analytics():
-	"""
-	Comprehensive analytics dashboard with multiple aggregation queries
-	"""
-	try:
-		# 1. Top 10 most common diagnoses
-		top_diagnoses_query = text("""
-			SELECT
-				c.condition_name,
-				c.icd_code,
-				COUNT(DISTINCT ad.subject_id) as patient_count,
-				COUNT(*) as total_diagnoses
-			FROM wl2822.condition c
-			JOIN wl2822.admission_diagnosis ad
-				ON c.icd_code = ad.icd_code
-				AND c.icd_version = ad.icd_version
-			GROUP BY c.condition_name, c.icd_code
-			ORDER BY patient_count DESC
-			LIMIT 10
-		""")
-		top_diagnoses = g.conn.execute(top_diagnoses_query).fetchall()
-
-		# 2. Top 10 most prescribed medications
-		top_medications_query = text("""
-			SELECT
-				m.name as medication_name,
-				m.strength,
-				COUNT(*) as prescription_count
-			FROM wl2822.medication m
-			JOIN wl2822.prescription p ON m.medication_id = p.medication_id
-			GROUP BY m.name, m.strength
-			ORDER BY prescription_count DESC
-			LIMIT 10
-		""")
-		top_medications = g.conn.execute(top_medications_query).fetchall()
-
-		# 3. Admission statistics by type
-		admission_stats_query = text("""
-			SELECT
-				admission_type,
-				COUNT(*) as admission_count,
-				COUNT(DISTINCT subject_id) as unique_patients,
-				AVG(EXTRACT(days FROM (admission_outtime::timestamp - admission_intime::timestamp))) as avg_length_days
-			FROM wl2822.admission
-			WHERE admission_outtime IS NOT NULL
-			GROUP BY admission_type
-			ORDER BY admission_count DESC
-		""")
-		admission_stats = g.conn.execute(admission_stats_query).fetchall()
-
-		# 4. Patient demographics breakdown
-		demographics_query = text("""
-			SELECT
-				p.sex,
-				p.race,
-				COUNT(DISTINCT p.subject_id) as patient_count,
-				AVG(2110 - EXTRACT(YEAR FROM p.date_of_birth)) as avg_age
-			FROM wl2822.patient p
-			LEFT JOIN wl2822.admission a ON p.subject_id = a.subject_id
-			GROUP BY p.sex, p.race
-			ORDER BY patient_count DESC
-			LIMIT 15
-		""")
-		demographics = g.conn.execute(demographics_query).fetchall()
-
-		# 5. Medical imaging statistics
-		imaging_stats_query = text("""
-			SELECT
-				viewpoint,
-				COUNT(*) as image_count,
-				COUNT(DISTINCT subject_id) as patient_count
-			FROM wl2822.medical_images
-			GROUP BY viewpoint
-			ORDER BY image_count DESC
-		""")
-		imaging_stats = g.conn.execute(imaging_stats_query).fetchall()
-
-		# 6. Provider order statistics
-		provider_stats_query = text("""
-			SELECT
-				p.provider_id,
-				COUNT(DISTINCT o.hadm_id) as admissions_served,
-				COUNT(o.poe_id) as total_orders,
-				COUNT(DISTINCT o.order_type) as order_types
-			FROM wl2822.provider p
-			LEFT JOIN wl2822.orders o ON p.provider_id = o.order_provider_id
-			GROUP BY p.provider_id
-			ORDER BY total_orders DESC
-			LIMIT 10
-		""")
-		provider_stats = g.conn.execute(provider_stats_query).fetchall()
-
-		# 7. Monthly admission trends (last 12 months of data)
-		monthly_trends_query = text("""
-			SELECT
-				TO_CHAR(admission_intime, 'YYYY-MM') as month,
-				COUNT(*) as admission_count,
-				COUNT(DISTINCT subject_id) as unique_patients
-			FROM wl2822.admission
-			GROUP BY TO_CHAR(admission_intime, 'YYYY-MM')
-			ORDER BY month DESC
-			LIMIT 12
-		""")
-		monthly_trends = g.conn.execute(monthly_trends_query).fetchall()
-
-		# 8. Overall database statistics
-		overall_stats = {
-			'patient_count': g.conn.execute(text('SELECT COUNT(*) FROM wl2822.patient')).scalar(),
-			'admission_count': g.conn.execute(text('SELECT COUNT(*) FROM wl2822.admission')).scalar(),
-			'prescription_count': g.conn.execute(text('SELECT COUNT(*) FROM wl2822.prescription')).scalar(),
-			'condition_count': g.conn.execute(text('SELECT COUNT(*) FROM wl2822.condition')).scalar(),
-			'medication_count': g.conn.execute(text('SELECT COUNT(*) FROM wl2822.medication')).scalar(),
-			'image_count': g.conn.execute(text('SELECT COUNT(*) FROM wl2822.medical_images')).scalar(),
-			'provider_count': g.conn.execute(text('SELECT COUNT(*) FROM wl2822.provider')).scalar(),
-			'procedure_count': g.conn.execute(text('SELECT COUNT(*) FROM wl2822.procedures_performed')).scalar()
-		}
+#
+# `python server.py ingest` loads CSV / CSV.gz extracts with COPY (see
+# bulk_load.py), then brings everything the app derives from the loaded
+# tables up to date: planner statistics and the analytics snapshot in the
+# database, and the in-process caches of running servers, which it asks to
+# drop through POST /api/caches/invalidate. The row counters stay
+# trigger-maintained during a load; the admission summary triggers are
+# switched off instead, since parallel loads of the child tables would
+# queue on the same summary rows, and the summary is rebuilt once after.
+# The data version triggers are switched off for the same reason; the
+# loaded tables' epochs are bumped after. So are the rollup change log
+# triggers, which would copy every loaded row to the log: the loaded
+# sources' rollups are rebuilt instead.
+#
+LOAD_DEFERRED_TRIGGERS = ('admission_summary_add', 'admission_summary_remove', 'admission_summary_move',
+	'data_versions_insert', 'data_versions_delete', 'data_versions_update',
+	'rollup_log_insert', 'rollup_log_delete', 'rollup_log_update')
 
-		return render_template("analytics.html",
-			top_diagnoses=top_diagnoses,
-			top_medications=top_medications,
-			admission_stats=admission_stats,
-			demographics=demographics,
-			imaging_stats=imaging_stats,
-			provider_stats=provider_stats,
-			monthly_trends=monthly_trends,
-			overall_stats=overall_stats)
+# Catalog search index built from each table
+SEARCH_INDEX_SOURCES = {
+	'condition': condition_index,
+	'medication': medication_index,
+	'procedures': procedure_index
+}
 
-	except Exception as e:
-		print(f"Error loading analytics: {e}")
-		import traceback
-		traceback.print_exc()
-		return f"Error loading analytics: {str(e)}", 500
 
+# Tables maintained from others, whose cached results go stale with them
+DERIVED_TABLES = {
+	'admission_summary': {'admission'} | set(ADMISSION_SUMMARY_COLUMNS.values()),
+	'table_counts': set(COUNTED_TABLES),
+	**{table: {source.table} for source in ROLLUP_SOURCES.values() for table in source.tables}
+}
 
-# ==========================================
-# MEDICATION ROUTES
-# ==========================================
 
-@app.route('/medications')
-def medications():
+def invalidate_caches(tables=None, broadcast=True):
 	"""
-	Medication catalog with search functionality
+	Drop this process' cached data derived from `tables` (every table when
+	None) and the shared result cache's; with `broadcast`, the other
+	`serve` workers drop theirs before their next request. Returns the
+	names of the caches dropped.
 	"""
-	search = request.args.get('search', '')
-	form = request.args.get('form', '')
+	dropped = []
+	# The shared result cache is dropped once, by the worker broadcasting
+	if result_cache is not None and (broadcast or not isinstance(result_cache.store, SharedResultStore)):
+		affected = None if tables is None else set(tables) | {
+			derived for derived, sources in DERIVED_TABLES.items() if sources & set(tables)}
+		result_cache.invalidate(affected)
+		dropped.append('results')
+	for table in FACET_COLUMNS:
+		if tables is None or table in tables:
+			facet_cache.invalidate(table)
+			dropped.append(f'facets:{table}')
+	for table, index in SEARCH_INDEX_SOURCES.items():
+		if tables is None or table in tables:
+			index.invalidate()
+			dropped.append(f'search:{index.name}')
+	for name in cohort_index.invalidate(tables):
+		dropped.append(f'cohort:{name}')
+	if broadcast and broadcast_invalidation(tables):
+		dropped.append('workers')
+	return dropped
 
-	# Build query with filters
-	query = text("""
-		SELECT
-			m.medication_id,
-			m.name,
-			m.strength,
-			m.form,
-			COUNT(DISTINCT p.subject_id) as patient_count,
-			COUNT(p.prescription_id) as prescription_count
-		FROM wl2822.medication m
-		LEFT JOIN wl2822.prescription p ON m.medication_id = p.medication_id
-		WHERE
-			(:search = '' OR LOWER(m.name) LIKE LOWER(:search_pattern))
-			AND (:form = '' OR m.form = :form)
-		GROUP BY m.medication_id, m.name, m.strength, m.form
-		ORDER BY prescription_count DESC NULLS LAST, m.name
-		LIMIT 100
-	""")
 
-	try:
-		search_pattern = f'%{search}%' if search else ''
-		result = g.conn.execute(query, {
-			'search': search,
-			'search_pattern': search_pattern,
-			'form': form
-		})
-		medications = result.fetchall()
+@app.route('/api/caches/invalidate', methods=['POST'])
+@admin_only
+def invalidate_caches_endpoint():
+	"""
+	Drop cached data derived from the tables given as ?table= (repeatable;
+	every table when absent), e.g. after a bulk load
+	"""
+	tables = request.args.getlist('table') or None
+	return jsonify(invalidated=invalidate_caches(tables))
 
-		# Get unique medication forms for filter dropdown
-		forms_result = g.conn.execute(text("SELECT DISTINCT form FROM wl2822.medication WHERE form IS NOT NULL ORDER BY form"))
-		medication_forms = [row[0] for row in forms_result.fetchall()]
 
-	except Exception as e:
-		print(f"Error fetching medications: {e}")
-		import traceback
-		traceback.print_exc()
-		medications = []
-		medication_forms = []
+def refresh_after_load(tables, server_urls=(), log=print):
+	"""
+	Bring derived data up to date after `tables` were bulk loaded, and ask
+	the servers at `server_urls` to drop their caches
+	"""
+	with engine.begin() as conn:
+		conn.execute(text("ANALYZE " + ", ".join(f"wl2822.{table}" for table in sorted(tables))))
+		has_snapshot = conn.execute(text("SELECT to_regclass('wl2822.analytics_snapshot') IS NOT NULL")).scalar()
+		has_summary = conn.execute(text("SELECT to_regclass('wl2822.admission_summary') IS NOT NULL")).scalar()
+		has_rollups = conn.execute(text("SELECT to_regclass('wl2822.rollup_changes') IS NOT NULL")).scalar()
+		if conn.execute(text("SELECT to_regclass('wl2822.data_versions') IS NOT NULL")).scalar():
+			bump_data_versions(conn, data_version_resets(tables))
+	log(f"analyzed {len(tables)} table(s)")
 
-	return render_template("medications.html",
-		medications=medications,
-		medication_forms=medication_forms,
-		search=search)
+	if has_summary and set(tables) & ({'admission'} | set(ADMISSION_SUMMARY_COLUMNS.values())):
+		with engine.begin() as conn:
+			refresh_admission_summary(conn)
+		log("admission summary rebuilt")
+
+	if has_snapshot:
+		log(f"analytics snapshot refreshed at {refresh_analytics_snapshot()}")
+
+	rollup_sources = [name for name, source in ROLLUP_SOURCES.items() if source.table in tables]
+	if has_rollups and rollup_sources:
+		refresh_rollups(full=True, sources=rollup_sources, log=log)
+
+	invalidate_caches(tables)
+	query = urllib.parse.urlencode([('table', table) for table in sorted(tables)])
+	for url in server_urls:
+		try:
+			invalidate_request = urllib.request.Request(url.rstrip('/') + '/api/caches/invalidate?' + query, method='POST',
+				headers={'X-Admin-Token': ADMIN_TOKEN} if ADMIN_TOKEN else {})
+			with urllib.request.urlopen(invalidate_request, timeout=30) as response:
+				log(f"{url}: dropped {', '.join(json.loads(response.read())['invalidated']) or 'nothing'}")
+		except Exception as e:
+			log(f"{url}: could not invalidate caches: {e}")
 
 
 # ==========================================
-# PRESCRIPTION ROUTES
+# SERVE MODE
 # ==========================================
 
-@app.route('/prescriptions')
-def prescriptions():
-	"""
-	Prescription browser with filtering
-	"""
-	# Get filter parameters
-	subject_id = request.args.get('subject_id', type=int)
-	medication_name = request.args.get('medication_name', '')
-	route = request.args.get('route', '')
-	from_date = request.args.get('from_date', '')
-	to_date = request.args.get('to_date', '')
+#
+# `python server.py serve` runs the app under the prefork server in
+# prefork.py: a master process that forks one worker per core, each serving
+# requests from a fixed pool of threads. The settings are the defaults of
+# its options:
+#
+#     WEB_WORKERS              worker processes (default: CPU count)
+#     WEB_THREADS              request threads per worker
+#     WEB_MAX_REQUESTS         requests after which a worker is replaced
+#                              (0 never)
+#     WEB_MAX_REQUESTS_JITTER  random extra requests per worker, so they do
+#                              not all recycle at once
+#     WEB_GRACEFUL_TIMEOUT     seconds a stopping worker gets to finish
+#     WEB_KEEPALIVE            seconds an idle keep-alive connection is kept
+#     WEB_RESTART_INTERVAL     least seconds between graceful restarts;
+#                              SIGHUPs received sooner are combined into
+#                              one at the end of the interval
+#     METRICS_DIR              where the workers share their metrics and
+#                              cache invalidations (default: a temporary
+#                              directory of the master's)
+#
+# Each worker has its own connection pool, so the database sees up to
+# WEB_WORKERS * (DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW) connections.
+#
+# Caches live in each worker. The worker that drops some appends the tables
+# to INVALIDATION_LOG in METRICS_DIR, and every worker replays the entries
+# it has not seen yet before its next request, so an invalidation costs the
+# others only the caches it names, not a restart.
+#
+WEB_WORKERS = env_int('WEB_WORKERS', os.cpu_count() or 1)
+WEB_THREADS = env_int('WEB_THREADS', 4)
+WEB_MAX_REQUESTS = env_int('WEB_MAX_REQUESTS', 0)
+WEB_MAX_REQUESTS_JITTER = env_int('WEB_MAX_REQUESTS_JITTER', 0)
+WEB_GRACEFUL_TIMEOUT = env_float('WEB_GRACEFUL_TIMEOUT', 30)
+WEB_KEEPALIVE = env_float('WEB_KEEPALIVE', 5)
+WEB_RESTART_INTERVAL = env_float('WEB_RESTART_INTERVAL', 10)
 
-	# Build query with filters
-	query = text("""
-		SELECT
-			p.prescription_id,
-			a.subject_id,
-			p.hadm_id,
-			m.name as medication_name,
-			m.strength,
-			m.form,
-			p.dose,
-			p.route,
-			p.frequency,
-			p.start_time,
-			p.end_time,
-			pat.sex,
-			2110 - EXTRACT(YEAR FROM pat.date_of_birth) as patient_age
-		FROM wl2822.prescription p
-		JOIN wl2822.medication m ON p.medication_id = m.medication_id
-		JOIN wl2822.admission a ON p.hadm_id = a.hadm_id
-		JOIN wl2822.patient pat ON a.subject_id = pat.subject_id
-		WHERE (:subject_id IS NULL OR a.subject_id = :subject_id)
-			AND (:medication_name = '' OR LOWER(m.name) LIKE LOWER(:medication_pattern))
-			AND (:route = '' OR p.route = :route)
-			AND (:from_date = '' OR p.start_time >= :from_date::timestamp)
-			AND (:to_date = '' OR p.start_time <= :to_date::timestamp)
-		ORDER BY p.start_time DESC
-		LIMIT 100
-	""")
+# Set in `serve` workers: the master's pid and this worker's number
+prefork_master = None
+worker_index = None
+started_at = time.time()
 
-	try:
-		medication_pattern = f'%{medication_name}%' if medication_name else ''
-		result = g.conn.execute(query, {
-			'subject_id': subject_id,
-			'medication_name': medication_name,
-			'medication_pattern': medication_pattern,
-			'route': route,
-			'from_date': from_date,
-			'to_date': to_date
-		})
-		prescriptions = result.fetchall()
+INVALIDATION_LOG = 'invalidations.log'
 
-		# Get unique routes for filter dropdown
-		routes_result = g.conn.execute(text("SELECT DISTINCT route FROM wl2822.prescription WHERE route IS NOT NULL ORDER BY route"))
-		prescription_routes = [row[0] for row in routes_result.fetchall()]
+# Under `serve`, the invalidation log and how far this process has replayed it
+invalidations = {'path': None, 'offset': 0}
+invalidations_lock = threading.Lock()
 
+
+def preload_app():
+	"""
+	Build in the `serve` master what every worker would otherwise build on
+	its first requests (compiled templates, catalog search indexes, the
+	cohort index); the forked workers share it until they change it
+	"""
+	# Invalidations the workers logged since the last warm-up apply here
+	# too, so a restart does not fork them from outdated indexes
+	if invalidations['path'] is None:
+		follow_invalidations(os.environ['METRICS_DIR'])
+	replay_invalidations()
+	for name in app.jinja_env.list_templates():
+		app.jinja_env.get_template(name)
+	try:
+		reload_search_indexes()
 	except Exception as e:
-		print(f"Error fetching prescriptions: {e}")
-		import traceback
-		traceback.print_exc()
-		prescriptions = []
-		prescription_routes = []
+		print(f"Search indexes not preloaded: {e}")
+	try:
+		# In the foreground: an indexing thread would not be forked with
+		# the workers, which would inherit it half done
+		cohort_index.ensure_loaded(background=False)
+	except Exception as e:
+		print(f"Cohort index not preloaded: {e}")
+	# The workers open their own connections
+	engine.dispose()
 
-	return render_template("prescriptions.html",
-		prescriptions=prescriptions,
-		prescription_routes=prescription_routes)
 
+def init_worker(worker, master_pid):
+	"""
+	Set up a freshly forked `serve` worker. Connections pooled before the
+	fork belong to the master, so they are dropped without being closed;
+	the worker's threads, including the analytics and rollup refreshers
+	(worker 0 only), are started here.
+	"""
+	global query_executor, prefork_master, worker_index, started_at
+	engine.dispose(close=False)
+	if replicas is not None:
+		replicas.after_fork()
+	cohort_index.after_fork()
+	query_executor = None
+	prefork_master, worker_index, started_at = master_pid, worker, time.time()
+	if os.environ.get('METRICS_DIR'):
+		metrics.share(os.environ['METRICS_DIR'])
+		# A preloaded worker replays what was logged since the master's warm-up
+		if invalidations['path'] is None:
+			follow_invalidations(os.environ['METRICS_DIR'])
+	if worker == 0 and ANALYTICS_REFRESH_INTERVAL > 0:
+		start_analytics_refresher(ANALYTICS_REFRESH_INTERVAL)
+	if worker == 0 and ROLLUP_REFRESH_INTERVAL > 0:
+		start_rollup_refresher(ROLLUP_REFRESH_INTERVAL)
 
-# ==========================================
-# PROCEDURE ROUTES
-# ==========================================
 
-@app.route('/procedures')
-def procedures():
+def follow_invalidations(directory):
 	"""
-	Procedure catalog with statistics
+	Replay the invalidations logged in `directory` from now on
 	"""
-	search = request.args.get('search', '')
-	icd_version = request.args.get('icd_version', type=int)
+	path = os.path.join(directory, INVALIDATION_LOG)
+	try:
+		offset = os.path.getsize(path)
+	except OSError:
+		offset = 0
+	with invalidations_lock:
+		invalidations['path'], invalidations['offset'] = path, offset
 
-	# Build query with filters - similar to medications
-	query = text("""
-		SELECT
-			pr.icd_code,
-			pr.icd_version,
-			pr.procedure_name,
-			COUNT(DISTINCT pp.subject_id) as patient_count,
-			COUNT(pp.hadm_id) as procedure_count,
-			MIN(pp.procedure_date) as first_performed,
-			MAX(pp.procedure_date) as last_performed
-		FROM wl2822.procedures pr
-		LEFT JOIN wl2822.procedures_performed pp
-			ON pr.icd_code = pp.icd_code
-			AND pr.icd_version = pp.icd_version
-		WHERE
-			(:search = '' OR
-			 LOWER(pr.procedure_name) LIKE LOWER(:search_pattern) OR
-			 pr.icd_code LIKE :search_pattern)
-			AND (:icd_version IS NULL OR pr.icd_version = :icd_version)
-		GROUP BY pr.icd_code, pr.icd_version, pr.procedure_name
-		ORDER BY procedure_count DESC NULLS LAST, patient_count DESC
-		LIMIT 100
-	""")
 
+def broadcast_invalidation(tables):
+	"""
+	Log that `tables` (every table when None) changed, for the other
+	workers to drop their caches. Returns whether it was logged.
+	"""
+	if invalidations['path'] is None:
+		return False
+	entry = json.dumps({'pid': os.getpid(), 'tables': None if tables is None else sorted(tables)}) + '\n'
 	try:
-		search_pattern = f'%{search}%' if search else ''
-		result = g.conn.execute(query, {
-			'search': search,
-			'search_pattern': search_pattern,
-			'icd_version': icd_version
-		})
-		procedures = result.fetchall()
+		# One write in append mode, so entries from concurrent workers never interleave
+		with open(invalidations['path'], 'a') as f:
+			f.write(entry)
+	except OSError as e:
+		print(f"Could not notify the other workers: {e}")
+		return False
+	return True
 
-	except Exception as e:
-		print(f"Error fetching procedures: {e}")
-		import traceback
-		traceback.print_exc()
-		procedures = []
 
-	return render_template("procedures.html",
-		procedures=procedures,
-		search=search)
+@app.before_request
+def replay_invalidations():
+	"""
+	Drop the caches the other workers invalidated since this process last
+	looked; run before every request, and by the master before it forks
+	"""
+	path = invalidations['path']
+	if path is None:
+		return
+	try:
+		size = os.path.getsize(path)
+	except OSError:
+		return
+	if size <= invalidations['offset']:
+		return
+	with invalidations_lock:
+		try:
+			with open(path, 'rb') as f:
+				f.seek(invalidations['offset'])
+				logged = f.read()
+		except OSError as e:
+			print(f"Error reading the invalidation log: {e}")
+			return
+		# A line still being written is read next time
+		logged = logged[:logged.rfind(b'\n') + 1]
+		invalidations['offset'] += len(logged)
+		for line in logged.splitlines():
+			entry = json.loads(line)
+			if entry['pid'] != os.getpid():
+				invalidate_caches(entry['tables'], broadcast=False)
+
+
+@app.route('/healthz')
+def healthz():
+	"""
+	Liveness and database reachability of this process, for load
+	balancers: 200 when a connection can run SELECT 1, 503 otherwise
+	"""
+	health = {
+		'pid': os.getpid(),
+		'worker': worker_index,
+		'uptime_seconds': round(time.time() - started_at, 1)
+	}
+	try:
+		with connect_primary() as conn:
+			conn.execute(text("SELECT 1"))
+		health['database'] = 'ok'
+		status = 200
+	except Exception as e:
+		health['database'] = str(e).splitlines()[0]
+		status = 503
+	health['breaker'] = db_breaker.stats()['state']
+	health['status'] = 'ok' if status == 200 else 'unavailable'
+	return jsonify(health), status
 
 
 # Example of adding new data to the database
@@ -850,9 +5869,21 @@ def login():
 
 
 if __name__ == "__main__":
+	import sys
 	import click
 
-	@click.command()
+	@click.group()
+	@click.pass_context
+	def cli(ctx):
+		"""
+		Medical records web server and maintenance commands
+		"""
+		global DB_STATEMENT_TIMEOUT_MS
+		# Loads, rebuilds and reports may take longer than any page should
+		if ctx.invoked_subcommand not in ('run', 'serve'):
+			DB_STATEMENT_TIMEOUT_MS = 0
+
+	@cli.command()
 	@click.option('--debug', is_flag=True)
 	@click.option('--threaded', is_flag=True)
 	@click.argument('HOST', default='0.0.0.0')
@@ -871,7 +5902,192 @@ if __name__ == "__main__":
 		"""
 
 		HOST, PORT = host, port
+		if ANALYTICS_REFRESH_INTERVAL > 0:
+			start_analytics_refresher(ANALYTICS_REFRESH_INTERVAL)
+		if ROLLUP_REFRESH_INTERVAL > 0:
+			start_rollup_refresher(ROLLUP_REFRESH_INTERVAL)
 		print("running on %s:%d" % (HOST, PORT))
 		app.run(host=HOST, port=PORT, debug=debug, threaded=threaded)
 
-run()
+	@cli.command()
+	@click.option('--workers', default=WEB_WORKERS, show_default=True, help='Worker processes')
+	@click.option('--threads', default=WEB_THREADS, show_default=True, help='Request threads per worker')
+	@click.option('--preload/--no-preload', default=True, show_default=True,
+		help='Load the app once in the master and fork it; --no-preload loads it in each worker, so a HUP restart picks up new code')
+	@click.option('--max-requests', default=WEB_MAX_REQUESTS, show_default=True, help='Replace a worker after this many requests (0 never)')
+	@click.option('--max-requests-jitter', default=WEB_MAX_REQUESTS_JITTER, show_default=True, help='Random extra requests per worker')
+	@click.option('--graceful-timeout', default=WEB_GRACEFUL_TIMEOUT, show_default=True, help='Seconds a stopping worker gets to finish')
+	@click.option('--keepalive', default=WEB_KEEPALIVE, show_default=True, help='Seconds an idle keep-alive connection is kept')
+	@click.argument('HOST', default='0.0.0.0')
+	@click.argument('PORT', default=8111, type=int)
+	def serve(workers, threads, preload, max_requests, max_requests_jitter, graceful_timeout, keepalive, host, port):
+		"""
+		Run the production server: one worker process per core, each with
+		a pool of request threads. SIGHUP restarts the workers gracefully,
+		SIGTERM stops them after the requests in flight.
+		"""
+		import importlib
+		import shutil
+		import prefork
+
+		if threads > POOL_SIZE + POOL_MAX_OVERFLOW:
+			print(f"warning: {threads} threads per worker share {POOL_SIZE + POOL_MAX_OVERFLOW} pooled connections")
+
+		metrics_dir = os.environ.get('METRICS_DIR')
+		created_metrics_dir = not metrics_dir
+		if metrics_dir:
+			os.makedirs(metrics_dir, exist_ok=True)
+			for name in os.listdir(metrics_dir):
+				if name.endswith(('.pickle', '.pickle.tmp')) or name == INVALIDATION_LOG:
+					os.remove(os.path.join(metrics_dir, name))
+		else:
+			metrics_dir = os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='coms4111-metrics-')
+		# The master only folds exited workers' metrics into the retired ones
+		metrics.directory = metrics_dir
+		worker_module = []
+
+		def load_app(worker):
+			# Without preload each worker imports the module from disk
+			module = sys.modules[__name__] if preload else importlib.import_module('server')
+			module.init_worker(worker, os.getppid())
+			worker_module.append(module)
+			return module.app
+
+		def stop_worker():
+			try:
+				worker_module[0].metrics.flush()
+			except Exception as e:
+				print(f"Error writing metrics: {e}")
+
+		try:
+			prefork.Master(load_app, host, port, workers, threads, max_requests, max_requests_jitter,
+				graceful_timeout, keepalive, warm=preload_app if preload else None,
+				restart_interval=WEB_RESTART_INTERVAL, worker_stopped=stop_worker,
+				worker_exited=metrics.retire).run()
+		finally:
+			if created_metrics_dir:
+				shutil.rmtree(metrics_dir, ignore_errors=True)
+
+	@cli.command('refresh-analytics')
+	def refresh_analytics():
+		"""
+		Recompute the /analytics snapshot now.
+		"""
+		started = time.time()
+		refreshed_at = refresh_analytics_snapshot()
+		print("analytics snapshot refreshed at %s (%.2fs)" % (refreshed_at, time.time() - started))
+
+	@cli.command('install-admission-summary')
+	def install_admission_summary_command():
+		"""
+		Install the trigger-maintained per-admission summary table.
+		"""
+		with engine.begin() as conn:
+			install_admission_summary(conn)
+			count = conn.execute(text("SELECT COUNT(*) FROM wl2822.admission_summary")).scalar()
+		print(f"admission summary installed for {count} admissions")
+
+	@cli.command('install-data-versions')
+	def install_data_versions_command():
+		"""
+		Install the trigger-maintained page versions behind the detail
+		pages' ETags.
+		"""
+		with engine.begin() as conn:
+			install_data_versions(conn)
+		print("data versions installed; patient and condition pages now answer conditional requests")
+
+	@cli.command('install-rollups')
+	def install_rollups_command():
+		"""
+		Install the day/week/month trend rollups and fill them.
+		"""
+		with engine.begin() as conn:
+			install_rollups(conn)
+		refresh_rollups(full=True)
+		print("rollups installed; /trends and the dashboard's monthly trends now read them")
+
+	@cli.command('refresh-rollups')
+	@click.option('--full', is_flag=True, help='Rebuild them from scratch instead of applying the logged changes')
+	@click.option('--verify', is_flag=True, help='Compare them with their tables bucket by bucket and rebuild a source that differs')
+	def refresh_rollups_command(full, verify):
+		"""
+		Apply the changes logged since the last refresh to the trend rollups.
+		"""
+		refresh_rollups(full, verify)
+
+	@cli.command('refresh-admission-summary')
+	def refresh_admission_summary_command():
+		"""
+		Rebuild the per-admission summary from the child tables.
+		"""
+		with engine.begin() as conn:
+			refresh_admission_summary(conn)
+		print("admission summary refreshed")
+
+	@cli.command()
+	@click.option('--skip-explain', is_flag=True, help='Only apply the migrations')
+	@click.option('--min-rows', default=1000, show_default=True, help='Ignore seq scans expected to read fewer rows')
+	def migrate(skip_explain, min_rows):
+		"""
+		Apply the pending index migrations, then EXPLAIN every route's
+		statements and report sequential scans.
+		"""
+		applied = apply_index_migrations(engine)
+		print(f"{len(applied)} migration(s) applied" if applied else "schema is up to date")
+		if not skip_explain:
+			sys.exit(1 if print_explain_report(explain_routes(engine, min_rows)) else 0)
+
+	@cli.command('explain-routes')
+	@click.option('--min-rows', default=1000, show_default=True, help='Ignore seq scans expected to read fewer rows')
+	def explain_routes_command(min_rows):
+		"""
+		EXPLAIN every route's statements and report sequential scans; exits
+		with status 1 when any are found.
+		"""
+		sys.exit(1 if print_explain_report(explain_routes(engine, min_rows)) else 0)
+
+	@cli.command()
+	@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+	@click.option('--jobs', default=4, show_default=True, help='Tables loaded at once')
+	@click.option('--batch-rows', default=100000, show_default=True, help='Rows staged and upserted per batch')
+	@click.option('--rebuild-indexes', type=click.Choice(['auto', 'always', 'never']), default='auto', show_default=True,
+		help='Drop and rebuild secondary indexes around a load; auto does so for loads large next to the table. '
+		'The table is locked against reads too until it commits, so use never while serving')
+	@click.option('--notify', 'server_urls', multiple=True, help='Running server whose caches to drop afterwards (repeatable)')
+	def ingest(paths, jobs, batch_rows, rebuild_indexes, server_urls):
+		"""
+		Bulk load <table>.csv / <table>.csv.gz files (or directories of
+		them) with COPY, then refresh derived data. Index rebuilds lock the
+		tables against reads: run them in a maintenance window.
+		"""
+		import bulk_load
+
+		# Each table being loaded holds one pooled connection
+		jobs = max(1, min(jobs, POOL_SIZE + POOL_MAX_OVERFLOW))
+		started = time.perf_counter()
+		try:
+			results = bulk_load.load_files(engine, paths, jobs, batch_rows, rebuild_indexes, LOAD_DEFERRED_TRIGGERS)
+		except ValueError as e:
+			raise click.ClickException(str(e))
+		elapsed = time.perf_counter() - started
+		rows = sum(result.rows for result in results)
+		print(f"loaded {rows} rows from {len(results)} file(s) in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)")
+		refresh_after_load({result.table for result in results}, server_urls)
+
+	@cli.command('install-counters')
+	def install_counters_command():
+		"""
+		Install the trigger-maintained row counter table.
+		"""
+		with engine.begin() as conn:
+			install_counters(conn)
+			counts = fetch_maintained_counts(conn, COUNTED_TABLES)
+		for table in COUNTED_TABLES:
+			print("%-22s %d" % (table, counts[table]))
+		print("set COUNTER_MODE=maintained to use them")
+
+	# `python server.py [--debug] [HOST] [PORT]` still starts the server
+	if len(sys.argv) < 2 or (sys.argv[1] not in cli.commands and sys.argv[1] != '--help'):
+		sys.argv.insert(1, 'run')
+	cli()
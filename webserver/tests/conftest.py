@@ -0,0 +1,60 @@
+"""
+The tests run the web server against a real Postgres database filled by
+generate_data.py, named by TEST_DATABASEURI; they are skipped without it.
+
+    TEST_DATABASEURI=postgresql://localhost/bench python -m pytest tests
+
+The server reaches the database through a DatabaseProxy, so a test can
+simulate an outage.
+"""
+import os
+import sys
+import time
+
+import pytest
+
+from dbproxy import DatabaseProxy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TEST_DATABASEURI = os.environ.get('TEST_DATABASEURI')
+
+
+@pytest.fixture(scope='session')
+def database_proxy():
+	if not TEST_DATABASEURI:
+		pytest.skip("TEST_DATABASEURI is not set")
+	proxy = DatabaseProxy(TEST_DATABASEURI)
+	yield proxy
+	proxy.close()
+
+
+@pytest.fixture(scope='session')
+def server(database_proxy):
+	"""
+	The server module, imported with its engine pointed at the proxy
+	"""
+	os.environ['DATABASEURI'] = database_proxy.uri
+	os.environ.setdefault('DB_BREAKER_PROBE_INTERVAL', '0.2')
+	import server
+	server.app.config['TESTING'] = True
+	return server
+
+
+@pytest.fixture
+def client(server):
+	return server.app.test_client()
+
+
+@pytest.fixture
+def database_outage(server, database_proxy):
+	"""
+	The proxy, for a test to drop; afterwards the database comes back and
+	the test waits for the circuit breaker to close
+	"""
+	yield database_proxy
+	database_proxy.restore()
+	deadline = time.time() + 10
+	while server.db_breaker.is_open and time.time() < deadline:
+		time.sleep(0.05)
+	assert not server.db_breaker.is_open
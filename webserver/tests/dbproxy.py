@@ -0,0 +1,94 @@
+"""
+A TCP proxy in front of the test database, so tests can take the database
+host away and bring it back
+"""
+import socket
+import threading
+
+from sqlalchemy.engine import make_url
+
+
+class DatabaseProxy:
+	"""
+	Forwards 127.0.0.1:<port> to a Postgres server. While down, every open
+	connection is dropped and new ones are closed as soon as they arrive,
+	as with a database host that went away.
+	"""
+
+	def __init__(self, uri):
+		url = make_url(uri)
+		host = url.host or url.query.get('host')
+		port = url.port or 5432
+		if host is None or host.startswith('/'):
+			self.target = (socket.AF_UNIX, f"{host or '/var/run/postgresql'}/.s.PGSQL.{port}")
+		else:
+			self.target = (socket.AF_INET, (host, port))
+		self.down = False
+		self.lock = threading.Lock()
+		self.connections = []
+		self.listener = socket.socket()
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind(('127.0.0.1', 0))
+		self.listener.listen(64)
+		self.port = self.listener.getsockname()[1]
+		self.uri = url.difference_update_query(['host']).set(host='127.0.0.1', port=self.port) \
+			.render_as_string(hide_password=False)
+		threading.Thread(target=self.accept, name='db-proxy', daemon=True).start()
+
+	def accept(self):
+		while True:
+			try:
+				client, _ = self.listener.accept()
+			except OSError:
+				return
+			if self.down:
+				client.close()
+				continue
+			try:
+				upstream = socket.socket(self.target[0])
+				upstream.connect(self.target[1])
+			except OSError:
+				client.close()
+				continue
+			with self.lock:
+				self.connections.append((client, upstream))
+			threading.Thread(target=self.pipe, args=(client, upstream), daemon=True).start()
+			threading.Thread(target=self.pipe, args=(upstream, client), daemon=True).start()
+
+	def pipe(self, source, destination):
+		try:
+			while True:
+				data = source.recv(65536)
+				if not data:
+					break
+				destination.sendall(data)
+		except OSError:
+			pass
+		finally:
+			for sock in (source, destination):
+				try:
+					sock.close()
+				except OSError:
+					pass
+
+	def drop(self):
+		"""
+		Take the database away: close every connection and refuse new ones
+		"""
+		self.down = True
+		with self.lock:
+			connections, self.connections = self.connections, []
+		for pair in connections:
+			for sock in pair:
+				try:
+					sock.shutdown(socket.SHUT_RDWR)
+					sock.close()
+				except OSError:
+					pass
+
+	def restore(self):
+		self.down = False
+
+	def close(self):
+		self.drop()
+		self.listener.close()
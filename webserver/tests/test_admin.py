@@ -0,0 +1,29 @@
+"""
+Admin endpoints only answer local or authenticated requests
+"""
+import pytest
+
+ADMIN_ENDPOINTS = ['/api/caches/invalidate', '/api/search/reload', '/api/facets/invalidate']
+
+
+@pytest.mark.parametrize('path', ADMIN_ENDPOINTS)
+def test_remote_requests_are_refused(client, path):
+	assert client.post(path, environ_base={'REMOTE_ADDR': '10.1.2.3'}).status_code == 403
+
+
+@pytest.mark.parametrize('path', ADMIN_ENDPOINTS)
+def test_proxied_requests_are_not_local(client, path):
+	assert client.post(path, headers={'X-Forwarded-For': '10.1.2.3'}).status_code == 403
+
+
+@pytest.mark.parametrize('path', ADMIN_ENDPOINTS)
+def test_token_is_checked(server, client, monkeypatch, path):
+	remote = {'REMOTE_ADDR': '10.1.2.3'}
+	assert client.post(path, headers={'X-Admin-Token': 'secret'}, environ_base=remote).status_code == 403
+	monkeypatch.setattr(server, 'ADMIN_TOKEN', 'secret')
+	assert client.post(path, headers={'X-Admin-Token': 'wrong'}, environ_base=remote).status_code == 403
+	assert client.post(path, headers={'X-Admin-Token': 'secret'}, environ_base=remote).status_code == 200
+
+
+def test_local_requests_are_allowed(client):
+	assert client.post('/api/caches/invalidate?table=medication').status_code == 200
@@ -0,0 +1,66 @@
+"""
+The cohort bitmap index
+"""
+import json
+import os
+import threading
+import time
+
+
+def test_reindexing_keeps_serving_the_previous_bitmaps(server, monkeypatch):
+	index = server.CohortIndex(server.COHORT_SOURCES)
+	expected = index.query('sex:f', limit=0)['count']
+	release = threading.Event()
+	scan = index.scan
+
+	def slow_scan(name):
+		release.wait(10)
+		return scan(name)
+
+	monkeypatch.setattr(index, 'scan', slow_scan)
+	index.invalidate(['patient'])
+
+	started = time.perf_counter()
+	assert index.query('sex:f', limit=0)['count'] == expected
+	assert index.query('sex:f', limit=0)['count'] == expected
+	assert time.perf_counter() - started < 1
+	assert index.refreshing
+
+	invalidated_at = index.invalidated_at['patient']
+	release.set()
+	deadline = time.time() + 10
+	while index.refreshing and time.time() < deadline:
+		time.sleep(0.01)
+	assert index.loaded_at['patient'] > invalidated_at
+	assert index.query('sex:f', limit=0)['count'] == expected
+
+
+def test_forked_workers_do_not_inherit_the_indexing_thread(server):
+	index = server.CohortIndex(server.COHORT_SOURCES)
+	index.ensure_loaded()
+	# The state a fork in the middle of a background reindex leaves
+	index.lock.acquire()
+	index.refreshing = True
+	index.after_fork()
+	index.invalidate(['patient'])
+	index.ensure_loaded(background=False)
+	assert not index.refreshing
+	assert index.fresh('patient')
+
+
+def test_master_reindexes_what_the_workers_invalidated(server, tmp_path, monkeypatch):
+	monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+	monkeypatch.setattr(server, 'invalidations', {'path': None, 'offset': 0})
+	index = server.CohortIndex(server.COHORT_SOURCES)
+	monkeypatch.setattr(server, 'cohort_index', index)
+	server.preload_app()
+	loaded_at = dict(index.loaded_at)
+
+	with open(tmp_path / server.INVALIDATION_LOG, 'a') as f:
+		f.write(json.dumps({'pid': os.getpid() + 1, 'tables': ['prescription']}) + '\n')
+	time.sleep(0.01)
+	server.preload_app()
+	# Indexed before the workers are forked, not by a thread they would inherit
+	assert not index.refreshing
+	assert index.loaded_at['prescription'] > loaded_at['prescription']
+	assert index.loaded_at['patient'] == loaded_at['patient']
@@ -0,0 +1,26 @@
+"""
+Streamed exports
+"""
+import csv
+import io
+
+
+def test_export_streams_on_one_connection(server, client, monkeypatch):
+	monkeypatch.setattr(server, 'EXPORT_FETCH_SIZE', 100)
+	checkouts = []
+
+	def record(dbapi_connection, connection_record, connection_proxy):
+		checkouts.append(server.engine.pool.checkedout())
+
+	server.event.listen(server.engine, 'checkout', record)
+	try:
+		response = client.get('/export/admissions.csv')
+		rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+	finally:
+		server.event.remove(server.engine, 'checkout', record)
+
+	with server.engine.connect() as conn:
+		total = conn.execute(server.text("SELECT COUNT(*) FROM wl2822.admission")).scalar()
+	assert response.status_code == 200
+	assert len(rows) == total + 1
+	assert checkouts and max(checkouts) == 1
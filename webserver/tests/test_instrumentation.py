@@ -0,0 +1,22 @@
+"""
+Statement instrumentation
+"""
+import pytest
+
+
+def test_failed_statements_do_not_leak_timers(server):
+	with server.engine.connect() as conn:
+		for _ in range(3):
+			with pytest.raises(server.exc.ProgrammingError):
+				conn.execute(server.text("SELECT * FROM wl2822.no_such_table"))
+			conn.rollback()
+		conn.execute(server.text("SELECT 1"))
+		assert conn.info['statement_started'] == []
+
+
+def test_cancelled_statements_do_not_leak_timers(server):
+	with server.engine.connect() as conn:
+		with pytest.raises(server.exc.OperationalError):
+			conn.execute(server.text("SET LOCAL statement_timeout = 10; SELECT pg_sleep(1)"))
+		conn.rollback()
+		assert conn.info['statement_started'] == []
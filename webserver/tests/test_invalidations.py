@@ -0,0 +1,41 @@
+"""
+Cache invalidations reach the other `serve` workers without restarting them
+"""
+import json
+import os
+
+
+def test_invalidations_are_replayed_by_the_other_workers(server, client, tmp_path, monkeypatch):
+	monkeypatch.setattr(server, 'invalidations', {'path': None, 'offset': 0})
+	server.follow_invalidations(str(tmp_path))
+	log = tmp_path / server.INVALIDATION_LOG
+	dropped = []
+	invalidate_caches = server.invalidate_caches
+
+	def record(tables=None, broadcast=True):
+		dropped.append((tables, broadcast))
+		return invalidate_caches(tables, broadcast)
+
+	monkeypatch.setattr(server, 'invalidate_caches', record)
+
+	# This worker's own invalidation is logged, and not replayed here
+	response = client.post('/api/caches/invalidate?table=medication')
+	assert 'workers' in response.get_json()['invalidated']
+	assert [json.loads(line) for line in log.read_text().splitlines()] == \
+		[{'pid': os.getpid(), 'tables': ['medication']}]
+	client.get('/healthz')
+	assert dropped == [(['medication'], True)]
+
+	# Another worker's is replayed once, without logging it again
+	with open(log, 'a') as f:
+		f.write(json.dumps({'pid': os.getpid() + 1, 'tables': ['condition']}) + '\n')
+		f.write('{"pid": ')
+	client.get('/healthz')
+	client.get('/healthz')
+	assert dropped[1:] == [(['condition'], False)]
+	assert log.read_text().count('\n') == 2
+	# The unfinished entry is read once complete
+	with open(log, 'a') as f:
+		f.write(json.dumps(os.getpid() + 1) + ', "tables": null}\n')
+	client.get('/healthz')
+	assert dropped[2:] == [(None, False)]
@@ -0,0 +1,47 @@
+"""
+Metrics shared between `serve` workers
+"""
+import os
+import pickle
+
+
+def worker_snapshot(server, directory, pid, requests):
+	"""
+	Write the snapshot of another worker that served `requests` requests
+	"""
+	registry = server.MetricsRegistry()
+	counter = registry.register(server.Counter('test_requests_total', 'Requests', ('route',)))
+	histogram = registry.register(server.Histogram('test_seconds', 'Latency', ('route',)))
+	registry.register(server.Gauge('test_connections', 'Connections', lambda: 2))
+	for _ in range(requests):
+		counter.inc(('index',))
+		histogram.observe(('index',), 0.02)
+	with open(os.path.join(directory, f'{pid}.pickle'), 'wb') as f:
+		pickle.dump(registry.snapshot(), f)
+
+
+def test_workers_metrics_add_up(server, tmp_path):
+	registry = server.MetricsRegistry()
+	counter = registry.register(server.Counter('test_requests_total', 'Requests', ('route',)))
+	histogram = registry.register(server.Histogram('test_seconds', 'Latency', ('route',)))
+	registry.register(server.Gauge('test_connections', 'Connections', lambda: 1))
+	registry.directory = str(tmp_path)
+	counter.inc(('index',))
+	histogram.observe(('index',), 0.5)
+	worker_snapshot(server, tmp_path, 101, 3)
+	worker_snapshot(server, tmp_path, 102, 5)
+
+	body = registry.expose()
+	assert 'test_requests_total{route="index"} 9' in body
+	assert 'test_seconds_count{route="index"} 9' in body
+	assert 'test_seconds_bucket{route="index",le="0.025"} 8' in body
+	assert 'test_connections 5' in body
+	assert 'metrics_processes 3' in body
+
+	# An exited worker's counts stay; its gauges go
+	registry.retire(101)
+	body = registry.expose()
+	assert not os.path.exists(tmp_path / '101.pickle')
+	assert 'test_requests_total{route="index"} 9' in body
+	assert 'test_connections 3' in body
+	assert 'metrics_processes 2' in body
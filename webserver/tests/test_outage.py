@@ -0,0 +1,102 @@
+"""
+Pages served while the database is unreachable
+"""
+import time
+
+import pytest
+
+
+def open_breaker(server, client, path):
+	"""
+	Request `path` until the failed connections open the circuit breaker
+	"""
+	for _ in range(server.DB_BREAKER_THRESHOLD * 2):
+		if server.db_breaker.is_open:
+			return
+		client.get(path)
+	assert server.db_breaker.is_open
+
+
+@pytest.fixture
+def expiring_results(server, monkeypatch):
+	"""
+	Cached results that expire almost at once, so later requests need the
+	database and fall back to stale results
+	"""
+	if server.result_cache is None:
+		pytest.skip("the result cache is disabled")
+	for route in ('analytics', 'condition_detail'):
+		monkeypatch.setitem(server.RESULT_CACHE_TTLS, route, 0.1)
+	server.result_cache.invalidate()
+	yield
+	server.result_cache.invalidate()
+
+
+def test_analytics_is_served_stale_while_breaker_is_open(server, client, database_outage, expiring_results):
+	response = client.get('/analytics')
+	assert response.status_code == 200
+	assert 'Warning' not in response.headers
+	time.sleep(0.2)
+
+	database_outage.drop()
+	open_breaker(server, client, '/analytics')
+	response = client.get('/analytics')
+
+	assert response.status_code == 200
+	assert response.headers['Warning'].startswith('110')
+	assert b'This section is unavailable' not in response.data
+
+
+def test_condition_is_served_stale_while_breaker_is_open(server, client, database_outage, expiring_results):
+	with server.engine.connect() as conn:
+		icd_code, icd_version = conn.execute(server.text(
+			"SELECT icd_code, icd_version FROM wl2822.admission_diagnosis LIMIT 1")).one()
+	path = f'/condition/{icd_code}/{icd_version}'
+	assert client.get(path).status_code == 200
+	time.sleep(0.2)
+
+	database_outage.drop()
+	open_breaker(server, client, path)
+	response = client.get(path)
+
+	assert response.status_code == 200
+	assert response.headers['Warning'].startswith('110')
+
+
+def test_analytics_sections_are_unavailable_without_cached_results(server, client, database_outage):
+	if server.result_cache is not None:
+		server.result_cache.invalidate()
+	database_outage.drop()
+	open_breaker(server, client, '/analytics')
+	response = client.get('/analytics')
+
+	assert response.status_code == 200
+	assert b'This section is unavailable' in response.data
+	assert server.section_failures.values[('analytics', 'overall_stats', 'unavailable')] > 0
+
+
+def test_condition_is_unavailable_without_cached_results(server, client, database_outage):
+	if server.result_cache is not None:
+		server.result_cache.invalidate()
+	database_outage.drop()
+	open_breaker(server, client, '/condition/4019/9')
+
+	assert client.get('/condition/4019/9').status_code == 503
+
+
+@pytest.mark.parametrize('path, json', [
+	('/trends', False),
+	('/api/v1/trends', True),
+	('/api/v1/conditions?search=abc', True),
+	('/api/suggest?q=abc', True)
+])
+def test_routes_answer_503_without_cached_results(server, client, database_outage, path, json):
+	server.invalidate_caches()
+	database_outage.drop()
+	open_breaker(server, client, path)
+	response = client.get(path)
+
+	assert response.status_code == 503
+	assert 'Retry-After' in response.headers
+	if json:
+		assert response.get_json() == {'error': 'database unavailable'}
@@ -0,0 +1,67 @@
+"""
+Keyset pagination over sort columns that can be NULL
+"""
+import pytest
+
+# Admissions and prescriptions without a time, added for these tests
+NULL_ROWS = 3
+FIRST_TEST_ID = 2000000000
+
+
+@pytest.fixture(scope='module')
+def subject_without_times(server):
+	"""
+	A patient with some admissions, plus NULL_ROWS admissions (each with a
+	prescription) whose times are NULL
+	"""
+	with server.engine.begin() as conn:
+		admission = conn.execute(server.text("""
+			SELECT a.subject_id, p.medication_id FROM wl2822.admission a
+			JOIN wl2822.prescription p ON p.hadm_id = a.hadm_id
+			LIMIT 1
+		""")).one()
+		for i in range(NULL_ROWS):
+			conn.execute(server.text("""
+				INSERT INTO wl2822.admission (hadm_id, subject_id, admission_intime)
+				VALUES (:hadm_id, :subject_id, NULL)
+			"""), {'hadm_id': FIRST_TEST_ID + i, 'subject_id': admission.subject_id})
+			conn.execute(server.text("""
+				INSERT INTO wl2822.prescription (prescription_id, hadm_id, subject_id, medication_id, start_time)
+				VALUES (:id, :id, :subject_id, :medication_id, NULL)
+			"""), {'id': FIRST_TEST_ID + i, 'subject_id': admission.subject_id,
+				'medication_id': admission.medication_id})
+	yield admission.subject_id
+	with server.engine.begin() as conn:
+		conn.execute(server.text("DELETE FROM wl2822.prescription WHERE prescription_id >= :id"), {'id': FIRST_TEST_ID})
+		conn.execute(server.text("DELETE FROM wl2822.admission WHERE hadm_id >= :id"), {'id': FIRST_TEST_ID})
+
+
+def walk(client, path, cursor_name, cursor=None):
+	"""
+	The pages reached by following `cursor_name` from `cursor`
+	"""
+	pages = []
+	while True:
+		payload = client.get(path + (f'&cursor={cursor}' if cursor else '')).get_json()
+		pages.append(payload)
+		cursor = payload[cursor_name]
+		if cursor is None:
+			return pages
+
+
+@pytest.mark.parametrize('resource, key', [('admissions', 'hadm_id'), ('prescriptions', 'prescription_id')])
+def test_pages_cover_rows_with_null_sort_keys(server, client, subject_without_times, monkeypatch, resource, key):
+	monkeypatch.setattr(server, 'result_cache', None)
+	path = f'/api/v1/{resource}?subject_id={subject_without_times}&per_page=2&format=columnar&fields={key}'
+	with server.engine.connect() as conn:
+		total = conn.execute(server.text(f"SELECT COUNT(*) FROM wl2822.{resource[:-1]} WHERE subject_id = :subject_id"),
+			{'subject_id': subject_without_times}).scalar()
+
+	forward = walk(client, path, 'next_cursor')
+	ids = [row_id for page in forward for row_id in page['columns'][0]]
+	assert len(ids) == len(set(ids)) == total
+	assert ids[-NULL_ROWS:] == sorted(range(FIRST_TEST_ID, FIRST_TEST_ID + NULL_ROWS), reverse=True)
+
+	# Back from the last page, every page comes out as it did going forward
+	backward = walk(client, path, 'prev_cursor', forward[-1]['prev_cursor'])
+	assert [page['columns'] for page in reversed(backward)] == [page['columns'] for page in forward[:-1]]
@@ -0,0 +1,152 @@
+"""
+The patient timeline costs a fixed number of statements, whatever the
+number of admissions
+"""
+import pytest
+
+PATIENT_TIMELINE_MODES = ('full', 'stream', 'lazy')
+
+
+@pytest.fixture(scope='module')
+def patients(server):
+	"""
+	{admissions: subject_id} for a patient with one admission and the
+	patient with the most
+	"""
+	with server.engine.connect() as conn:
+		single = conn.execute(server.text("""
+			SELECT subject_id FROM wl2822.admission
+			GROUP BY subject_id HAVING COUNT(*) = 1
+			LIMIT 1
+		""")).one()
+		most = conn.execute(server.text("""
+			SELECT subject_id, COUNT(*) AS admissions FROM wl2822.admission
+			GROUP BY subject_id
+			ORDER BY admissions DESC
+			LIMIT 1
+		""")).one()
+	if most.admissions < 2:
+		pytest.skip("no patient has more than one admission")
+	return {1: single.subject_id, most.admissions: most.subject_id}
+
+
+@pytest.fixture
+def count_statements(server, monkeypatch):
+	"""
+	A function that requests a page and returns the statements it ran,
+	with the result cache out of the way
+	"""
+	monkeypatch.setattr(server, 'result_cache', None)
+	statements = []
+
+	def record(conn, cursor, statement, parameters, context, executemany):
+		statements.append(statement)
+
+	server.event.listen(server.engine, 'before_cursor_execute', record)
+
+	def count(client, path):
+		del statements[:]
+		response = client.get(path)
+		response.get_data()
+		response.close()
+		assert response.status_code == 200
+		return len(statements)
+
+	yield count
+	server.event.remove(server.engine, 'before_cursor_execute', record)
+
+
+def test_every_timeline_mode_is_covered(server):
+	assert set(PATIENT_TIMELINE_MODES) == set(server.PATIENT_TIMELINE_MODES)
+
+
+@pytest.mark.parametrize('mode', PATIENT_TIMELINE_MODES)
+def test_timeline_statements_do_not_grow_with_admissions(server, client, patients, count_statements, monkeypatch, mode):
+	monkeypatch.setattr(server, 'PATIENT_TIMELINE_MODE', mode)
+	# A streamed timeline fetched in one round
+	monkeypatch.setattr(server, 'STREAM_DETAIL_BATCH', 0)
+	# Warm up the checks the server caches per process
+	for subject_id in patients.values():
+		count_statements(client, f'/patient/{subject_id}')
+
+	counts = {admissions: count_statements(client, f'/patient/{subject_id}')
+		for admissions, subject_id in patients.items()}
+
+	assert len(set(counts.values())) == 1, counts
+	# The patient, the admissions, one query per detail section and the
+	# page version, when the data versions are installed
+	with server.engine.connect() as conn:
+		versioned = server.data_versions_installed(conn)
+	assert counts[1] <= 7 + versioned
+
+
+def test_streamed_timeline_fetches_details_in_growing_rounds(server, client, patients, count_statements, monkeypatch):
+	monkeypatch.setattr(server, 'PATIENT_TIMELINE_MODE', 'stream')
+	monkeypatch.setattr(server, 'STREAM_DETAIL_BATCH', 0)
+	admissions = max(patients)
+	path = f'/patient/{patients[admissions]}'
+	count_statements(client, path)
+	one_round = count_statements(client, path)
+
+	monkeypatch.setattr(server, 'STREAM_DETAIL_BATCH', 1)
+	rounds = [len(batch) for batch in server.detail_batches(list(range(admissions)))]
+	assert sum(rounds) == admissions
+	assert rounds[:3] == [1, 2, 4][:len(rounds)]
+	# One statement per detail section and round
+	assert count_statements(client, path) == one_round + 5 * (len(rounds) - 1)
+
+
+def test_streamed_timeline_statements_are_recorded(server, client, patients, count_statements, monkeypatch):
+	monkeypatch.setattr(server, 'PATIENT_TIMELINE_MODE', 'stream')
+	path = f'/patient/{patients[1]}'
+	count_statements(client, path)
+	before = server.request_statements.snapshot().get(('patient_detail',), ([], 0, 0))
+	statements = count_statements(client, path)
+	after = server.request_statements.snapshot()[('patient_detail',)]
+	# The details are fetched while the body streams, after the request hooks
+	assert after[2] == before[2] + 1
+	assert after[1] - before[1] == statements
+
+
+def test_admission_fragment_statements_are_fixed(server, client, patients, count_statements):
+	with server.engine.connect() as conn:
+		hadm_ids = {admissions: conn.execute(server.text(
+			"SELECT hadm_id FROM wl2822.admission WHERE subject_id = :subject_id LIMIT 1"),
+			{'subject_id': subject_id}).scalar() for admissions, subject_id in patients.items()}
+	paths = {admissions: f'/api/patient/{patients[admissions]}/admission/{hadm_id}'
+		for admissions, hadm_id in hadm_ids.items()}
+	for path in paths.values():
+		count_statements(client, path)
+
+	counts = {admissions: count_statements(client, path) for admissions, path in paths.items()}
+
+	assert len(set(counts.values())) == 1, counts
+
+
+@pytest.mark.parametrize('mode', PATIENT_TIMELINE_MODES)
+def test_timeline_validators_only_cover_complete_pages(server, client, patients, monkeypatch, mode):
+	with server.engine.connect() as conn:
+		if not server.data_versions_installed(conn):
+			pytest.skip("the data versions are not installed")
+	monkeypatch.setattr(server, 'PATIENT_TIMELINE_MODE', mode)
+	monkeypatch.setattr(server, 'result_cache', None)
+	path = f'/patient/{patients[1]}'
+	response = client.get(path)
+	response.get_data()
+	assert response.status_code == 200
+	# A streamed page's headers are sent before its sections run
+	assert bool(response.headers.get('ETag')) == (mode != 'stream')
+
+	fetch_section = server.fetch_section
+
+	def orders_unavailable(conn, name, query, params):
+		if name == 'orders':
+			return server.SectionUnavailable('timeout')
+		return fetch_section(conn, name, query, params)
+
+	monkeypatch.setattr(server, 'fetch_section', orders_unavailable)
+	response = client.get(path)
+	response.get_data()
+	assert response.status_code == 200
+	# Lazy timelines fetch no sections; the others are missing one
+	assert bool(response.headers.get('ETag')) == (mode == 'lazy')
@@ -0,0 +1,166 @@
+"""
+Read-only routes go to a replica; lagging or unreachable replicas, and
+clients that just wrote, are served by the primary.
+
+TEST_REPLICA_URI names a streaming replica of the test database (these
+tests are skipped without it), e.g. one made with
+
+    pg_basebackup -d postgresql://localhost/mimic -D /tmp/replica -R -X stream
+    pg_ctl -D /tmp/replica -o '-p 5433' start
+"""
+import os
+import time
+
+import flask
+import pytest
+from sqlalchemy import create_engine, text
+
+from conftest import TEST_DATABASEURI
+from dbproxy import DatabaseProxy
+
+TEST_REPLICA_URI = os.environ.get('TEST_REPLICA_URI')
+
+
+def replica_set(server, uri):
+	"""
+	A ReplicaSet of the one replica at `uri`, checked once; its background
+	checker is kept from starting so the tests decide when it checks
+	"""
+	replicas = server.ReplicaSet([uri], 'round_robin')
+	replicas.checker_pid = os.getpid()
+	replicas.replicas[0].check()
+	return replicas
+
+
+@pytest.fixture
+def replicas(server, monkeypatch):
+	if not TEST_REPLICA_URI:
+		pytest.skip("TEST_REPLICA_URI is not set")
+	replicas = replica_set(server, TEST_REPLICA_URI)
+	assert replicas.replicas[0].healthy, replicas.replicas[0].error
+	monkeypatch.setattr(server, 'replicas', replicas)
+	# Every request below has to reach a database
+	monkeypatch.setattr(server, 'result_cache', None)
+	yield replicas
+	replicas.replicas[0].engine.dispose()
+
+
+def served_by(server, client, path):
+	"""
+	Name of the database that answered `path`
+	"""
+	with client:
+		response = client.get(path)
+		assert response.status_code == 200
+		return server.replicas.name_of(flask.g.conn.engine)
+
+
+def test_reads_go_to_the_replica(server, client, replicas):
+	assert served_by(server, client, '/patients') == 'replica-0'
+	# Routes outside REPLICA_ROUTES stay on the primary
+	assert served_by(server, client, '/db_status') == 'primary'
+
+
+def test_lagging_replica_is_skipped(server, client, replicas, monkeypatch):
+	primary = create_engine(TEST_DATABASEURI, isolation_level='AUTOCOMMIT')
+	standby = create_engine(TEST_REPLICA_URI, isolation_level='AUTOCOMMIT')
+	with primary.connect() as primary_conn, standby.connect() as standby_conn:
+		def write():
+			# A committed transaction, so the replica has a replay timestamp
+			primary_conn.execute(text("SELECT txid_current()"))
+			return primary_conn.execute(text("SELECT pg_current_wal_insert_lsn()")).scalar()
+
+		def wait_for(condition, lsn):
+			deadline = time.time() + 10
+			while not standby_conn.execute(text(condition), {'lsn': lsn}).scalar():
+				assert time.time() < deadline, condition
+				time.sleep(0.05)
+
+		wait_for("SELECT pg_last_wal_replay_lsn() >= CAST(:lsn AS pg_lsn)", write())
+		standby_conn.execute(text("SELECT pg_wal_replay_pause()"))
+		try:
+			time.sleep(1.1)
+			write()
+			wait_for("SELECT pg_last_wal_receive_lsn() > pg_last_wal_replay_lsn()", None)
+			monkeypatch.setattr(server, 'REPLICA_MAX_LAG', 1)
+			replica = replicas.replicas[0]
+			replica.check()
+			assert not replica.healthy
+			assert replica.lag > 1
+			assert served_by(server, client, '/patients') == 'primary'
+		finally:
+			standby_conn.execute(text("SELECT pg_wal_replay_resume()"))
+
+		monkeypatch.setattr(server, 'REPLICA_MAX_LAG', 30)
+		replica.check()
+		assert replica.healthy
+		assert served_by(server, client, '/patients') == 'replica-0'
+	primary.dispose()
+	standby.dispose()
+
+
+def test_unreachable_replica_falls_back_to_the_primary(server, client, monkeypatch):
+	if not TEST_REPLICA_URI:
+		pytest.skip("TEST_REPLICA_URI is not set")
+	proxy = DatabaseProxy(TEST_REPLICA_URI)
+	replicas = replica_set(server, proxy.uri)
+	monkeypatch.setattr(server, 'replicas', replicas)
+	monkeypatch.setattr(server, 'result_cache', None)
+	try:
+		assert served_by(server, client, '/patients') == 'replica-0'
+		replicas.replicas[0].engine.dispose()
+		proxy.drop()
+		fallbacks = server.replica_fallbacks.values.get(('replica-0',), 0)
+
+		assert served_by(server, client, '/patients') == 'primary'
+		assert not replicas.replicas[0].healthy
+		assert server.replica_fallbacks.values.get(('replica-0',), 0) == fallbacks + 1
+		# Later requests skip it without trying it first
+		assert served_by(server, client, '/patients') == 'primary'
+	finally:
+		proxy.close()
+		replicas.replicas[0].engine.dispose()
+
+
+def test_writers_are_pinned_to_the_primary(server, client, replicas):
+	assert served_by(server, client, '/patients') == 'replica-0'
+
+	response = client.post('/api/caches/invalidate?table=medication')
+	assert response.status_code == 200
+	assert server.READ_YOUR_WRITES_COOKIE in response.headers['Set-Cookie']
+	assert served_by(server, client, '/patients') == 'primary'
+	assert served_by(server, client, '/prescriptions') == 'primary'
+
+	# Once the pin expires the client reads from the replica again
+	client.set_cookie(server.READ_YOUR_WRITES_COOKIE, str(time.time() - 1))
+	assert served_by(server, client, '/patients') == 'replica-0'
+
+
+def test_failed_replica_statements_are_accounted_for(server, replicas):
+	replica = replicas.replicas[0]
+	with replica.engine.connect() as conn:
+		with pytest.raises(Exception):
+			conn.execute(text("SELECT no_such_column FROM wl2822.patient"))
+		assert not conn.info.get('statement_started')
+
+
+def test_replica_lost_mid_statement_is_skipped(server, client, monkeypatch):
+	if not TEST_REPLICA_URI:
+		pytest.skip("TEST_REPLICA_URI is not set")
+	proxy = DatabaseProxy(TEST_REPLICA_URI)
+	replicas = replica_set(server, proxy.uri)
+	monkeypatch.setattr(server, 'replicas', replicas)
+	monkeypatch.setattr(server, 'result_cache', None)
+	replica = replicas.replicas[0]
+	try:
+		with replica.engine.connect() as conn:
+			conn.execute(text("SELECT 1"))
+			proxy.drop()
+			with pytest.raises(Exception):
+				conn.execute(text("SELECT 1"))
+		assert not replica.healthy
+		assert not server.db_breaker.is_open
+		assert served_by(server, client, '/patients') == 'primary'
+	finally:
+		proxy.close()
+		replica.engine.dispose()
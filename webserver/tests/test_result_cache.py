@@ -0,0 +1,20 @@
+"""
+The in-process result store keeps its results within their byte budget
+"""
+import pickle
+import time
+
+
+def test_memory_store_counts_what_it_holds(server):
+	value = (('subject_id', 'gender'), tuple((i, 'F') for i in range(100)))
+	blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+	store = server.MemoryResultStore(2 * len(blob))
+	for key in ('a', 'b', 'c'):
+		store.put(key, blob, frozenset(['patient']), time.time() + 60)
+
+	# The budget holds two of them; the least recently used went first
+	assert store.stats() == {'entries': 2, 'bytes': 2 * len(blob), 'evictions': 1}
+	assert store.get('a') is None
+	# Each hit is a copy of the rows stored, not the stored rows themselves
+	assert store.get('b') == value
+	assert store.get('b') is not store.get('b')
@@ -0,0 +1,155 @@
+"""
+The trend rollups follow every change to their sources: rows with any
+key, rows committed late, updates and deletes
+"""
+import pytest
+
+# Test admissions sit below the generated keys, in months with no data
+FIRST_TEST_ID = 19000000
+JANUARY, FEBRUARY = '2300-01-01', '2300-02-01'
+
+
+def quiet(message):
+	pass
+
+
+@pytest.fixture
+def rollups(server):
+	with server.engine.connect() as conn:
+		if not server.rollups_installed(conn):
+			pytest.skip("the rollups are not installed")
+	server.refresh_rollups(log=quiet)
+	yield
+	with server.engine.begin() as conn:
+		conn.execute(server.text("DELETE FROM wl2822.admission_diagnosis WHERE diagnosed_on >= :day"), {'day': JANUARY})
+		conn.execute(server.text("DELETE FROM wl2822.prescription WHERE hadm_id >= :id AND hadm_id < :id + 100"),
+			{'id': FIRST_TEST_ID})
+		conn.execute(server.text("DELETE FROM wl2822.admission WHERE hadm_id >= :id AND hadm_id < :id + 100"),
+			{'id': FIRST_TEST_ID})
+	server.refresh_rollups(log=quiet)
+
+
+@pytest.fixture
+def sample(server):
+	with server.engine.connect() as conn:
+		subject_id, medication_id = conn.execute(server.text("""
+			SELECT subject_id, medication_id FROM wl2822.prescription WHERE medication_id IS NOT NULL LIMIT 1
+		""")).one()
+		codes = conn.execute(server.text("SELECT icd_code, icd_version FROM wl2822.condition LIMIT 2")).fetchall()
+	return subject_id, medication_id, codes
+
+
+def month(server, table, measures, **key):
+	"""
+	The month rollup rows of `table` for January and February 2300 with
+	the given key, as {period: measures}
+	"""
+	where = "".join(f" AND {column} = :{column}" for column in key)
+	with server.engine.connect() as conn:
+		return {str(row[0]): tuple(row[1:]) for row in conn.execute(server.text(f"""
+			SELECT period, {measures} FROM wl2822.{table}
+			WHERE grain = 'month' AND period IN (:january, :february){where}
+		"""), {'january': JANUARY, 'february': FEBRUARY, **key})}
+
+
+def assert_verified(server):
+	for name in server.ROLLUP_SOURCES:
+		applied, drift, rebuilt = server.refresh_rollup(name, verify=True)
+		assert (drift, rebuilt) == (0, None), name
+
+
+def test_rollups_follow_every_change(server, rollups, sample):
+	subject_id, medication_id, ((code, version), (late_code, late_version)) = sample
+	with server.engine.begin() as conn:
+		conn.execute(server.text("""
+			INSERT INTO wl2822.admission (hadm_id, subject_id, admission_intime, admission_outtime)
+			VALUES (:id, :subject_id, '2300-01-15', '2300-01-18')
+		"""), {'id': FIRST_TEST_ID, 'subject_id': subject_id})
+		conn.execute(server.text("""
+			INSERT INTO wl2822.prescription (prescription_id, hadm_id, subject_id, medication_id, start_time)
+			VALUES (:id, :id, :subject_id, :medication_id, '2300-01-16')
+		"""), {'id': FIRST_TEST_ID, 'subject_id': subject_id, 'medication_id': medication_id})
+		conn.execute(server.text("""
+			INSERT INTO wl2822.admission_diagnosis (hadm_id, subject_id, icd_code, icd_version, diagnosed_on)
+			VALUES (:id, :subject_id, :code, :version, '2300-01-16')
+		"""), {'id': FIRST_TEST_ID, 'subject_id': subject_id, 'code': code, 'version': version})
+	server.refresh_rollups(log=quiet)
+	assert month(server, 'rollup_admissions', 'admissions, patients, length_days_sum, length_count') == \
+		{JANUARY: (1, 1, 3, 1)}
+	assert month(server, 'rollup_prescriptions', 'prescriptions', medication_id=medication_id) == {JANUARY: (1,)}
+	assert month(server, 'rollup_diagnoses', 'diagnoses', icd_code=code, icd_version=version) == {JANUARY: (1,)}
+
+	# A diagnosis added to an admission that is already rolled up
+	with server.engine.begin() as conn:
+		conn.execute(server.text("""
+			INSERT INTO wl2822.admission_diagnosis (hadm_id, subject_id, icd_code, icd_version, diagnosed_on)
+			VALUES (:id, :subject_id, :code, :version, '2300-01-20')
+		"""), {'id': FIRST_TEST_ID, 'subject_id': subject_id, 'code': late_code, 'version': late_version})
+	server.refresh_rollups(log=quiet)
+	assert month(server, 'rollup_diagnoses', 'diagnoses', icd_code=late_code, icd_version=late_version) == \
+		{JANUARY: (1,)}
+
+	# A transaction still open during a refresh is counted by the next one
+	with server.engine.connect() as conn:
+		conn.execute(server.text("""
+			INSERT INTO wl2822.admission (hadm_id, subject_id, admission_intime, admission_outtime)
+			VALUES (:id, :subject_id, '2300-01-20', '2300-01-21')
+		"""), {'id': FIRST_TEST_ID + 1, 'subject_id': subject_id})
+		server.refresh_rollups(log=quiet)
+		conn.commit()
+	assert month(server, 'rollup_admissions', 'admissions') == {JANUARY: (1,)}
+	server.refresh_rollups(log=quiet)
+	assert month(server, 'rollup_admissions', 'admissions, patients, length_days_sum, length_count') == \
+		{JANUARY: (2, 1, 4, 2)}
+	assert month(server, 'rollup_admission_patients', 'admissions', subject_id=subject_id) == {JANUARY: (2,)}
+
+	# An update moves the admission to another month
+	with server.engine.begin() as conn:
+		conn.execute(server.text("""
+			UPDATE wl2822.admission SET admission_intime = '2300-02-10', admission_outtime = '2300-02-12'
+			WHERE hadm_id = :id
+		"""), {'id': FIRST_TEST_ID + 1})
+	server.refresh_rollups(log=quiet)
+	assert month(server, 'rollup_admissions', 'admissions, patients, length_days_sum') == \
+		{JANUARY: (1, 1, 3), FEBRUARY: (1, 1, 2)}
+	assert_verified(server)
+
+	with server.engine.begin() as conn:
+		conn.execute(server.text("DELETE FROM wl2822.admission_diagnosis WHERE hadm_id = :id"), {'id': FIRST_TEST_ID})
+		conn.execute(server.text("DELETE FROM wl2822.prescription WHERE prescription_id = :id"), {'id': FIRST_TEST_ID})
+		conn.execute(server.text("DELETE FROM wl2822.admission WHERE hadm_id IN (:id, :id + 1)"), {'id': FIRST_TEST_ID})
+	server.refresh_rollups(log=quiet)
+	assert month(server, 'rollup_admissions', 'admissions') == {}
+	assert month(server, 'rollup_admission_patients', 'admissions') == {}
+	assert month(server, 'rollup_prescriptions', 'prescriptions') == {}
+	assert month(server, 'rollup_diagnoses', 'diagnoses') == {}
+	assert_verified(server)
+
+
+def test_verification_rebuilds_rollups_that_drifted(server, rollups):
+	with server.engine.begin() as conn:
+		conn.execute(server.text("""
+			UPDATE wl2822.rollup_prescriptions SET prescriptions = prescriptions + 1
+			WHERE (grain, period, medication_id) IN (SELECT grain, period, medication_id FROM wl2822.rollup_prescriptions LIMIT 1)
+		"""))
+	applied, drift, rebuilt = server.refresh_rollup('prescription', verify=True)
+	assert drift == 1
+	assert rebuilt
+	assert_verified(server)
+
+	# The rebuilt table took over the names of the one it replaced
+	with server.engine.connect() as conn:
+		indexes = {row[0] for row in conn.execute(server.text("""
+			SELECT indexname FROM pg_indexes WHERE schemaname = 'wl2822' AND tablename = 'rollup_prescriptions'
+		"""))}
+	assert indexes == {'rollup_prescriptions_pkey', 'rollup_prescriptions_medication'}
+
+
+def test_truncate_logs_a_reset(server, rollups):
+	with server.engine.connect() as conn:
+		conn.execute(server.text("TRUNCATE wl2822.admission_diagnosis"))
+		resets = conn.execute(server.text("""
+			SELECT COUNT(*) FROM wl2822.rollup_changes WHERE source = 'diagnosis' AND sign = 0
+		""")).scalar()
+		conn.rollback()
+	assert resets == 1